@@ -0,0 +1,407 @@
+"""SQLite 数据库的在线备份
+
+完整备份使用 SQLite 的 backup API, 每步只复制少量页面, 步与步之间休眠.
+数据库处于 WAL 模式时, 整个复制过程在同一个读事务中进行: WAL 模式下的读事务不会阻塞写入,
+各步看到的也是同一个快照, 不会因为其他连接的写入而从头开始.
+
+增量快照直接读取 WAL 文件: 自上次快照以来追加的帧包含了所有被修改页面的完整内容,
+取每个页面最新的一帧写成增量文件即可, 整个过程不需要任何锁. 两次快照之间服务会一直持有
+一个读事务, 使 WAL 不能被重置; 如果 WAL 仍然被重置了 (salt 改变), 就无法确定遗漏了哪些页面,
+下一次快照会改为完整备份, 开始一条新的备份链. 代价是 WAL 在备份链存续期间只增不减,
+完整备份开始前会释放读事务并截断 WAL, 调用方应在 `wal_size` 过大时提前做完整备份.
+
+每条备份链是一个目录, 其中 `base.db` 为完整备份, `NNNNNN.delta` 为依次生成的增量文件.
+增量文件的格式为 `_DELTA_MAGIC`, 页面大小、提交后的页数、页面数, 之后是若干 (页号, 页面内容)"""
+
+import functools
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+__all__ = ["BackupService", "restore_chain"]
+
+_WAL_HEADER = struct.Struct(">IIIIII")
+_WAL_FRAME_HEADER = struct.Struct(">IIII")
+_WAL_MAGIC = 0x377F0682
+_DELTA_MAGIC = b"LMWALDT1"
+_DELTA_HEADER = struct.Struct(">IIQ")
+_PGNO = struct.Struct(">I")
+_MASK = 0xFFFFFFFF
+_A = np.array([[1, 1], [1, 2]], dtype=np.uint64)
+
+
+@functools.cache
+def _powers(n: int):
+    """A^(n-1-k), k = 0..n-1, 以 uint64 回绕计算, 只关心低 32 位"""
+    powers = np.empty((n, 2, 2), dtype=np.uint64)
+    m = np.eye(2, dtype=np.uint64)
+    for k in range(n - 1, -1, -1):
+        powers[k] = m
+        m = _A @ m
+    return powers, m
+
+
+def wal_checksum(s0: int, s1: int, data: bytes, big_endian: bool):
+    """SQLite WAL 的累积校验和
+
+    逐对处理 32 位整数 x0, x1: s0 += x0 + s1; s1 += x1 + s0. 这是一个线性递推,
+    写成矩阵形式后可以用 NumPy 一次算完一整页, 而不必在 Python 中逐字循环"""
+    words = np.frombuffer(data, dtype=">u4" if big_endian else "<u4")
+    x0 = words[0::2].astype(np.uint64)
+    x1 = words[1::2].astype(np.uint64)
+    b0, b1 = x0, x0 + x1
+    powers, an = _powers(len(x0))
+    t0 = int((powers[:, 0, 0] * b0 + powers[:, 0, 1] * b1).sum())
+    t1 = int((powers[:, 1, 0] * b0 + powers[:, 1, 1] * b1).sum())
+    an = an.tolist()
+    return (
+        (an[0][0] * s0 + an[0][1] * s1 + t0) & _MASK,
+        (an[1][0] * s0 + an[1][1] * s1 + t1) & _MASK,
+    )
+
+
+class WalReset(Exception):
+    """WAL 在两次快照之间被重置, 无法再做增量快照"""
+
+
+@dataclass
+class WalScan:
+    salt: tuple[int, int]
+    page_size: int
+    # 最后一个提交帧之后的帧序号, 下一次从这里继续
+    end: int
+    # 倒数第二个提交帧之后的帧序号
+    prev_end: int
+    # 最后一次提交后数据库的页数
+    db_pages: int
+    pages: dict[int, bytes] = field(default_factory=dict)
+
+
+def scan_wal(path: str | Path, start: int = 0, salt: tuple[int, int] | None = None):
+    """读取 WAL 中从第 `start` 帧开始的所有有效帧, 只保留最后一个提交帧及以前的部分
+
+    `salt` 与文件头中的不一致时抛出 `WalReset`; WAL 不存在或为空时返回 None"""
+    try:
+        fp = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with fp:
+        header = fp.read(32)
+        if len(header) < 32:
+            return None
+        magic, _, page_size, _, salt1, salt2 = _WAL_HEADER.unpack_from(header)
+        if magic & ~1 != _WAL_MAGIC:
+            return None
+        if salt is not None and (salt1, salt2) != tuple(salt):
+            raise WalReset()
+        big_endian = bool(magic & 1)
+        frame_size = 24 + page_size
+        if start == 0:
+            s0, s1 = wal_checksum(0, 0, header[:24], big_endian)
+            if (s0, s1) != struct.unpack_from(">II", header, 24):
+                return None
+        else:
+            fp.seek(32 + (start - 1) * frame_size + 16)
+            prev = fp.read(8)
+            if len(prev) < 8:
+                raise WalReset()
+            s0, s1 = struct.unpack(">II", prev)
+        fp.seek(32 + start * frame_size)
+        scan = WalScan((salt1, salt2), page_size, start, start, 0)
+        pending: dict[int, bytes] = {}
+        index = start
+        while len(frame := fp.read(frame_size)) == frame_size:
+            pgno, commit, fsalt1, fsalt2 = _WAL_FRAME_HEADER.unpack_from(frame)
+            if (fsalt1, fsalt2) != (salt1, salt2):
+                break
+            s0, s1 = wal_checksum(s0, s1, frame[:8] + frame[24:], big_endian)
+            if (s0, s1) != struct.unpack_from(">II", frame, 16):
+                break
+            index += 1
+            pending[pgno] = frame[24:]
+            if commit:
+                scan.pages.update(pending)
+                pending.clear()
+                scan.prev_end, scan.end = scan.end, index
+                scan.db_pages = commit
+    return scan
+
+
+def wal_salt(path: str | Path):
+    try:
+        with open(path, "rb") as fp:
+            header = fp.read(32)
+    except FileNotFoundError:
+        return None
+    if len(header) < 32:
+        return None
+    return _WAL_HEADER.unpack_from(header)[4:]
+
+
+def write_delta(path: Path, scan: WalScan):
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as fp:
+        fp.write(_DELTA_MAGIC)
+        fp.write(_DELTA_HEADER.pack(scan.page_size, scan.db_pages, len(scan.pages)))
+        for pgno in sorted(scan.pages):
+            fp.write(_PGNO.pack(pgno))
+            fp.write(scan.pages[pgno])
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, path)
+
+
+def apply_delta(db: Path, delta: Path):
+    with open(delta, "rb") as src, open(db, "r+b") as dst:
+        if src.read(len(_DELTA_MAGIC)) != _DELTA_MAGIC:
+            raise ValueError(f"{delta} is not a delta file")
+        page_size, db_pages, count = _DELTA_HEADER.unpack(
+            src.read(_DELTA_HEADER.size)
+        )
+        for _ in range(count):
+            (pgno,) = _PGNO.unpack(src.read(_PGNO.size))
+            dst.seek((pgno - 1) * page_size)
+            dst.write(src.read(page_size))
+        dst.truncate(db_pages * page_size)
+
+
+def restore_chain(chain: str | Path, dest: str | Path, until: int | None = None):
+    """由一条备份链恢复出数据库文件, `until` 为最后应用的增量序号, 为 None 时应用全部"""
+    chain, dest = Path(chain), Path(dest)
+    tmp = dest.with_name(dest.name + ".restoring")
+    shutil.copyfile(chain / "base.db", tmp)
+    for delta in sorted(chain.glob("*.delta")):
+        if until is not None and int(delta.stem) > until:
+            break
+        apply_delta(tmp, delta)
+    os.replace(tmp, dest)
+
+
+def _connect(path: str | Path):
+    # 手动管理事务
+    return sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+
+
+class _Target:
+    def __init__(self, name: str, source: Path):
+        self.name = name
+        self.source = source
+        self.wal = False
+        self.lock = threading.Lock()
+        # 两次快照之间持有读事务的连接, 阻止 WAL 被重置
+        self.pin: sqlite3.Connection | None = None
+        self.chain: Path | None = None
+        self.salt: tuple[int, int] | None = None
+        self.consumed = 0
+        self.seq = 0
+        self.created = 0.0
+
+    @property
+    def wal_path(self):
+        return self.source.with_name(self.source.name + "-wal")
+
+    def release_pin(self):
+        if self.pin is not None:
+            self.pin.close()
+            self.pin = None
+
+    def save_state(self):
+        assert self.chain is not None
+        state = {
+            "wal": self.wal,
+            "salt": self.salt,
+            "consumed": self.consumed,
+            "seq": self.seq,
+            "created": self.created,
+        }
+        tmp = self.chain / "state.json.tmp"
+        tmp.write_text(json.dumps(state))
+        os.replace(tmp, self.chain / "state.json")
+
+    def load_state(self, chain: Path):
+        try:
+            state = json.loads((chain / "state.json").read_text())
+        except (FileNotFoundError, ValueError):
+            return
+        if state.get("wal") != self.wal:
+            # 日志模式改变过, 旧的链无法继续
+            return
+        self.chain = chain
+        self.salt = tuple(state["salt"]) if state["salt"] else None
+        self.consumed = state["consumed"]
+        self.seq = state["seq"]
+        self.created = state["created"]
+
+
+class BackupService:
+    """`directory` 下每个数据库一个子目录, 其中每条备份链一个以开始时间命名的目录"""
+
+    def __init__(
+        self,
+        directory: str | Path,
+        *,
+        step_pages: int = 256,
+        step_sleep: float = 0.01,
+        keep_chains: int = 3,
+    ):
+        self.directory = Path(directory)
+        self.step_pages = step_pages
+        self.step_sleep = step_sleep
+        self.keep_chains = max(keep_chains, 1)
+        self._targets: dict[str, _Target] = {}
+
+    def __contains__(self, name: str):
+        return name in self._targets
+
+    def add(self, name: str, source: str | Path):
+        """登记要备份的数据库, 并尝试把它切换到 WAL 模式, 在线程中调用"""
+        target = _Target(name, Path(source))
+        conn = _connect(target.source)
+        try:
+            mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        except sqlite3.OperationalError:
+            # 有其他连接正在使用时无法切换, 只能做完整备份
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        finally:
+            conn.close()
+        target.wal = mode.lower() == "wal"
+        chains = self._chains(name)
+        if chains:
+            target.load_state(chains[-1])
+        self._targets[name] = target
+        return target.wal
+
+    def chain_age(self, name: str):
+        """当前备份链开始至今的秒数, 还没有备份链时返回 None"""
+        target = self._targets[name]
+        if target.chain is None:
+            return None
+        return time.time() - target.created
+
+    def _chains(self, name: str):
+        root = self.directory / name
+        if not root.is_dir():
+            return []
+        return sorted(p for p in root.iterdir() if (p / "base.db").is_file())
+
+    def _prune(self, name: str):
+        for chain in self._chains(name)[: -self.keep_chains]:
+            shutil.rmtree(chain, ignore_errors=True)
+
+    def full(self, name: str):
+        """完整备份, 开始一条新的备份链, 返回链的目录. 在线程中调用"""
+        target = self._targets[name]
+        with target.lock:
+            return self._full(target)
+
+    def wal_size(self, name: str):
+        """数据库当前 WAL 文件的字节数, 不是 WAL 模式或没有 WAL 文件时返回 0"""
+        target = self._targets[name]
+        if not target.wal:
+            return 0
+        try:
+            return target.wal_path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def _truncate_wal(self, target: _Target):
+        """释放读事务并尽量把 WAL 合并后截断, 有其他连接在读写时可能只完成一部分"""
+        target.release_pin()
+        conn = _connect(target.source)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            conn.close()
+
+    def _full(self, target: _Target):
+        chain = self.directory / target.name / time.strftime("%Y%m%d-%H%M%S")
+        chain.mkdir(parents=True, exist_ok=True)
+        if target.wal:
+            # 旧的链即将被新的完整备份取代, 不再需要阻止 WAL 被重置
+            self._truncate_wal(target)
+        src = _connect(target.source)
+        try:
+            before = scan_wal(target.wal_path) if target.wal else None
+            if target.wal:
+                # 开启读事务并固定快照, 之后的每一步都从这个快照复制
+                src.execute("BEGIN")
+                src.execute("SELECT count(*) FROM sqlite_master").fetchone()
+                salt_at_begin = wal_salt(target.wal_path)
+            dst = _connect(chain / "base.db.tmp")
+            try:
+                src.backup(dst, pages=self.step_pages, sleep=self.step_sleep)
+            finally:
+                dst.close()
+        except BaseException:
+            src.close()
+            shutil.rmtree(chain, ignore_errors=True)
+            raise
+        os.replace(chain / "base.db.tmp", chain / "base.db")
+        target.release_pin()
+        target.chain = chain
+        target.seq = 0
+        target.created = time.time()
+        if target.wal:
+            # 读事务开始前扫描到的最后一个提交可能尚未对快照可见, 从倒数第二个提交之后开始,
+            # 重复应用的帧是完整的页面内容, 不影响结果. 扫描之后 WAL 被重置过时,
+            # 新 WAL 中的帧都在快照之后或已包含在快照中, 从头开始即可
+            target.pin = src
+            if before is not None and before.salt == salt_at_begin:
+                target.salt, target.consumed = before.salt, before.prev_end
+            else:
+                target.salt, target.consumed = salt_at_begin, 0
+        else:
+            src.close()
+            target.salt = None
+            target.consumed = 0
+        target.save_state()
+        self._prune(target.name)
+        return chain
+
+    def snapshot(self, name: str):
+        """增量快照, 无法做增量时改为完整备份; 返回生成的文件, 没有变化时返回 None.
+        在线程中调用"""
+        target = self._targets[name]
+        with target.lock:
+            if target.chain is None:
+                return self._full(target) / "base.db"
+            if not target.wal:
+                # 不是 WAL 模式时只能做完整备份, 由调用方决定何时进行
+                return None
+            try:
+                scan = scan_wal(target.wal_path, target.consumed, target.salt)
+            except WalReset:
+                return self._full(target) / "base.db"
+            if scan is None and target.salt is not None:
+                # 最后一个连接关闭时 WAL 会被合并后删除
+                return self._full(target) / "base.db"
+            # 在释放旧的读事务之前先开启新的, 保证任何时刻都有读事务阻止 WAL 被重置
+            pin = _connect(target.source)
+            pin.execute("BEGIN")
+            pin.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            target.release_pin()
+            target.pin = pin
+            if scan is None or scan.end == target.consumed:
+                return None
+            target.seq += 1
+            delta = target.chain / f"{target.seq:06d}.delta"
+            write_delta(delta, scan)
+            target.salt = scan.salt
+            target.consumed = scan.end
+            target.save_state()
+            return delta
+
+    def close(self):
+        for target in self._targets.values():
+            with target.lock:
+                target.release_pin()
@@ -3,6 +3,8 @@ import functools
 import os
 import time
 import traceback
+from collections import OrderedDict
+from io import BytesIO
 
 import aiofiles
 from melobot.adapter.generic import send_image, send_text
@@ -13,10 +15,12 @@ from melobot.protocols.onebot.v11.adapter.event import MessageEvent
 from melobot.protocols.onebot.v11.adapter.segment import ReplySegment, TextSegment
 from melobot.utils import singleton
 from melobot.utils.parse.cmd import CmdArgFormatInfo, CmdArgFormatter
+from PIL import Image
 from yarl import URL
 
 from .asyncutils import async_retry
-from .images import text_to_image
+from .encoding import EncodePolicy
+from .images import crop_to_circle, text_to_image
 from .templates import async_http, http_headers
 
 
@@ -65,10 +69,19 @@ class AvatarCache:
 	URL_TEMPLATE = "https://q1.qlogo.cn/g?b=qq&nk={uid}&s=640"
 	HEADERS = http_headers.copy()
 	SUPPORTED_URL_HOSTS = ["q.qlogo.cn", "q1.qlogo.cn"]
+	# 内存中保留的圆形头像的总字节数; 尺寸由用户指定的缩放倍数决定,
+	# 边长超过 MAX_CIRCLE_SIZE 的只裁剪不缓存, 以免少数几个大图占满缓存
+	MAX_CIRCLE_BYTES = 64 * 1024 * 1024
+	MAX_CIRCLE_SIZE = 1024
 
 	def __init__(self):
 		os.makedirs(self.CACHE_DIR, exist_ok=True)
 		self._update_times: dict[int, float] = {}
+		# (uid, size) -> (裁剪时头像的更新时间, 圆形头像)
+		self._circles: OrderedDict[tuple[int, int], tuple[float, Image.Image]] = (
+			OrderedDict()
+		)
+		self._circle_bytes = 0
 
 	def __getitem__(self, val: int):
 		return self.get(val)
@@ -116,6 +129,37 @@ class AvatarCache:
 			self._update_times[uid] = time.time()
 			return data
 
+	async def get_circle(self, uid: int, size: int):
+		"""裁剪为 `size` 见方的圆形头像, 按 (uid, size) 缓存, 头像更新后重新裁剪.
+		返回的图片是共享的, 不要修改"""
+		key = uid, size
+		updated = self._update_times.get(uid, 0)
+		if (
+				(cached := self._circles.get(key)) is not None
+				and cached[0] == updated
+				and time.time() - updated <= self.EXPIRES
+		):
+			self._circles.move_to_end(key)
+			return cached[1]
+		data = await self.get(uid)
+		img = await asyncio.to_thread(
+			lambda: crop_to_circle(Image.open(BytesIO(data)), size)
+		)
+		if size > self.MAX_CIRCLE_SIZE:
+			return img
+		if (old := self._circles.pop(key, None)) is not None:
+			self._circle_bytes -= self._nbytes(old[1])
+		self._circles[key] = self._update_times.get(uid, 0), img
+		self._circle_bytes += self._nbytes(img)
+		while self._circle_bytes > self.MAX_CIRCLE_BYTES:
+			_, (_, evicted) = self._circles.popitem(last=False)
+			self._circle_bytes -= self._nbytes(evicted)
+		return img
+
+	@staticmethod
+	def _nbytes(img: Image.Image):
+		return img.width * img.height * len(img.getbands())
+
 
 cached_avatar_source = AvatarCache()
 
@@ -128,7 +172,9 @@ def get_adapter():
 async def _report_by_image(text: str):
 	await send_image(
 		"Error Report",
-		raw=await asyncio.to_thread(text_to_image, text),
+		raw=await asyncio.to_thread(
+			text_to_image, text, policy=EncodePolicy(png_compress_level=1)
+		),
 		mimetype="image/png",
 	)
 
@@ -0,0 +1,76 @@
+"""可以透明保存 zstd 压缩数据的 JSON 列类型
+
+SQLite 的列没有固定的存储类型, 同一列中既可以有 JSON 文本, 也可以有 BLOB.
+未压缩的值照常以 JSON 文本保存; 被压缩的值是带有字典 id 的 zstd 帧,
+读取时按帧头中的字典 id 找到对应的字典解压, 调用方拿到的总是解析好的对象"""
+
+import json
+import threading
+from typing import Any
+
+import zstandard
+from sqlalchemy import JSON
+from sqlalchemy.types import TypeDecorator
+
+__all__ = [
+    "CompressedJSON",
+    "register_dictionary",
+    "has_dictionary",
+    "make_compressor",
+    "decompress_value",
+]
+
+_dictionaries: dict[int, zstandard.ZstdCompressionDict] = {}
+# 解压器不能在多个线程中同时使用, 每个线程各自缓存一份
+_local = threading.local()
+
+
+def register_dictionary(data: bytes):
+    """登记一个训练好的字典, 返回它的字典 id"""
+    zdict = zstandard.ZstdCompressionDict(data)
+    _dictionaries[zdict.dict_id()] = zdict
+    return zdict.dict_id()
+
+
+def has_dictionary(dict_id: int):
+    return dict_id in _dictionaries
+
+
+def _decompressor(dict_id: int) -> zstandard.ZstdDecompressor:
+    cache: dict[int, zstandard.ZstdDecompressor] = _local.__dict__.setdefault(
+        "decompressors", {}
+    )
+    if (dctx := cache.get(dict_id)) is None:
+        if dict_id and dict_id not in _dictionaries:
+            raise LookupError(f"zstd dictionary {dict_id} is not registered")
+        dctx = cache[dict_id] = zstandard.ZstdDecompressor(
+            dict_data=_dictionaries.get(dict_id)
+        )
+    return dctx
+
+
+def decompress_value(data: bytes) -> Any:
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+    return json.loads(_decompressor(dict_id).decompress(data))
+
+
+def make_compressor(dict_id: int, level: int = 9):
+    """使用已登记字典的压缩器, 载入字典的开销不小, 批量压缩时应复用同一个"""
+    return zstandard.ZstdCompressor(
+        level=level, dict_data=_dictionaries[dict_id], write_content_size=True
+    )
+
+
+class CompressedJSON(TypeDecorator):
+    impl = JSON
+    cache_ok = True
+
+    def result_processor(self, dialect, coltype):
+        load = super().result_processor(dialect, coltype)
+
+        def process(value):
+            if isinstance(value, bytes):
+                return decompress_value(value)
+            return load(value) if load is not None else value
+
+        return process
@@ -1,14 +1,61 @@
 import asyncio
 import functools
-from collections.abc import Callable
-from typing import Concatenate
+import os
+from collections.abc import Callable, Iterable, Mapping
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, Concatenate, Literal
 
 from melobot.typ.base import AsyncCallable
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncConnection
 from sqlalchemy.ext.asyncio.engine import create_async_engine
+from sqlalchemy.sql import Executable
 from sqlalchemy.schema import Table
 from sqlmodel import Session, SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+_FetchMode = Literal["all", "first", "one", "one_or_none"]
+
+
+class PreparedQuery:
+    """只构建一次, 之后带着不同参数反复执行的查询对象
+
+    语句中可变的部分用 `bindparam` 表示. 由于语句对象被复用,
+    它的缓存键只会计算一次, 编译结果则直接从引擎的编译缓存中取得"""
+
+    def __init__(self, dbcore: "AsyncDbCore", stmt: Executable, fetch: _FetchMode):
+        self._dbcore = dbcore
+        self._stmt = stmt
+        self._fetch = fetch
+
+    @property
+    def statement(self):
+        return self._stmt
+
+    def fetch_from(self, session: Session, **params: Any):
+        """在已有的同步 Session 中执行, 用于 `run_sync` 调用的函数内部"""
+        return getattr(session.exec(self._stmt, params=params), self._fetch)()
+
+    async def __call__(self, **params: Any):
+        async with self._dbcore.read_session() as sess:
+            return getattr(await sess.exec(self._stmt, params=params), self._fetch)()
+
+
+def _attach_databases(attach: dict[str, str], dbapi_conn: Any, _: Any):
+    cursor = dbapi_conn.cursor()
+    try:
+        for alias, path in attach.items():
+            cursor.execute(f'ATTACH DATABASE ? AS "{alias}"', (path,))
+    finally:
+        cursor.close()
+
+
+def _create_missing_indexes(conn: Any, tables: list[Table]):
+    for table in tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
 
 class AsyncDbCore:
     class AsyncDbCoreException(Exception):
@@ -20,13 +67,35 @@ class AsyncDbCore:
     class AlreadyStarted(AsyncDbCoreException):
         pass
 
-    def __init__(self, dburl: str, tables: list[Table], *, echo: bool = False):
+    def __init__(
+        self,
+        dburl: str,
+        tables: list[Table],
+        *,
+        echo: bool = False,
+        query_cache_size: int = 500,
+        attach: Mapping[str, str] | None = None,
+    ):
+        """`attach` 为 {别名: 文件路径}, 这些 SQLite 文件会被 ATTACH 到每个连接上,
+        本库中不存在的表在查询时会到其中查找"""
         self._url = dburl
         self._tables = tables
         self._engine = create_async_engine(
-            dburl, connect_args={"check_same_thread": False}, echo=echo
+            dburl,
+            connect_args={"check_same_thread": False},
+            echo=echo,
+            query_cache_size=query_cache_size,
         )
+        if attach:
+            event.listen(
+                self._engine.sync_engine,
+                "connect",
+                functools.partial(_attach_databases, dict(attach)),
+            )
         self._startup_event = asyncio.Event()
+        self._read_lock = asyncio.Lock()
+        self._read_conn: AsyncConnection | None = None
+        self._read_session: AsyncSession | None = None
 
     @property
     def started(self):
@@ -39,14 +108,78 @@ class AsyncDbCore:
             await conn.run_sync(
                 SQLModel.metadata.create_all, tables=self._tables, checkfirst=True
             )
+            # create_all 不会给已存在的表补建之后新增的索引
+            await conn.run_sync(_create_missing_indexes, self._tables)
         self._startup_event.set()
 
+    async def shutdown(self):
+        async with self._read_lock:
+            if self._read_session is not None:
+                await self._read_session.close()
+                self._read_session = None
+            if self._read_conn is not None:
+                await self._read_conn.close()
+                self._read_conn = None
+        await self._engine.dispose()
+
     def get_session(self, autoflush=False):
         """注意返回值是 AsyncSession 而不是 Session"""
         if not self.started.is_set():
             raise self.NotStarted()
         return AsyncSession(self._engine, autoflush=autoflush)
 
+    def begin(self):
+        """返回一个开启了事务的 AsyncConnection 上下文, 用于 Core 层面的批量写入"""
+        if not self.started.is_set():
+            raise self.NotStarted()
+        return self._engine.begin()
+
+    @asynccontextmanager
+    async def read_session(self):
+        """复用同一个连接和 AsyncSession 来执行简短的只读操作, 不可嵌套使用
+
+        所有使用者排队共享这一个连接, 全表扫描、批量任务等耗时的读取请用 `run_sync`,
+        以免挡住高频的点查. 每次使用结束后都会结束隐式开启的事务, 保证下次读取能看到最新的数据,
+        在其中进行的写入也会因此被丢弃. 读出的对象会被 expunge 而不会被 expire,
+        与 `get_session` 关闭后的表现一致"""
+        if not self.started.is_set():
+            raise self.NotStarted()
+        async with self._read_lock:
+            if self._read_session is None:
+                self._read_conn = await self._engine.connect()
+                self._read_session = AsyncSession(self._read_conn, autoflush=False)
+            sess = self._read_session
+            try:
+                yield sess
+            finally:
+                sess.expunge_all()
+                await sess.rollback()
+
+    async def reclaim_space(self, convert: bool = False):
+        """把 SQLite 文件中的空闲页归还给文件系统, 返回是否执行了回收
+
+        auto_vacuum 为 INCREMENTAL 时执行 incremental_vacuum, 开销很小. 否则只有
+        `convert` 为真时才会切换到 INCREMENTAL 并执行一次完整的 VACUUM, 它会重写整个文件,
+        期间阻塞所有写入, 并临时占用与数据库等大的磁盘空间"""
+        if not self.started.is_set():
+            raise self.NotStarted()
+        async with self._engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            mode = (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar()
+            if mode == 2:
+                # 每一步只释放一页, 需要把结果全部取完
+                (await conn.exec_driver_sql("PRAGMA incremental_vacuum")).all()
+                return True
+            if not convert:
+                return False
+            await conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            await conn.exec_driver_sql("VACUUM")
+            return True
+
+    def prepare(self, stmt: Executable, fetch: _FetchMode = "all"):
+        """将语句包装成可带参数反复执行的 `PreparedQuery`, 执行时使用只读 session"""
+        return PreparedQuery(self, stmt, fetch)
+
     async def run_sync[**P, T](
         self,
         func: Callable[Concatenate[Session, P], T],
@@ -57,13 +190,163 @@ class AsyncDbCore:
         async with self.get_session() as asess:
             return await asess.run_sync(func, *args, **kwargs)
 
+    async def run_sync_read[**P, T](
+        self,
+        func: Callable[Concatenate[Session, P], T],
+        *args: P.args,
+        **kwargs: P.kwargs,
+    ):
+        """在复用的只读 session 中执行第一个参数是 Session 的同步函数,
+        适合高频的简短查询"""
+        async with self.read_session() as asess:
+            return await asess.run_sync(func, *args, **kwargs)
+
     def to_async[**P, T](
-        self, func: Callable[Concatenate[Session, P], T]
+        self, func: Callable[Concatenate[Session, P], T], *, readonly: bool = False
     ) -> AsyncCallable[P, T]:
-        """将执行第一个参数是 Session 的同步函数装饰成异步函数, 运行时会单开一个 AsyncSession"""
+        """将执行第一个参数是 Session 的同步函数装饰成异步函数, 运行时会单开一个 AsyncSession
+
+        `readonly` 为真时改为使用复用的只读 session"""
+        runner = self.run_sync_read if readonly else self.run_sync
 
         @functools.wraps(func)
         async def wrapped(*args: P.args, **kwargs: P.kwargs):
-            return await self.run_sync(func, *args, **kwargs)
+            return await runner(func, *args, **kwargs)
 
         return wrapped
+
+
+_ShardMode = Literal["off", "group", "hash"]
+
+
+class ShardRouter:
+    """按群号把消息类的表路由到独立的 SQLite 文件
+
+    `main` 保存其余所有数据, 以及私聊消息和不分片时的全部消息. 每个分片文件只建立
+    `tables` 中的表, 并把主库 ATTACH 为 `core`, 对用户、群组等表的 join 会落到主库上.
+    group 模式下每个群一个文件, hash 模式下按群号取模分到 `buckets` 个文件中;
+    启用后不要再修改 `buckets`, 否则已有的消息会被路由到错误的分片
+
+    启用后主库中仍可能留有此前录入的群消息, 它们被迁移完之前分片中的历史是不完整的.
+    按群读取请使用 `route_read`, 它会等到该群迁移完成; 启用分片时必须在启动后
+    调用 `begin_migration` 和 `finish_migration`, 否则 `route_read` 会一直等待"""
+
+    def __init__(
+        self,
+        main: AsyncDbCore,
+        directory: str | Path,
+        tables: list[Table],
+        *,
+        mode: _ShardMode = "off",
+        buckets: int = 16,
+        echo: bool = False,
+        query_cache_size: int = 500,
+    ):
+        self.main = main
+        self.mode = mode
+        self.buckets = max(buckets, 1)
+        self._dir = Path(directory)
+        self._tables = tables
+        self._echo = echo
+        self._query_cache_size = query_cache_size
+        self._shards: dict[str, AsyncDbCore] = {}
+        self._lock = asyncio.Lock()
+        self._main_path = main._engine.url.database
+        # 主库中仍有消息待迁移的群, 以及是否已经得到了这份名单
+        self._migrating: dict[int, asyncio.Event] = {}
+        self._scanned = asyncio.Event()
+        if not self.enabled:
+            self._scanned.set()
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    @property
+    def cores(self):
+        """主库和所有已打开的分片"""
+        return [self.main, *self._shards.values()]
+
+    def shard_name(self, group_id: int | None):
+        """group_id 所在分片的名称, 存放在主库中时返回 None"""
+        if group_id is None or not self.enabled:
+            return None
+        if self.mode == "group":
+            return f"group_{group_id}"
+        return f"bucket_{group_id % self.buckets}"
+
+    async def _open(self, name: str):
+        if (core := self._shards.get(name)) is None:
+            core = AsyncDbCore(
+                f"sqlite+aiosqlite:///{(self._dir / f'{name}.db').as_posix()}",
+                self._tables,
+                echo=self._echo,
+                query_cache_size=self._query_cache_size,
+                attach={"core": self._main_path},
+            )
+            await core.startup()
+            self._shards[name] = core
+        return core
+
+    async def startup(self):
+        """启动主库, 并打开磁盘上已有的全部分片, 关闭分片后它们仍会参与全局查询"""
+        await self.main.startup()
+        async with self._lock:
+            if self._dir.is_dir():
+                for path in sorted(self._dir.glob("*.db")):
+                    await self._open(path.stem)
+            elif self.enabled:
+                os.makedirs(self._dir, exist_ok=True)
+
+    async def shutdown(self):
+        async with self._lock:
+            for core in self._shards.values():
+                await core.shutdown()
+            self._shards.clear()
+        await self.main.shutdown()
+
+    async def route(self, group_id: int | None) -> AsyncDbCore:
+        """返回保存 group_id 的消息的数据库, 分片不存在时会创建它"""
+        if (name := self.shard_name(group_id)) is None:
+            return self.main
+        if (core := self._shards.get(name)) is not None:
+            return core
+        async with self._lock:
+            return await self._open(name)
+
+    async def route_read(self, group_id: int | None) -> AsyncDbCore:
+        """与 `route` 相同, 但会等到该群在主库中的旧消息全部迁移到分片后才返回"""
+        if group_id is not None and self.enabled:
+            await self._scanned.wait()
+            if (done := self._migrating.get(group_id)) is not None:
+                await done.wait()
+        return await self.route(group_id)
+
+    def begin_migration(self, group_ids: Iterable[int]):
+        """登记主库中还有消息的群, 在它们迁移完成之前 `route_read` 会等待"""
+        for gid in group_ids:
+            self._migrating.setdefault(gid, asyncio.Event())
+        self._scanned.set()
+
+    def finish_migration(self, group_id: int | None = None):
+        """标记一个群迁移完成, 不指定时放行所有仍在等待的群"""
+        gids = list(self._migrating) if group_id is None else [group_id]
+        for gid in gids:
+            if (done := self._migrating.pop(gid, None)) is not None:
+                done.set()
+        self._scanned.set()
+
+    async def fan_out[**P, T](
+        self,
+        func: Callable[Concatenate[Session, P], T],
+        *args: P.args,
+        **kwargs: P.kwargs,
+    ) -> list[T]:
+        """在每个库各自单开的 session 中并发执行同一个同步函数, 按 `cores` 的顺序返回结果
+
+        这里执行的多是扫描整个库的查询, 因此不占用各库共享的只读 session"""
+        return list(
+            await asyncio.gather(
+                *(core.run_sync(func, *args, **kwargs) for core in self.cores)
+            )
+        )
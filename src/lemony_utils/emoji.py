@@ -0,0 +1,145 @@
+"""按码位序列缓存的 emoji 图片源
+
+pilmoji 在绘制时对每个 emoji 同步调用 `get_emoji`, 网络源会在绘制线程里逐个请求 CDN.
+这里把 emoji 图片保存在内存和磁盘上, 绘制时只查缓存, 从不访问网络;
+缺失的 emoji 由 `prefetch` 在绘制前扫描文本, 在事件循环中并发下载"""
+
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Iterable
+from io import BytesIO
+from urllib.parse import quote_plus
+
+import aiofiles
+from aiohttp import ClientError
+from pilmoji.helpers import EMOJI_REGEX
+from pilmoji.source import BaseSource
+
+from .asyncutils import async_retry
+from .consts import http_headers
+from .templates import async_http
+
+__all__ = ["emoji_key", "find_emojis", "CachedEmojiSource"]
+
+
+def emoji_key(emoji: str):
+    """码位序列, 如 1f468-200d-1f4bb"""
+    return "-".join(f"{ord(c):x}" for c in emoji)
+
+
+def find_emojis(texts: str | Iterable[str]):
+    """找出文本中 pilmoji 会作为 emoji 绘制的部分, 不包括 Discord 自定义表情"""
+    if isinstance(texts, str):
+        texts = (texts,)
+    return {
+        m for text in texts for m in EMOJI_REGEX.findall(text) if not m.startswith("<")
+    }
+
+
+class CachedEmojiSource(BaseSource):
+    """`cdn` 的地址格式与 emojicdn.elk.sh 相同: `{cdn}{emoji}?style={style}`"""
+
+    # 内存中保留的 emoji 图片数量
+    MAX_MEMORY = 1024
+
+    def __init__(
+        self,
+        cdn: str | None = None,
+        style: str = "google",
+        cache_dir: str = "data/emoji_cache",
+        concurrency: int = 8,
+    ):
+        self._cdn = (cdn or "https://emojicdn.elk.sh/").rstrip("/") + "/"
+        self._style = style
+        self._dir = os.path.join(cache_dir, style)
+        os.makedirs(self._dir, exist_ok=True)
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+        # CDN 上没有的 emoji, 本次运行中不再请求
+        self._missing: set[str] = set()
+        self._pending: dict[str, asyncio.Task[bytes | None]] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.hits = 0
+        self.misses = 0
+        self.downloads = 0
+
+    def path_of(self, emoji: str):
+        return os.path.join(self._dir, f"{emoji_key(emoji)}.png")
+
+    def _remember(self, emoji: str, data: bytes):
+        with self._lock:
+            self._memory[emoji] = data
+            self._memory.move_to_end(emoji)
+            while len(self._memory) > self.MAX_MEMORY:
+                self._memory.popitem(last=False)
+
+    def cached(self, emoji: str):
+        """只查内存和磁盘, 都没有时返回 None"""
+        with self._lock:
+            if (data := self._memory.get(emoji)) is not None:
+                self._memory.move_to_end(emoji)
+                return data
+        try:
+            with open(self.path_of(emoji), "rb") as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return None
+        self._remember(emoji, data)
+        return data
+
+    def get_emoji(self, emoji: str, /):
+        # 在绘制线程中调用, 没有缓存时放弃图片, 由 pilmoji 按普通文字绘制
+        if (data := self.cached(emoji)) is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return BytesIO(data)
+
+    def get_discord_emoji(self, id: int, /):  # pylint: disable=W0622
+        return None
+
+    @async_retry((ClientError, asyncio.TimeoutError), max_retries=2)
+    async def _download(self, emoji: str):
+        url = f"{self._cdn}{quote_plus(emoji)}?style={quote_plus(self._style)}"
+        async with async_http(url, "get", headers=http_headers) as resp:
+            if resp.status == 404:
+                return None
+            resp.raise_for_status()
+            return await resp.read()
+
+    async def _fetch(self, emoji: str):
+        async with self._semaphore:
+            data = await self._download(emoji)
+        if data is None:
+            self._missing.add(emoji)
+            return None
+        self.downloads += 1
+        path = self.path_of(emoji)
+        # 先写入临时文件, 避免中途失败留下不完整的缓存
+        async with aiofiles.open(tmp := f"{path}.tmp", "wb") as fp:
+            await fp.write(data)
+        os.replace(tmp, path)
+        self._remember(emoji, data)
+        return data
+
+    async def prefetch(self, texts: str | Iterable[str]):
+        """并发下载文本中尚未缓存的 emoji, 返回新取得的个数; 下载失败的 emoji 会被跳过"""
+        wanted = [
+            e
+            for e in find_emojis(texts)
+            if e not in self._missing
+            and e not in self._memory
+            and not os.path.isfile(self.path_of(e))
+        ]
+        if not wanted:
+            return 0
+        tasks = []
+        for emoji in wanted:
+            if (task := self._pending.get(emoji)) is None:
+                task = self._pending[emoji] = asyncio.create_task(self._fetch(emoji))
+                task.add_done_callback(lambda _, e=emoji: self._pending.pop(e, None))
+            tasks.append(asyncio.shield(task))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        return sum(isinstance(r, bytes) for r in results)
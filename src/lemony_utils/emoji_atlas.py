@@ -0,0 +1,140 @@
+"""离线的 emoji 图集
+
+把一套 emoji 图片打包成一个文件: 文件头之后是 (码位序列, 偏移, 长度) 的索引, 再之后是各图片的 PNG 数据.
+使用时以只读方式 mmap 整个文件, 索引载入为字典, 查找一个 emoji 只是一次字典查询和一次切片,
+不依赖网络. 图集可以由一个目录中的 PNG 文件或一个彩色 emoji 字体生成, 见文件末尾"""
+
+import mmap
+import os
+import re
+import struct
+from collections.abc import Iterable
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+from pilmoji.helpers import language_pack
+from pilmoji.source import BaseSource
+
+from .emoji import emoji_key, find_emojis
+
+__all__ = [
+    "atlas_key",
+    "iter_png_dir",
+    "iter_font_emojis",
+    "build_emoji_atlas",
+    "AtlasEmojiSource",
+]
+
+_MAGIC = b"LEMOJI\x00\x01"
+_HEADER = struct.Struct("<8sI")
+_ENTRY = struct.Struct("<HQI")
+_KEY_REGEX = re.compile(r"[0-9a-f]+(?:-[0-9a-f]+)*", re.IGNORECASE)
+
+
+def atlas_key(emoji_or_key: str):
+    """图集中的键: 去掉变体选择符 FE0F 的码位序列, 有无 FE0F 的写法都能查到同一张图"""
+    key = emoji_or_key if emoji_or_key.isascii() else emoji_key(emoji_or_key)
+    return "-".join(p for p in key.lower().split("-") if p != "fe0f")
+
+
+def iter_png_dir(directory: str):
+    """读取以码位序列命名的 PNG, 如 1f600.png, emoji_u1f468_200d_1f4bb.png"""
+    for name in sorted(os.listdir(directory)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() != ".png":
+            continue
+        key = stem.removeprefix("emoji_u").replace("_", "-")
+        if not _KEY_REGEX.fullmatch(key):
+            continue
+        with open(os.path.join(directory, name), "rb") as fp:
+            yield key, fp.read()
+
+
+def iter_font_emojis(font_file: str, size: int = 109):
+    """用彩色 emoji 字体绘制 pilmoji 认识的全部 emoji; Noto Color Emoji 只有 109 这一个字号"""
+    font = ImageFont.truetype(font_file, size=size)
+    for emoji in sorted(set(language_pack.values())):
+        img = Image.new("RGBA", (size * 2, size * 2))
+        ImageDraw.Draw(img).text((0, 0), emoji, font=font, embedded_color=True)
+        bbox = img.getbbox()
+        # 字体中没有的序列会被画成空白或者几个分开的字形
+        if bbox is None or bbox[2] - bbox[0] > size * 1.5:
+            continue
+        result = BytesIO()
+        img.crop(bbox).save(result, "PNG", optimize=True)
+        yield emoji_key(emoji), result.getvalue()
+
+
+def build_emoji_atlas(dest: str, images: Iterable[tuple[str, bytes]]):
+    """把 (码位序列, PNG 数据) 打包为图集文件, 返回收录的 emoji 数量"""
+    entries: dict[str, bytes] = {}
+    for key, data in images:
+        entries.setdefault(atlas_key(key), data)
+    index_size = sum(_ENTRY.size + len(key) for key in entries)
+    offset = _HEADER.size + index_size
+    with open(tmp := f"{dest}.tmp", "wb") as fp:
+        fp.write(_HEADER.pack(_MAGIC, len(entries)))
+        for key, data in entries.items():
+            fp.write(_ENTRY.pack(len(key), offset, len(data)))
+            fp.write(key.encode())
+            offset += len(data)
+        for data in entries.values():
+            fp.write(data)
+    os.replace(tmp, dest)
+    return len(entries)
+
+
+class AtlasEmojiSource(BaseSource):
+    """从图集文件读取 emoji. 图集中没有的 emoji 交给 `fallback`"""
+
+    def __init__(self, path: str, fallback: BaseSource | None = None):
+        self._fallback = fallback
+        with open(path, "rb") as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not an emoji atlas")
+        self._index: dict[str, tuple[int, int]] = {}
+        pos = _HEADER.size
+        for _ in range(count):
+            klen, offset, length = _ENTRY.unpack_from(self._mm, pos)
+            pos += _ENTRY.size
+            key = self._mm[pos : pos + klen].decode()
+            pos += klen
+            self._index[key] = (offset, length)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, emoji: str):
+        return atlas_key(emoji) in self._index
+
+    def get_emoji(self, emoji: str, /):
+        if (entry := self._index.get(atlas_key(emoji))) is not None:
+            offset, length = entry
+            return BytesIO(self._mm[offset : offset + length])
+        if self._fallback is not None:
+            return self._fallback.get_emoji(emoji)
+        return None
+
+    def get_discord_emoji(self, id: int, /):  # pylint: disable=W0622
+        if self._fallback is not None:
+            return self._fallback.get_discord_emoji(id)
+        return None
+
+    async def prefetch(self, texts: str | Iterable[str]):
+        """只为图集中没有的 emoji 调用 `fallback` 的预取"""
+        prefetch = getattr(self._fallback, "prefetch", None)
+        if prefetch is None:
+            return 0
+        return await prefetch([e for e in find_emojis(texts) if e not in self])
+
+    def close(self):
+        self._mm.close()
+
+
+if __name__ == "__main__":
+    src = input("PNG 目录或彩色 emoji 字体:")
+    dst = input("图集文件:")
+    imgs = iter_png_dir(src) if os.path.isdir(src) else iter_font_emojis(src)
+    print(build_emoji_atlas(dst, imgs), "emojis packed")
@@ -0,0 +1,162 @@
+"""渲染结果的统一编码
+
+各插件的渲染结果都经由 `encode_image` 编码, 编码方式由插件配置中的 `EncodePolicy` 决定.
+颜色不多的图 (文字、表格) 量化为调色板 PNG 体积最小; 带有照片的引用图用 WebP 或 JPEG 更合适.
+设置了 `max_bytes` 时, 结果过大会依次改用更紧凑的编码, 都不满足时取其中最小的"""
+
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Literal
+
+import numpy as np
+from melobot.log import get_logger
+from PIL import Image
+from pydantic import BaseModel
+
+__all__ = ["EncodePolicy", "EncodedImage", "encode_image"]
+
+# libwebp 能编码的最大边长
+WEBP_MAX_SIDE = 16383
+
+
+class EncodePolicy(BaseModel):
+    # auto: 颜色数不超过 palette_colors 时用调色板 PNG, 否则用 PNG
+    # palette: 总是量化为调色板 PNG (有损)
+    format: Literal["auto", "png", "palette", "webp", "jpeg"] = "auto"
+    palette_colors: int = 256
+    # PNG 的压缩等级 (0-9), 越小越快, 6 之后体积收益很小
+    png_compress_level: int = 6
+    # WebP 和 JPEG 的质量
+    quality: int = 85
+    # 编码结果的目标字节数, <= 0 时不限制
+    max_bytes: int = 0
+
+
+@dataclass
+class EncodedImage:
+    data: bytes
+    # png, webp 或 jpeg
+    format: str
+    # 编码用时 (秒), 包括尝试过的所有编码
+    elapsed: float
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def mimetype(self):
+        return f"image/{self.format}"
+
+    @property
+    def extension(self):
+        return ".jpg" if self.format == "jpeg" else f".{self.format}"
+
+    def __str__(self):
+        return f"{self.format} {self.size / 1024:.1f}KiB {self.elapsed * 1000:.0f}ms"
+
+
+def _flatten(img: Image.Image):
+    """去掉透明度, 透明部分以白色填充"""
+    if img.mode == "RGB":
+        return img
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        img = img.convert("RGBA")
+        bg = Image.new("RGB", img.size, "white")
+        bg.paste(img, mask=img.getchannel("A"))
+        return bg
+    return img.convert("RGB")
+
+
+def _exact_rgba_palette(img: Image.Image, colors: list[tuple[int, tuple]]):
+    """用图中实际出现的颜色构造调色板, 逐像素查表, 不损失任何颜色"""
+    pixels = np.asarray(img, dtype=np.uint8).reshape(-1, 4).view(np.uint32).ravel()
+    table = np.unique(
+        np.array([c for _, c in colors], dtype=np.uint8).view(np.uint32).ravel()
+    )
+    indices = np.searchsorted(table, pixels).astype(np.uint8)
+    result = Image.fromarray(indices.reshape(img.height, img.width), "P")
+    result.putpalette(table.view(np.uint8).tobytes(), "RGBA")
+    return result
+
+
+def _to_palette(img: Image.Image, colors: int):
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA")
+    if (used := img.getcolors(colors)) is not None:
+        # 颜色数本就不超过 colors 时要逐色保留, FASTOCTREE 会合并相近的颜色,
+        # 抹掉文字的抗锯齿. MEDIANCUT 此时是精确的, 但不支持 RGBA
+        if img.mode == "RGB":
+            return img.quantize(colors, method=Image.Quantize.MEDIANCUT)
+        return _exact_rgba_palette(img, used)
+    # 颜色更多时只能有损量化, FASTOCTREE 支持 RGBA
+    return img.quantize(colors, method=Image.Quantize.FASTOCTREE)
+
+
+def _save(img: Image.Image, fmt: str, policy: EncodePolicy, quality: int):
+    result = BytesIO()
+    match fmt:
+        case "png" | "palette":
+            if fmt == "palette":
+                img = _to_palette(img, policy.palette_colors)
+            img.save(result, "PNG", compress_level=policy.png_compress_level)
+        case "webp":
+            img.save(result, "WEBP", quality=quality, method=4)
+        case "jpeg":
+            _flatten(img).save(result, "JPEG", quality=quality, optimize=True)
+    return result.getvalue()
+
+
+def _candidates(img: Image.Image, policy: EncodePolicy):
+    """(编码, 质量) 的尝试顺序, 第一个为策略指定的编码, 之后为超出目标大小时的后备"""
+    fmt = policy.format
+    if fmt == "auto":
+        flat = (
+            policy.palette_colors > 0
+            and img.getcolors(policy.palette_colors) is not None
+        )
+        fmt = "palette" if flat else "png"
+    q = policy.quality
+    chain = [(fmt, q), ("webp", q), ("webp", q * 3 // 4), ("webp", q // 2)]
+    chain.append(("jpeg", q // 2))
+    if max(img.size) > WEBP_MAX_SIDE:
+        # 超出 WebP 的尺寸上限, 只能用 PNG 或 JPEG
+        chain = [c for c in chain if c[0] != "webp"]
+    seen: list[tuple[str, int]] = []
+    for c in chain:
+        if c not in seen:
+            seen.append(c)
+    return seen
+
+
+def encode_image(img: Image.Image, policy: EncodePolicy | None = None):
+    """按策略编码图片; CPU 密集, 在线程中调用"""
+    if policy is None:
+        policy = EncodePolicy()
+    start = time.perf_counter()
+    best: tuple[bytes, str] | None = None
+    error: Exception | None = None
+    for fmt, quality in _candidates(img, policy):
+        try:
+            data = _save(img, fmt, policy, quality)
+        except (ValueError, OSError) as e:
+            # 例如尺寸超出了该编码的上限, 换下一种编码
+            get_logger().debug(f"Failed to encode as {fmt}: {e!r}")
+            error = e
+            continue
+        if best is None or len(data) < len(best[0]):
+            best = data, fmt
+        if policy.max_bytes <= 0 or len(data) <= policy.max_bytes:
+            break
+    if best is None:
+        assert error is not None
+        raise error
+    data, fmt = best
+    result = EncodedImage(
+        data=data,
+        format="png" if fmt == "palette" else fmt,
+        elapsed=time.perf_counter() - start,
+    )
+    get_logger().debug(f"Encoded {img.width}x{img.height} image: {result}")
+    return result
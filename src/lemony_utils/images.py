@@ -1,17 +1,27 @@
 from io import BytesIO
 import base64
-import random
+import functools
+import hashlib
+import os
 from typing import Any, Generator, Iterable, Literal, Type
 from urllib.parse import quote_plus
 from contextlib import contextmanager
 import math
 import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
 
 from melobot.protocols.onebot.v11.adapter.segment import ImageSegment
-from PIL import ImageFont, ImageDraw, Image, ImageFilter
+from PIL import ImageColor, ImageFont, ImageDraw, ImageOps, Image
 from pilmoji import Pilmoji
 from pilmoji.source import HTTPBasedSource, BaseSource
 
+from .encoding import EncodePolicy, encode_image
+from .render import RenderExecutor
+
 _FontFileT = str | BytesIO
 _TupleColorT = tuple[int, int, int] | tuple[int, int, int, int]
 _ColorT = int | _TupleColorT | str
@@ -43,20 +53,76 @@ class SelfHostSource(HTTPBasedSource):
 
 class FontCache:
     """因为发现 ImageDraw.text 方法中的 font_size 参数不起效，
-    于是弄了个这样的类来做字体缓存"""
+    于是弄了个这样的类来做字体缓存
+
+    字体文件只在第一次使用时读入一次, 各字号的字体对象按 LRU 保留至多 `max_sizes` 个.
+    同一字体文件应通过 `get_font_cache` 共用一个实例"""
 
-    def __init__(self, font_file: _FontFileT, preload_size_range: range | None = None):
+    def __init__(
+        self,
+        font_file: _FontFileT,
+        preload_size_range: range | None = None,
+        max_sizes: int = 32,
+    ):
         self._font_file = font_file
-        self._font_map: dict[int, ImageFont.FreeTypeFont] = {}
+        self._font_data: bytes | None = None
+        self._font_map: OrderedDict[int, ImageFont.FreeTypeFont] = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_sizes = max(max_sizes, 1)
+        self.hits = 0
+        self.misses = 0
         if preload_size_range:
-            for size in preload_size_range:
-                self._font_map[size] = ImageFont.truetype(font_file, size=size)
+            self.preload(preload_size_range)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _load(self, size: int):
+        if self._font_data is None:
+            if isinstance(self._font_file, BytesIO):
+                self._font_data = self._font_file.getvalue()
+            else:
+                with open(self._font_file, "rb") as fp:
+                    self._font_data = fp.read()
+        # 从头读完整个 BytesIO 时得到的就是同一个 bytes 对象, 各字号共用一份字体数据
+        return ImageFont.truetype(BytesIO(self._font_data), size=size)
 
     def use(self, size: int):
         size = int(size)
-        if size not in self._font_map:
-            self._font_map[size] = ImageFont.truetype(self._font_file, size=size)
-        return self._font_map[size]
+        with self._lock:
+            if (font := self._font_map.get(size)) is not None:
+                self._font_map.move_to_end(size)
+                self.hits += 1
+                return font
+            self.misses += 1
+            font = self._font_map[size] = self._load(size)
+            while len(self._font_map) > self.max_sizes:
+                self._font_map.popitem(last=False)
+            return font
+
+    def preload(self, sizes: Iterable[int]):
+        """预先载入常用字号, 不计入命中统计; 会读取字体文件, 在线程中调用"""
+        with self._lock:
+            for size in map(int, sizes):
+                if size not in self._font_map:
+                    self._font_map[size] = self._load(size)
+            while len(self._font_map) > self.max_sizes:
+                self._font_map.popitem(last=False)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        # 其他线程可能正在用这些字体绘制, 子进程中它们的状态不可信, 按需重新载入
+        self._font_map = OrderedDict()
+
+    def stats(self):
+        return {
+            "sizes": len(self._font_map),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
 
     @contextmanager
     def usec(self, size: int):
@@ -66,7 +132,50 @@ class FontCache:
         return self.use(key)
 
 
-_t2i_default_font = FontCache("data/fonts/sarasa-mono-sc-semibold.ttf")
+_font_registry: dict[str, FontCache] = {}
+_font_registry_lock = threading.Lock()
+
+
+def _font_key(font_file: _FontFileT):
+    if isinstance(font_file, BytesIO):
+        return "sha1:" + hashlib.sha1(font_file.getbuffer()).hexdigest()
+    return os.path.abspath(font_file)
+
+
+def get_font_cache(font_file: _FontFileT):
+    """进程内按字体文件共享的 FontCache"""
+    key = _font_key(font_file)
+    with _font_registry_lock:
+        if (cache := _font_registry.get(key)) is None:
+            cache = _font_registry[key] = FontCache(font_file)
+        return cache
+
+
+def preload_fonts(font_file: _FontFileT, sizes: Iterable[int]):
+    """预先载入共享字体的常用字号, 在线程中调用"""
+    get_font_cache(font_file).preload(sizes)
+
+
+def font_cache_stats():
+    """各共享字体的缓存字号数和命中率"""
+    with _font_registry_lock:
+        return {key: cache.stats() for key, cache in _font_registry.items()}
+
+
+def _reset_after_fork():
+    """fork 时只有调用 fork 的线程被复制, 其他线程持有的锁在子进程中永远不会被释放.
+    渲染进程池的工作进程就是这样 fork 出来的, 在子进程中换掉所有继承来的锁"""
+    global _font_registry_lock, _fit_lock, _main_color_lock
+    _font_registry_lock = threading.Lock()
+    for cache in _font_registry.values():
+        cache._reset_after_fork()
+    _fit_lock = threading.Lock()
+    _main_color_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+_t2i_default_font = get_font_cache("data/fonts/sarasa-mono-sc-semibold.ttf")
 default_font_cache = _t2i_default_font
 
 
@@ -79,28 +188,48 @@ def wrap_text_by_length(s: str, line_length: int):
     return result
 
 
+# 每个字体对象的 字符 -> 宽度 缓存, 字体对象被回收时一并丢弃
+_glyph_widths: weakref.WeakKeyDictionary[ImageFont.FreeTypeFont, dict[str, float]] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def glyph_widths(text: str, font: ImageFont.FreeTypeFont):
+    """逐字符的宽度, 每个字符在每个字体对象上只测量一次"""
+    cache = _glyph_widths.get(font)
+    if cache is None:
+        cache = _glyph_widths[font] = {}
+    for c in set(text).difference(cache):
+        cache[c] = font.getlength(c)
+    return np.fromiter(map(cache.__getitem__, text), np.float64, len(text))
+
+
 def wrap_text_by_width(
     s: str,
     line_width: int | float,
     font: ImageFont.FreeTypeFont,
 ):
-    """根据像素宽度断行"""
+    """根据像素宽度断行
+
+    在逐字符宽度的前缀和上二分查找断点. FreeType 的宽度都是 1/64 的整数倍,
+    前缀和没有舍入误差, 结果与逐字符累加一致"""
     result: list[str] = []
     line_width = int(line_width)
     for line in s.splitlines():
         if not line:
             result.append("")
             continue
-        char_widths = [font.getlength(c) for c in line]
-        start = 0
+        cum = np.cumsum(glyph_widths(line, font))
+        if cum[-1] <= line_width:
+            result.append(line)
+            continue
+        start, base = 0, 0.0
         while start < len(line):
-            current_width = 0
-            end = start
-            while end < len(line) and current_width + char_widths[end] <= line_width:
-                current_width += char_widths[end]
-                end += 1
+            end = int(np.searchsorted(cum, base + line_width, side="right"))
+            # 单个字符就超过行宽时也放下这一个字符, 否则永远无法前进
+            end = max(end, start + 1)
             result.append(line[start:end])
-            start = end
+            start, base = end, cum[end - 1]
     return result
 
 
@@ -109,6 +238,11 @@ def to_full_width(text: str):
     return "".join([chr(ord(c) + 0xFEE0) if 33 <= ord(c) <= 126 else c for c in text])
 
 
+_FIT_CACHE_SIZE = 512
+_fit_cache: OrderedDict[tuple, tuple[int, str]] = OrderedDict()
+_fit_lock = threading.Lock()
+
+
 def calc_font_size(
     text: str,
     max_font_size: int,
@@ -121,17 +255,51 @@ def calc_font_size(
     """计算出尽可能适合指定bbox的文本的字体大小，返回字号和断行后的文本内容
 
     当已经达到给定的最小字号但仍不能适合bbox高度时，返回最小字号，
-    此时直接使用返回的字号和断行文本绘制文本将会超出bbox的高度"""
-    fsize = max_font_size
-    while fsize > min_font_size:
-        with fontcache.usec(size=fsize) as font:
-            wrapped_lines = wrap_text_by_width(text, box_width, font)
-            bbox = font.getbbox("意义是无意识")  # 这里要的是字体高度所以填什么都好x
-            # getbbox 不认换行符所以像这样
-            if (bbox[3] - bbox[1] + spacing) * len(wrapped_lines) <= box_height:
-                break
-        fsize -= 1
-    return fsize, "\n".join(wrap_text_by_width(text, box_width, fontcache.use(fsize)))
+    此时直接使用返回的字号和断行文本绘制文本将会超出bbox的高度
+
+    字号越大断出的行越多、每行越高, 所以能否放下对字号是单调的, 可以二分查找.
+    结果按参数缓存, 重复绘制相同的文本时不再断行"""
+    key = (
+        text,
+        max_font_size,
+        box_width,
+        box_height,
+        fontcache,
+        min_font_size,
+        spacing,
+    )
+    with _fit_lock:
+        if (cached := _fit_cache.get(key)) is not None:
+            _fit_cache.move_to_end(key)
+            return cached
+
+    def fit(fsize: int):
+        """能放下时返回断行结果, 否则返回 None"""
+        font = fontcache.use(fsize)
+        wrapped_lines = wrap_text_by_width(text, box_width, font)
+        bbox = font.getbbox("意义是无意识")  # 这里要的是字体高度所以填什么都好x
+        # getbbox 不认换行符所以像这样
+        if (bbox[3] - bbox[1] + spacing) * len(wrapped_lines) <= box_height:
+            return wrapped_lines
+        return None
+
+    # 在 (lo, hi] 中找能放下的最大字号, 都放不下时取最小字号
+    lo, hi = min(min_font_size, max_font_size), max_font_size
+    best = None
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if (lines := fit(mid)) is not None:
+            lo, best = mid, lines
+        else:
+            hi = mid - 1
+    if best is None:
+        best = wrap_text_by_width(text, box_width, fontcache.use(lo))
+    result = lo, "\n".join(best)
+    with _fit_lock:
+        _fit_cache[key] = result
+        while len(_fit_cache) > _FIT_CACHE_SIZE:
+            _fit_cache.popitem(last=False)
+    return result
 
 
 @contextmanager
@@ -158,7 +326,7 @@ def draw_multiline_text_auto(
     `sticky` 参数的含义参考 tkinter 的 grid 布局中的 `sticky` 参数，指定为 `None` 时横纵居中
 
     多余的 kwargs 参数们会被递交给 `draw.text` 或 `Pilmoji.text`"""
-    fontcache = font if isinstance(font, FontCache) else FontCache(font_file=font)
+    fontcache = font if isinstance(font, FontCache) else get_font_cache(font)
     font_size, wrapped_text = calc_font_size(
         text,
         max_font_size,
@@ -265,73 +433,205 @@ def calc_bbox(actual_bbox: _BboxT, expected_bbox: _BboxT, sticky: str | None):
     return int(x), int(y)
 
 
-def get_main_color(image: Image.Image, radius: None | float = None, resize: int = 50):
-    """通过 缩小图像 + 高斯模糊 + 随机取样 取得主要颜色
+_MAIN_COLOR_CACHE_SIZE = 256
+_main_color_cache: OrderedDict[tuple, tuple[int, int, int, int]] = OrderedDict()
+_main_color_lock = threading.Lock()
+
+
+def _dominant_color(image: Image.Image, bins: int, sample: int):
+    small = image.convert("RGBA").resize((sample, sample), Image.Resampling.BOX)
+    pixels = np.asarray(small).reshape(-1, 4)
+    # 忽略透明部分
+    rgb = pixels[pixels[:, 3] >= 128, :3]
+    if not len(rgb):
+        return 255, 255, 255, 255
+    q = (rgb.astype(np.uint32) * bins) >> 8
+    index = (q[:, 0] * bins + q[:, 1]) * bins + q[:, 2]
+    # 数量相同时取编号最小的格子, 结果是确定的
+    best = np.bincount(index, minlength=bins**3).argmax()
+    r, g, b = rgb[index == best].mean(axis=0).round().astype(int)
+    return int(r), int(g), int(b), 255
+
+
+def get_main_color(image: Image.Image, bins: int = 8, sample: int = 64):
+    """取得主要颜色: 缩小到 `sample` 见方后把颜色分入 `bins`^3 个格子,
+    返回像素最多的格子中颜色的平均值. 结果按图片内容缓存
 
     Inspired by Moncak
 
     ~~没错插件 `EroMoncak` 的名字里的 `Moncak` 就是这只萝莉~~"""
-    blurred = image.resize((resize, resize)).filter(
-        ImageFilter.GaussianBlur(resize if radius is None else radius)
-    )
-    w, h = blurred.size
-    return blurred.getpixel((random.randint(0, w - 1), random.randint(0, h - 1)))
+    digest = hashlib.sha1(image.tobytes()).digest()
+    key = digest, image.mode, image.size, bins, sample
+    with _main_color_lock:
+        if (cached := _main_color_cache.get(key)) is not None:
+            _main_color_cache.move_to_end(key)
+            return cached
+    result = _dominant_color(image, bins, sample)
+    with _main_color_lock:
+        _main_color_cache[key] = result
+        while len(_main_color_cache) > _MAIN_COLOR_CACHE_SIZE:
+            _main_color_cache.popitem(last=False)
+    return result
 
 
-def text_to_image(
+def _is_opaque(color: _ColorT):
+    if isinstance(color, int):
+        return False
+    if isinstance(color, str):
+        color = ImageColor.getrgb(color)
+    return len(color) == 3 or color[3] == 255
+
+
+def layout_text(
+    text: str,
+    font: ImageFont.FreeTypeFont,
+    wrap: int | None = 1920,
+    max_height: int | None = None,
+    margin: int = 10,
+    spacing: int = 4,
+    stroke_width: int = 0,
+):
+    """只测量不绘制: 断行并按 `max_height` 分页, 返回 [(页面文本, 页面尺寸)]
+
+    尺寸由字体度量和缓存的字符宽度算出, 不需要栅格化文本. 行距的算法与
+    `ImageDraw.multiline_text` 一致; 忽略字距调整, 由边距吸收"""
+    if wrap is not None and wrap > 0:
+        lines = wrap_text_by_width(text, wrap, font)
+    else:
+        lines = text.splitlines()
+    if not lines:
+        lines = [""]
+    ascent, descent = font.getmetrics()
+    line_height = ascent + descent + 2 * stroke_width
+    pitch = font.getbbox("A", stroke_width=stroke_width)[3] + stroke_width + spacing
+    per_page = len(lines)
+    if max_height is not None and max_height > 0:
+        per_page = max((max_height - 2 * margin - line_height) // pitch + 1, 1)
+    widths = [float(glyph_widths(line, font).sum()) for line in lines]
+    pages: list[tuple[str, tuple[int, int]]] = []
+    for i in range(0, len(lines), per_page):
+        page = lines[i : i + per_page]
+        width = math.ceil(max(widths[i : i + per_page])) + 2 * stroke_width
+        height = (len(page) - 1) * pitch + line_height
+        pages.append(("\n".join(page), (width + 2 * margin, height + 2 * margin)))
+    return pages
+
+
+def text_to_images(
     text: str,
     font: ImageFont.FreeTypeFont | None | int = None,
     color: _ColorT = (255, 255, 255, 255),
     bg_color: _ColorT = (32, 32, 32, 255),
     margin: int = 10,
     wrap: int | None = 1920,
+    max_height: int | None = 4096,
+    policy: EncodePolicy | None = None,
     **kwargs,
 ):
+    """把文本绘制成图片, 高度超过 `max_height` 时分成多页, 返回各页编码后的数据
+
+    每页只分配一次恰好大小的画布, 编码后立即释放. 背景和文字都不透明时使用 RGB 画布.
+    编码方式见 `EncodePolicy`, 默认的策略会把纯文字图量化为调色板 PNG"""
     if font is None:
         font = _t2i_default_font.use(20)
     elif isinstance(font, int):
         font = _t2i_default_font.use(font)
-    if wrap is not None and wrap > 0:
-        text = "\n".join(wrap_text_by_width(text, wrap, font))
-    img = Image.new("RGBA", (1000, 1000))
-    draw = ImageDraw.Draw(img)
-    left, top, right, bottom = draw.multiline_textbbox((0, 0), text, font)
-    width, height = right - left + 2 * margin, bottom - top + 2 * margin
-    img = Image.new("RGBA", (width, height), color=bg_color)
-    draw = ImageDraw.Draw(img)
-    draw_point = (0 + margin, 0 + margin)
-    draw.multiline_text(draw_point, text, font=font, fill=color, **kwargs)
-    result = BytesIO()
-    img.save(result, "PNG")
-    return result.getvalue()
+    spacing = kwargs.pop("spacing", 4)
+    stroke_width = kwargs.get("stroke_width", 0)
+    opaque = _is_opaque(color) and _is_opaque(bg_color)
+    results: list[bytes] = []
+    for page, size in layout_text(
+        text, font, wrap, max_height, margin, spacing, stroke_width
+    ):
+        img = Image.new("RGB" if opaque else "RGBA", size, color=bg_color)
+        draw = ImageDraw.Draw(img)
+        draw.multiline_text(
+            (margin + stroke_width, margin + stroke_width),
+            page,
+            font=font,
+            fill=color,
+            spacing=spacing,
+            **kwargs,
+        )
+        results.append(encode_image(img, policy).data)
+    return results
+
+
+def text_to_image(
+    text: str,
+    font: ImageFont.FreeTypeFont | None | int = None,
+    color: _ColorT = (255, 255, 255, 255),
+    bg_color: _ColorT = (32, 32, 32, 255),
+    margin: int = 10,
+    wrap: int | None = 1920,
+    **kwargs,
+):
+    """把文本绘制成一张图片, 不分页"""
+    return text_to_images(
+        text, font, color, bg_color, margin, wrap, max_height=None, **kwargs
+    )[0]
 
 
 def bytes_to_b64_url(b: bytes):
     return "base64://" + base64.b64encode(b).decode("utf-8")
 
 
-async def text_to_imgseg(text: str, /, **kwargs):
-    return ImageSegment(
-        file=await asyncio.to_thread(
-            lambda: bytes_to_b64_url(text_to_image(text, **kwargs)),
-        )
-    )
+def _t2i_runner(executor: RenderExecutor | None, kwargs: dict[str, Any]):
+    # 从内存载入的字体对象在渲染进程中无法还原, 指定了字体对象时在线程中绘制
+    if executor is None or isinstance(kwargs.get("font"), ImageFont.FreeTypeFont):
+        return asyncio.to_thread
+    return executor.run
 
 
-def crop_to_circle(img: Image.Image):
-    img = img.convert("RGBA")
-    width, height = img.size
+async def text_to_imgseg(
+    text: str, /, executor: RenderExecutor | None = None, **kwargs
+):
+    """绘制成一张图片, 参数见 `text_to_images`; `executor` 为空时在线程中绘制"""
+    data = await _t2i_runner(executor, kwargs)(text_to_image, text, **kwargs)
+    return ImageSegment(file=await asyncio.to_thread(bytes_to_b64_url, data))
+
+
+async def text_to_imgsegs(
+    text: str, /, executor: RenderExecutor | None = None, **kwargs
+):
+    """绘制成分页的图片, 用于可能很长的文本, 参数见 `text_to_images`"""
+    pages = await _t2i_runner(executor, kwargs)(text_to_images, text, **kwargs)
+    return [
+        ImageSegment(file=url)
+        for url in await asyncio.to_thread(lambda: list(map(bytes_to_b64_url, pages)))
+    ]
 
-    size = min(width, height)
-    left = (width - size) // 2
-    top = (height - size) // 2
-    right = left + size
-    bottom = top + size
-    img_cropped = img.crop((left, top, right, bottom))
 
-    mask = Image.new("L", (size, size), 0)
-    draw = ImageDraw.Draw(mask)
-    draw.ellipse((0, 0, size, size), fill=255)
-    img_cropped.putalpha(mask)
+# 绘制圆形蒙版时的超采样倍数, 缩小后得到抗锯齿的边缘
+_MASK_SUPERSAMPLE = 4
 
-    return img_cropped.copy()
+
+# 尺寸来自用户指定的缩放倍数, 只缓存不超过此边长的蒙版
+_MAX_CACHED_MASK_SIZE = 1024
+
+
+def _make_circle_mask(size: int):
+    big = size * _MASK_SUPERSAMPLE
+    mask = Image.new("L", (big, big), 0)
+    ImageDraw.Draw(mask).ellipse((0, 0, big - 1, big - 1), fill=255)
+    return mask.resize((size, size), Image.Resampling.BOX)
+
+
+_cached_circle_mask = functools.lru_cache(maxsize=64)(_make_circle_mask)
+
+
+def circle_mask(size: int):
+    """`size` 见方的抗锯齿圆形蒙版, 按尺寸缓存; 返回的蒙版可能是共享的, 不要修改"""
+    if size > _MAX_CACHED_MASK_SIZE:
+        return _make_circle_mask(size)
+    return _cached_circle_mask(size)
+
+
+def crop_to_circle(img: Image.Image, size: int | None = None):
+    """居中裁剪为正方形并加上圆形蒙版, `size` 不为空时同时缩放到 `size` 见方"""
+    img = img.convert("RGBA")
+    if size is None:
+        size = min(img.size)
+    img = ImageOps.fit(img, (size, size), Image.Resampling.LANCZOS)
+    img.putalpha(circle_mask(size))
+    return img
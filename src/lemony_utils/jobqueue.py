@@ -0,0 +1,295 @@
+"""存储在 SQLite 中的持久化后台任务队列
+
+任务以行的形式写入数据库, 由常驻的异步 worker 领取执行. 领取时为任务加上租约,
+执行成功后删除, 失败时按指数退避重新排期, 超过最大尝试次数后标记为失败并保留以便排查.
+进程崩溃时未完成的任务仍留在表中, 下次启动后继续执行"""
+
+import asyncio
+import time
+import traceback
+from collections.abc import Awaitable, Callable, Iterable
+from dataclasses import dataclass
+from typing import Any
+
+from melobot.log import get_logger
+from sqlalchemy import Column, Index, case, func, or_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlmodel import JSON, Field, SQLModel, col, delete, select, update
+
+from .database import AsyncDbCore
+
+__all__ = ["PENDING", "FAILED", "Job", "JOB_TABLE", "JobQueue"]
+
+PENDING = "pending"
+FAILED = "failed"
+
+
+class Job(SQLModel, table=True):
+    id: int | None = Field(default=None, primary_key=True)
+    type: str
+    payload: dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSON))
+    # 同一个 key 同时只会有一个待执行的任务, 用于合并重复的任务
+    key: str | None = Field(default=None, unique=True)
+    status: str = PENDING
+    attempts: int = 0
+    max_attempts: int = 5
+    next_run: float = Field(default_factory=time.time)
+    lease_until: float | None = None
+    created: float = Field(default_factory=time.time)
+    last_error: str | None = None
+
+    __table_args__ = (Index("ix_job_status_next_run", "status", "next_run"),)
+
+
+JOB_TABLE = SQLModel.metadata.tables[Job.__tablename__]
+
+_INSERT_JOB = insert(JOB_TABLE).on_conflict_do_nothing()
+
+JobHandler = Callable[[dict[str, Any]], Awaitable[Any]]
+
+
+@dataclass
+class _JobType:
+    handler: JobHandler
+    max_attempts: int
+    lease: float
+    retry_delay: float
+    on_giveup: JobHandler | None
+
+
+class JobQueue:
+    """`AsyncDbCore` 上的任务队列, 需要把 `JOB_TABLE` 加入其建表列表中"""
+
+    def __init__(self, dbcore: AsyncDbCore, *, poll_interval: float = 30):
+        self._dbcore = dbcore
+        self._types: dict[str, _JobType] = {}
+        self._poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._workers: list[asyncio.Task] = []
+        # 被指定给专门 worker 的任务类型, 通用 worker 不会领取它们
+        self._dedicated: set[str] = set()
+
+    def register(
+        self,
+        type: str,
+        handler: JobHandler,
+        *,
+        max_attempts: int = 5,
+        lease: float = 120,
+        retry_delay: float = 10,
+        on_giveup: JobHandler | None = None,
+    ):
+        """注册任务类型的处理函数, 它接收任务的 payload
+
+        任务执行时间超过 `lease` 秒后会被视为失联而可能被重复领取.
+        重试间隔从 `retry_delay` 开始逐次翻倍, 放弃时调用 `on_giveup`"""
+        self._types[type] = _JobType(
+            handler, max_attempts, lease, retry_delay, on_giveup
+        )
+        self.notify()
+
+    def _row(self, type: str, payload: dict[str, Any], key: str | None, delay: float):
+        now = time.time()
+        jtype = self._types.get(type)
+        return {
+            "type": type,
+            "payload": payload,
+            "key": key,
+            "status": PENDING,
+            "attempts": 0,
+            "max_attempts": jtype.max_attempts if jtype else 5,
+            "next_run": now + delay,
+            "lease_until": None,
+            "created": now,
+            "last_error": None,
+        }
+
+    async def enqueue(
+        self,
+        type: str,
+        payload: dict[str, Any] | None = None,
+        *,
+        key: str | None = None,
+        delay: float = 0,
+        conn: AsyncConnection | None = None,
+    ):
+        """加入一个任务, 已有同 key 的待执行任务时忽略
+
+        传入 `conn` 时在该连接的事务中写入, 以便与其他写入一起提交,
+        此时需要在提交后调用 `notify` 来唤醒 worker"""
+        await self.enqueue_many([(type, payload or {}, key)], delay=delay, conn=conn)
+
+    async def enqueue_many(
+        self,
+        jobs: Iterable[tuple[str, dict[str, Any], str | None]],
+        *,
+        delay: float = 0,
+        conn: AsyncConnection | None = None,
+    ):
+        rows = [self._row(t, p, k, delay) for t, p, k in jobs]
+        if not rows:
+            return
+        if conn is not None:
+            await conn.execute(_INSERT_JOB, rows)
+            return
+        async with self._dbcore.begin() as conn:
+            await conn.execute(_INSERT_JOB, rows)
+        self.notify()
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def _claim(self, types: list[str]):
+        if not types:
+            return None
+        now = time.time()
+        candidate = (
+            select(Job.id)
+            .where(
+                Job.status == PENDING,
+                col(Job.type).in_(types),
+                Job.next_run <= now,
+                or_(col(Job.lease_until).is_(None), col(Job.lease_until) < now),
+            )
+            .order_by(col(Job.next_run))
+            .limit(1)
+            .scalar_subquery()
+        )
+        lease = case(
+            {t: self._types[t].lease for t in types}, value=JOB_TABLE.c.type
+        )
+        # 单条 UPDATE 语句完成领取, 多个 worker 之间不会重复领取同一个任务
+        async with self._dbcore.begin() as conn:
+            return (
+                await conn.execute(
+                    update(JOB_TABLE)
+                    .where(JOB_TABLE.c.id == candidate)
+                    .values(
+                        attempts=JOB_TABLE.c.attempts + 1, lease_until=now + lease
+                    )
+                    .returning(JOB_TABLE)
+                )
+            ).one_or_none()
+
+    async def _next_due(self, types: list[str]):
+        """最近一个待执行任务的时间, 用于决定空闲时的等待时长"""
+        async with self._dbcore.get_session() as sess:
+            return (
+                await sess.exec(
+                    select(func.min(Job.next_run)).where(
+                        Job.status == PENDING,
+                        col(Job.type).in_(types),
+                        col(Job.lease_until).is_(None),
+                    )
+                )
+            ).one()
+
+    async def _finish(self, job: Any, error: BaseException | None):
+        jtype = self._types[job.type]
+        async with self._dbcore.begin() as conn:
+            if error is None:
+                await conn.execute(delete(JOB_TABLE).where(JOB_TABLE.c.id == job.id))
+                return False
+            message = "".join(traceback.format_exception_only(error)).strip()
+            if job.attempts >= job.max_attempts:
+                # key 置空, 以便之后可以重新加入同 key 的任务
+                values = {"status": FAILED, "key": None, "lease_until": None}
+            else:
+                delay = jtype.retry_delay * 2 ** (job.attempts - 1)
+                values = {"next_run": time.time() + delay, "lease_until": None}
+            await conn.execute(
+                update(JOB_TABLE)
+                .where(JOB_TABLE.c.id == job.id)
+                .values(last_error=message, **values)
+            )
+        return job.attempts >= job.max_attempts
+
+    def _types_for(self, types: frozenset[str] | None):
+        if types is not None:
+            return [t for t in types if t in self._types]
+        return [t for t in self._types if t not in self._dedicated]
+
+    async def _work(self, types: frozenset[str] | None):
+        logger = get_logger()
+        backoff = 1.0
+        while True:
+            try:
+                await self._step(types)
+            except Exception:
+                # 数据库被锁之类的暂时性错误不应让 worker 退出, 等一会再继续
+                logger.exception(f"Job worker error, retrying in {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self._poll_interval)
+            else:
+                backoff = 1.0
+
+    async def _step(self, types: frozenset[str] | None):
+        """领取并执行一个任务, 没有可执行的任务时等待到下一个任务到期或被唤醒"""
+        logger = get_logger()
+        # 先清除再领取, 领取期间加入的任务仍能唤醒之后的等待
+        self._wakeup.clear()
+        job = await self._claim(self._types_for(types))
+        if job is None:
+            timeout = self._poll_interval
+            if (due := await self._next_due(self._types_for(types))) is not None:
+                timeout = min(timeout, max(0.0, due - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
+            return
+        # 唤醒其他空闲的 worker 一起领取
+        self.notify()
+        jtype = self._types[job.type]
+        try:
+            await jtype.handler(job.payload)
+        except Exception as e:
+            error: Exception | None = e
+            logger.warning(
+                f"Job {job.type}#{job.id} failed "
+                f"(attempt {job.attempts}/{job.max_attempts}): {e!r}"
+            )
+        else:
+            error = None
+        # 这里失败时任务保持租约, 租约到期后会被重新领取
+        gave_up = await self._finish(job, error)
+        if gave_up and jtype.on_giveup is not None:
+            try:
+                await jtype.on_giveup(job.payload)
+            except Exception as e:
+                logger.warning(f"on_giveup of job {job.type}#{job.id} failed: {e!r}")
+
+    async def start(self, workers: int = 4):
+        """启动处理所有未指定给专门 worker 的任务类型的通用 worker
+
+        此前进程遗留的租约会被清除, 这些任务会立即重新执行"""
+        async with self._dbcore.begin() as conn:
+            await conn.execute(
+                update(JOB_TABLE)
+                .where(col(JOB_TABLE.c.lease_until).is_not(None))
+                .values(lease_until=None)
+            )
+        self.add_workers(workers)
+
+    def add_workers(self, count: int, types: Iterable[str] | None = None):
+        """增加 worker, 指定 `types` 时这些 worker 只处理这些类型的任务"""
+        restricted = None if types is None else frozenset(types)
+        if restricted is not None:
+            self._dedicated |= restricted
+        for _ in range(count):
+            self._workers.append(asyncio.create_task(self._work(restricted)))
+        self.notify()
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    async def pending_count(self, type: str | None = None) -> int:
+        stmt = select(func.count()).select_from(Job).where(Job.status == PENDING)
+        if type is not None:
+            stmt = stmt.where(Job.type == type)
+        async with self._dbcore.get_session() as sess:
+            return (await sess.exec(stmt)).one()
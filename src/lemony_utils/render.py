@@ -0,0 +1,147 @@
+"""在进程池中执行的渲染任务
+
+Pillow 的排版和绘制中有大量纯 Python 代码, 放在线程中执行时会互相争抢 GIL,
+几个群同时生成引用图时只能排队. 这里用进程池执行渲染, 每个工作进程启动时先构造好
+渲染所需的对象 (字体、蒙版、占位图等), 任务只传递可 pickle 的参数和编码后的结果.
+
+任务函数和预热函数都必须定义在模块顶层; 任务中用 `warm_object` 取得预热好的对象.
+进程数为 0、工作进程崩溃或参数无法 pickle 时改在线程中执行,
+此时取得的是本进程中登记时构造的对象. 超时的任务直接失败, 不会重新执行.
+
+工作进程由多线程的主进程 fork 而来, 继承的锁可能正被其他线程持有而永远不会释放.
+预热函数会用到的模块级缓存须用 `os.register_at_fork` 在子进程中换掉自己的锁,
+见 `images._reset_after_fork`; 万一仍然卡住, 超时后换用新的进程池"""
+
+import asyncio
+import functools
+import pickle
+import signal
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any
+
+from melobot.log import get_logger
+
+__all__ = ["RenderExecutor", "warm_object"]
+
+_WarmSpec = tuple[str, Callable[..., Any], tuple]
+
+_objects: dict[str, Any] = {}
+
+
+def _init_worker(specs: list[_WarmSpec]):
+    # fork 出的进程虽然继承了这些对象, 但其中的锁可能正被其他线程持有, 重新构造
+    # 它们; 预热函数取用的共享缓存则由各自的 at-fork 钩子重置
+    for key, factory, args in specs:
+        _objects[key] = factory(*args)
+
+
+def warm_object(key: str) -> Any:
+    """取得当前进程中预热好的对象"""
+    return _objects[key]
+
+
+class RenderExecutor:
+    # 工作进程内的计时先到期; 父进程多等这么久仍无结果, 说明进程卡在了 C 代码中
+    KILL_GRACE = 10
+
+    def __init__(self, processes: int = 0, timeout: float = 120):
+        """`timeout` 为单个任务的最长执行时间 (秒), 不含等待空闲工作进程的时间"""
+        self.processes = processes
+        self.timeout = timeout
+        self._specs: list[_WarmSpec] = []
+        self._pool: ProcessPoolExecutor | None = None
+        # 同时提交的任务不超过工作进程数, 任务一提交就开始执行, 计时不含排队
+        self._slots = asyncio.Semaphore(max(processes, 1))
+
+    def register[**P, T](
+        self, key: str, factory: Callable[P, T], /, *args: P.args, **kwargs: P.kwargs
+    ) -> T:
+        """登记在每个工作进程启动时构造的对象, 须在第一次提交任务之前登记.
+        本进程中也立即构造一份并返回, 供插件自身和线程回退使用"""
+        if kwargs:
+            factory = functools.partial(factory, **kwargs)
+        self._specs.append((key, factory, args))
+        obj = _objects[key] = factory(*args)
+        return obj
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.processes, initializer=_init_worker, initargs=(self._specs,)
+            )
+        return self._pool
+
+    def _retire(self, pool: ProcessPoolExecutor):
+        """之后的任务提交到新的进程池, 已提交到旧池的任务照常完成"""
+        if self._pool is pool:
+            self._pool = None
+        pool.shutdown(wait=False)
+
+    async def run[**P, T](
+        self, func: Callable[P, T], /, *args: P.args, **kwargs: P.kwargs
+    ) -> T:
+        """执行超时时抛出 `TimeoutError`"""
+        if self.processes > 0:
+            try:
+                # 预先序列化, 无法 pickle 的任务不会进入进程池
+                payload = pickle.dumps((func, args, kwargs), pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                get_logger().warning(f"Render job not picklable, using a thread: {e!r}")
+            else:
+                try:
+                    return await self._run_in_pool(payload)
+                except BrokenProcessPool:
+                    get_logger().exception("Render process pool broke, using a thread")
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def _run_in_pool(self, payload: bytes) -> Any:
+        async with self._slots:
+            pool = self._get_pool()
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(pool, _call, payload, self.timeout)
+            try:
+                done, _ = await asyncio.wait(
+                    {future}, timeout=self.timeout + self.KILL_GRACE
+                )
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            if not done:
+                # 卡住的工作进程不会再接任务, 换一个进程池; 其他任务不受影响
+                future.cancel()
+                self._retire(pool)
+                get_logger().error(
+                    f"Render worker stuck after {self.timeout}s, replacing the pool"
+                )
+                raise TimeoutError(f"Render job timed out after {self.timeout}s")
+            try:
+                return future.result()
+            except BrokenProcessPool:
+                self._retire(pool)
+                raise
+
+    def shutdown(self):
+        """插件停止时调用, 取消尚未开始的任务"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+def _on_alarm(signum, frame):
+    raise TimeoutError("Render job timed out")
+
+
+def _call(payload: bytes, timeout: float):
+    func, args, kwargs = pickle.loads(payload)
+    # 任务在工作进程的主线程中执行, 用定时信号中断超时的任务, 工作进程本身可以继续使用
+    timed = timeout > 0 and hasattr(signal, "setitimer")
+    if timed:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        if timed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
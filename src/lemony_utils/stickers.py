@@ -0,0 +1,184 @@
+"""按表情包 id 缓存的商城表情 (mface)
+
+同一个商城表情会以不同的 URL 出现成千上万次, 但 `emoji_package_id` 和 `emoji_id`
+总能唯一确定它. 这里以二者为键, 在磁盘上保存原始文件, 在内存中保存解码并缩小后的首帧,
+供 Recorder 的录入流程和两个引用渲染器共用, 重复出现的表情不会再被下载和解码"""
+
+import asyncio
+import os
+from collections import OrderedDict
+from collections.abc import Mapping
+from io import BytesIO
+from typing import Any
+
+import aiofiles
+from melobot.utils import singleton
+from PIL import Image
+
+from .asyncutils import async_retry
+from .botutils import get_mface_url
+from .consts import http_headers
+from .templates import async_http
+
+__all__ = ["StickerKey", "sticker_key", "StickerCache", "sticker_cache"]
+
+StickerKey = tuple[int, str]
+
+
+def sticker_key(data: Mapping[str, Any]) -> StickerKey | None:
+    """从 mface 消息段的 data 中取出缓存键, 信息不全时返回 None"""
+    package_id, emoji_id = data.get("emoji_package_id"), data.get("emoji_id")
+    if package_id is None or not emoji_id:
+        return None
+    try:
+        return int(package_id), str(emoji_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _verify(data: bytes):
+    """确认数据是 Pillow 能识别的图片, 否则抛出异常; CDN 出错时可能返回网页"""
+    with Image.open(BytesIO(data)) as img:
+        img.verify()
+
+
+def _decode_frame(data: bytes, max_side: int):
+    with Image.open(BytesIO(data)) as img:
+        img.draft("RGB", (max_side, max_side))
+        frame = img.convert("RGBA")
+    if max(frame.size) > max_side:
+        frame.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    return frame
+
+
+def _nbytes(img: Image.Image):
+    return img.width * img.height * len(img.getbands())
+
+
+@singleton
+class StickerCache:
+    CACHE_DIR = "data/stickers"
+    # 内存中保留的已解码帧的总字节数的默认值, 可通过实例的 max_frame_bytes 修改
+    MAX_FRAME_BYTES = 64 * 1024 * 1024
+    DEFAULT_SIDE = 300
+
+    def __init__(self):
+        os.makedirs(self.CACHE_DIR, exist_ok=True)
+        self.max_frame_bytes = self.MAX_FRAME_BYTES
+        self._frames: OrderedDict[tuple[int, str, int], Image.Image] = OrderedDict()
+        self._frame_bytes = 0
+        self._pending: dict[StickerKey, asyncio.Task[bytes]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.downloads = 0
+
+    def path_of(self, key: StickerKey):
+        """原始文件的路径; 商城表情有 GIF、PNG 等多种格式, 文件名不带格式的扩展名"""
+        package_id, emoji_id = key
+        return os.path.join(self.CACHE_DIR, str(package_id), f"{emoji_id}.img")
+
+    def _legacy_path(self, key: StickerKey):
+        package_id, emoji_id = key
+        return os.path.join(self.CACHE_DIR, str(package_id), f"{emoji_id}.gif")
+
+    def _existing_path(self, key: StickerKey):
+        for path in (self.path_of(key), self._legacy_path(key)):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def has(self, key: StickerKey):
+        return self._existing_path(key) is not None
+
+    def _discard(self, key: StickerKey):
+        """删除无法解码的缓存文件, 下次使用时重新下载"""
+        for path in (self.path_of(key), self._legacy_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @async_retry()
+    async def _download(self, url: str):
+        async with async_http(url, "get", headers=http_headers) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    async def _fetch(self, key: StickerKey, url: str | None):
+        data = await self._download(url or get_mface_url(key[1]))
+        self.downloads += 1
+        await asyncio.to_thread(_verify, data)
+        path = self.path_of(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写入临时文件, 避免中途失败留下不完整的缓存
+        async with aiofiles.open(tmp := f"{path}.tmp", "wb") as fp:
+            await fp.write(data)
+        os.replace(tmp, path)
+        return data
+
+    async def get_bytes(self, key: StickerKey, url: str | None = None):
+        """返回表情的原始文件内容, 同一个表情同时只会下载一次"""
+        if (path := self._existing_path(key)) is not None:
+            async with aiofiles.open(path, "rb") as fp:
+                return await fp.read()
+        if (task := self._pending.get(key)) is None:
+            task = self._pending[key] = asyncio.create_task(self._fetch(key, url))
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def prefetch(self, key: StickerKey, url: str | None = None):
+        """确保表情的原始文件已在磁盘上, 返回是否进行了下载"""
+        if self.has(key):
+            return False
+        await self.get_bytes(key, url)
+        return True
+
+    async def get_frame(
+        self, key: StickerKey, url: str | None = None, max_side: int = DEFAULT_SIDE
+    ):
+        """返回解码后长边不超过 `max_side` 的首帧, 调用方不应修改它"""
+        fkey = (*key, max_side)
+        if (frame := self._frames.get(fkey)) is not None:
+            self._frames.move_to_end(fkey)
+            self.hits += 1
+            return frame
+        self.misses += 1
+        data = await self.get_bytes(key, url)
+        try:
+            frame = await asyncio.to_thread(_decode_frame, data, max_side)
+        except Exception:
+            self._discard(key)
+            raise
+        if (old := self._frames.pop(fkey, None)) is not None:
+            self._frame_bytes -= _nbytes(old)
+        self._frames[fkey] = frame
+        self._frame_bytes += _nbytes(frame)
+        while self._frame_bytes > self.max_frame_bytes and self._frames:
+            _, evicted = self._frames.popitem(last=False)
+            self._frame_bytes -= _nbytes(evicted)
+        return frame
+
+    async def get_frames(
+        self,
+        items: Mapping[str, tuple[StickerKey, str | None]],
+        max_side: int = DEFAULT_SIDE,
+    ):
+        """批量获取, 参数为 {名称: (键, url)}, 获取失败的不会出现在结果中"""
+        names = list(items)
+        frames = await asyncio.gather(
+            *[self.get_frame(*items[n], max_side=max_side) for n in names],
+            return_exceptions=True,
+        )
+        return {n: f for n, f in zip(names, frames) if isinstance(f, Image.Image)}
+
+    def stats(self):
+        return {
+            "frames": len(self._frames),
+            "frame_bytes": self._frame_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "downloads": self.downloads,
+        }
+
+
+sticker_cache = StickerCache()
@@ -7,7 +7,7 @@ from melobot.protocols.onebot.v11.adapter import Adapter
 from melobot.utils.parse import CmdArgs
 
 from arknights_datasource import ArknSource
-from lemony_utils.images import text_to_imgseg
+from lemony_utils.images import text_to_imgsegs
 import little_helper
 
 ArknightsUtils = PluginPlanner("0.1.0")
@@ -56,7 +56,7 @@ async def query(
                 )
                 if result:
                     await adapter.send_reply(
-                        await text_to_imgseg(
+                        await text_to_imgsegs(
                             json.dumps(result[0], indent=2, ensure_ascii=False)
                         )
                     )
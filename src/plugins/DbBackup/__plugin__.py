@@ -0,0 +1,101 @@
+import asyncio
+import glob
+from pathlib import Path
+
+from melobot import get_bot
+from melobot.log import get_logger
+from melobot.plugin import PluginPlanner
+from pydantic import BaseModel
+
+from configloader import ConfigLoader, ConfigLoaderMetadata
+from lemony_utils.backup import BackupService
+
+
+class BackupConfig(BaseModel):
+    # 要备份的数据库文件, 支持通配
+    databases: list[str] = [
+        "data/record/messages.db",
+        "data/record/shards/*.db",
+        "data/record/deers.db",
+        "data/group_waifus.db",
+    ]
+    directory: str = "data/backups"
+    # 完整备份的间隔, 备份链持有读事务, WAL 在两次完整备份之间只增不减
+    full_interval: int = 24 * 60 * 60
+    # WAL 超过此字节数时提前做完整备份, 以便截断 WAL; <= 0 时不检查
+    max_wal_size: int = 64 * 1024 * 1024
+    # 增量快照的间隔
+    snapshot_interval: int = 15 * 60
+    # 每个数据库保留的备份链条数
+    keep_chains: int = 3
+    # 完整备份时每步复制的页数和每步之间的等待, 避免长时间占用数据库
+    step_pages: int = 256
+    step_sleep: float = 0.01
+
+
+DbBackup = PluginPlanner("0.1.0")
+bot = get_bot()
+logger = get_logger()
+cfgloader = ConfigLoader(
+    ConfigLoaderMetadata(model=BackupConfig, filename="backup_conf.json")
+)
+cfgloader.load_config()
+service = BackupService(
+    cfgloader.config.directory,
+    step_pages=cfgloader.config.step_pages,
+    step_sleep=cfgloader.config.step_sleep,
+    keep_chains=cfgloader.config.keep_chains,
+)
+
+
+def _resolve():
+    """展开通配, 以相对于 data 目录的路径命名, 如 record_shards_g123"""
+    found: dict[str, Path] = {}
+    for pattern in cfgloader.config.databases:
+        for p in sorted(glob.glob(pattern)):
+            path = Path(p)
+            try:
+                rel = path.relative_to("data")
+            except ValueError:
+                rel = path
+            found[rel.with_suffix("").as_posix().replace("/", "_")] = path
+    return found
+
+
+async def backup_all():
+    """对每个数据库做一次增量快照, 到期或无法增量时做完整备份"""
+    for name, path in _resolve().items():
+        try:
+            if name not in service:
+                await asyncio.to_thread(service.add, name, path)
+            age = service.chain_age(name)
+            wal_size = service.wal_size(name)
+            max_wal = cfgloader.config.max_wal_size
+            if (
+                age is None
+                or age > cfgloader.config.full_interval
+                or 0 < max_wal < wal_size
+            ):
+                chain = await asyncio.to_thread(service.full, name)
+                logger.info(
+                    f"Full backup of {name} written to {chain}"
+                    f" (WAL was {wal_size / 1024 / 1024:.1f} MiB)"
+                )
+            elif result := await asyncio.to_thread(service.snapshot, name):
+                logger.debug(f"Backup snapshot of {name} written to {result}")
+        except Exception:
+            logger.exception(f"Failed to back up {name}")
+
+
+@bot.on_loaded
+async def _():
+    # 等各插件完成建表和迁移
+    await asyncio.sleep(60)
+    while True:
+        await backup_all()
+        await asyncio.sleep(cfgloader.config.snapshot_interval)
+
+
+@bot.on_stopped
+async def _():
+    await asyncio.to_thread(service.close)
@@ -12,22 +12,34 @@ from melobot.protocols.onebot.v11.adapter.base import Adapter
 from melobot.protocols.onebot.v11.adapter.event import GroupMessageEvent
 from melobot.protocols.onebot.v11.adapter.segment import ImageSegment, TextSegment
 from melobot.protocols.onebot.v11.handle import on_message
-from melobot.utils.base import to_async
 from melobot.utils.deco import lock
 from pydantic import BaseModel
 
 from configloader import ConfigLoader, ConfigLoaderMetadata
 from lemony_utils.botutils import cached_avatar_source
 from lemony_utils.database import AsyncDbCore
+from lemony_utils.encoding import EncodePolicy
 from lemony_utils.images import bytes_to_b64_url
-
-from .core import TABLES, Drawer, query, query_one_day_total, record
+from lemony_utils.render import RenderExecutor
+
+from .core import (
+    TABLES,
+    make_drawer,
+    query,
+    query_one_day_total,
+    record,
+    render_calendar,
+)
 
 
 class CfgModel(BaseModel):
     trigger_chars: str = "鹿撸🦌"
     group_isolation: bool = False
     daily_limit: int = 100  # < 1 的值记为无限制
+    # 日历图颜色很少, 默认的策略会量化为调色板 PNG
+    encoding: EncodePolicy = EncodePolicy()
+    # 渲染进程数, 日历图绘制很快, 默认在线程中绘制
+    render_processes: int = 0
 
 
 dburl = "sqlite+aiosqlite:///data/record/deers.db"
@@ -38,12 +50,12 @@ cfgloader = ConfigLoader(
 cfgloader.load_config()
 
 deerdbcore = AsyncDbCore(dburl, TABLES, echo="--debug" in sys.argv)
-drawer = Drawer("data/deer.jpg", "data/correct.png")
+render_executor = RenderExecutor(cfgloader.config.render_processes)
+render_executor.register("deeeer", make_drawer, "data/deer.jpg", "data/correct.png")
 
 record_a = deerdbcore.to_async(record)
-query_a = deerdbcore.to_async(query)
-query_one_day_total_a = deerdbcore.to_async(query_one_day_total)
-draw = to_async(drawer.draw)
+query_a = deerdbcore.to_async(query, readonly=True)
+query_one_day_total_a = deerdbcore.to_async(query_one_day_total, readonly=True)
 
 plugin = PluginPlanner("0.1.2")
 bot = get_bot()
@@ -54,6 +66,11 @@ async def _():
     await deerdbcore.startup()
 
 
+@bot.on_stopped
+async def _():
+    render_executor.shutdown()
+
+
 DEER_CHARS = cfgloader.config.trigger_chars
 DEER_JUDGE_REGEX = re.compile(rf"^(?:\s*[{re.escape(DEER_CHARS)}]\s*)+$", re.IGNORECASE)
 DEER_COUNT_REGEX = re.compile(rf"[{re.escape(DEER_CHARS)}]", re.IGNORECASE)
@@ -90,18 +107,20 @@ async def deer(event: GroupMessageEvent, adapter: Adapter):
     )
     nt = time.localtime()
     avatar = BytesIO(await cached_avatar_source.get(event.user_id))
-    pic = await draw(
+    pic = await render_executor.run(
+        render_calendar,
         records,
         year=nt.tm_year,
         month=nt.tm_mon,
         user_name=str(event.sender.nickname),
         user_avatar=avatar,
+        policy=cfgloader.config.encoding,
     )
     await adapter.send_reply(
         [
             TextSegment("成功🦌了" + (f" {combo} 次!" if combo > 1 else "!")),
             ImageSegment(
-                file=await asyncio.to_thread(bytes_to_b64_url, pic.getvalue())
+                file=await asyncio.to_thread(bytes_to_b64_url, pic.data)
             ),
         ],
     )
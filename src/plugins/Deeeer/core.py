@@ -7,9 +7,12 @@ from pathlib import Path
 from typing import cast
 
 from PIL import Image, ImageDraw, ImageOps
+from sqlalchemy import bindparam
 from sqlmodel import Field, Session, SQLModel, select
 
+from lemony_utils.encoding import EncodePolicy, encode_image
 from lemony_utils.images import FontCache, default_font_cache
+from lemony_utils.render import warm_object
 from lemony_utils.time import get_time_period_start
 
 
@@ -24,6 +27,18 @@ class DeerRecord(SQLModel, table=True):
 TABLES = [SQLModel.metadata.tables[cast(str, DeerRecord.__tablename__)]]
 
 
+# 查询语句只构建一次, 每次调用只传入参数
+_QUERY_STMT = select(
+    DeerRecord.timestamp,
+    DeerRecord.combo,
+).where(
+    DeerRecord.timestamp >= bindparam("start"),
+    DeerRecord.timestamp <= bindparam("end"),
+    DeerRecord.user_id == bindparam("uid"),
+)
+_QUERY_IN_GROUP_STMT = _QUERY_STMT.where(DeerRecord.group_id == bindparam("gid"))
+
+
 def query(
     session: Session,
     uid: int,
@@ -33,17 +48,11 @@ def query(
     now_time = time.time()
     if time_range is None:
         time_range = (get_time_period_start("month", now_time).timestamp(), now_time)
-    query_stmt = select(
-        DeerRecord.timestamp,
-        DeerRecord.combo,
-    ).where(
-        DeerRecord.timestamp >= time_range[0],
-        DeerRecord.timestamp <= time_range[1],
-        DeerRecord.user_id == uid,
-    )
-    if gid is not None:
-        query_stmt = query_stmt.where(DeerRecord.group_id == gid)
-    return list(session.exec(query_stmt).all())
+    params = {"start": time_range[0], "end": time_range[1], "uid": uid}
+    if gid is None:
+        return list(session.exec(_QUERY_STMT, params=params).all())
+    params["gid"] = gid
+    return list(session.exec(_QUERY_IN_GROUP_STMT, params=params).all())
 
 
 def query_one_day_total(
@@ -101,6 +110,9 @@ class Drawer:
         self._deer_pic_ok = Image.alpha_composite(self._deer_pic, cs)
         self._font = font if font else default_font_cache
 
+    def preload_fonts(self):
+        self._font.preload((self.FONT_SIZE, self.FONT_SIZE_SMALL))
+
     def draw(
         self,
         records: list[tuple[float, int]],
@@ -108,6 +120,7 @@ class Drawer:
         month: int,
         user_name: str,
         user_avatar: _ValidImageInput | None = None,
+        policy: EncodePolicy | None = None,
     ):
         mc = calendar.monthcalendar(year, month)
         user_avatar = Image.alpha_composite(
@@ -190,6 +203,24 @@ class Drawer:
                 fill="#ff0000ff",
                 anchor="rs",
             )
-        result = BytesIO()
-        canvas.save(result, "png")
-        return result
+        return encode_image(canvas, policy)
+
+
+def make_drawer(deer_pic: _ValidImageInput, correct_sign: _ValidImageInput):
+    """构造 Drawer 并载入字体, 也用作渲染进程的预热"""
+    drawer = Drawer(deer_pic, correct_sign)
+    drawer.preload_fonts()
+    return drawer
+
+
+def render_calendar(
+    records: list[tuple[float, int]],
+    year: int,
+    month: int,
+    user_name: str,
+    user_avatar: _ValidImageInput | None = None,
+    policy: EncodePolicy | None = None,
+):
+    """渲染进程中执行的任务, 使用预热好的 Drawer"""
+    drawer: Drawer = warm_object("deeeer")
+    return drawer.draw(records, year, month, user_name, user_avatar, policy)
@@ -9,7 +9,7 @@ from melobot.protocols.onebot.v11.adapter.event import MessageEvent
 
 import checker_factory
 import little_helper
-from lemony_utils.images import text_to_imgseg
+from lemony_utils.images import text_to_imgsegs
 
 Executor = PluginPlanner("0.1.0")
 little_helper.register(
@@ -50,7 +50,7 @@ async def run_shell(event: MessageEvent, adapter: Adapter, logger: GenericLogger
     if s := stderr:
         reply.append(f"stderr:\n{s.strip()}")
     reply.append(f"\ncode = {code}")
-    await adapter.send_reply(await text_to_imgseg("\n".join(reply)))
+    await adapter.send_reply(await text_to_imgsegs("\n".join(reply)))
 
 
 @on_start_match(".pyexec", checker=checker_factory.get_owner_checker())
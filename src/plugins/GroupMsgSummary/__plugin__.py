@@ -82,7 +82,8 @@ class MsgFromDB:
 
 async def get_reply_from_db(event: GroupMessageEvent):
 	msg_id = get_reply_msg_id(event)
-	async with Recorder.database.get_session() as sess:
+	database = await Recorder.shards.route_read(event.group_id)
+	async with database.get_session() as sess:
 		from sqlalchemy.orm import joinedload
 
 		msg = (
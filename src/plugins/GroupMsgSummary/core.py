@@ -169,9 +169,10 @@ class SummaryCore:
 		"""准备摘要数据 - 使用新的get_recent_messages函数"""
 		from .. import Recorder
 
-		async with Recorder.database.get_session() as sess:
+		database = await Recorder.shards.route_read(group_id)
+		async with database.get_session() as sess:
 			# 使用get_recent_messages函数获取最近count条消息
-			messages = await Recorder.database.run_sync(
+			messages = await database.run_sync(
 				lambda session: Recorder.utils.get_recent_messages(
 					session,
 					group_id=group_id,
@@ -3,7 +3,7 @@ import os
 import time
 
 import aiofiles
-from melobot import PluginPlanner
+from melobot import PluginPlanner, get_bot
 from melobot.handle import on_command
 from melobot.log import GenericLogger
 from melobot.protocols.onebot.v11 import Adapter
@@ -13,8 +13,10 @@ from pydantic import BaseModel
 
 import little_helper
 from configloader import ConfigLoader, ConfigLoaderMetadata
+from lemony_utils.encoding import EncodePolicy
+from lemony_utils.render import RenderExecutor
 
-from .maker import QuoteMaker
+from .maker import make_quote_maker
 
 Quoter = PluginPlanner("0.1.0")
 little_helper.register(
@@ -28,10 +30,16 @@ little_helper.register(
 
 class QuoteConfig(BaseModel):
     emoji_cdn: str | None = None
+    # 离线 emoji 图集, 由 `python -m lemony_utils.emoji_atlas` 生成
+    emoji_atlas: str | None = None
     font: str = "data/fonts/NotoSansSC-Medium.ttf"
     mask: str = "data/quote_mask.png"
     saveto: str | None = "data/record/quotes"
     allow_image: bool = False
+    # 允许引用图片时结果可能很大, 超过 4MiB 时改用更紧凑的编码
+    encoding: EncodePolicy = EncodePolicy(max_bytes=4 * 1024 * 1024)
+    # 渲染进程数, 默认在线程中渲染; 多个群同时引用较慢时再开启
+    render_processes: int = 0
 
 
 os.makedirs("data/fonts", exist_ok=True)
@@ -41,11 +49,22 @@ cfgloader = ConfigLoader(
 cfgloader.load_config()
 if cfgloader.config.saveto:
     os.makedirs(cfgloader.config.saveto, exist_ok=True)
-maker = QuoteMaker(
+render_executor = RenderExecutor(cfgloader.config.render_processes)
+maker = render_executor.register(
+    "justquote",
+    make_quote_maker,
     font=cfgloader.config.font,
     bg_mask=cfgloader.config.mask,
     emoji_cdn=cfgloader.config.emoji_cdn,
+    emoji_atlas=cfgloader.config.emoji_atlas,
+    encoding=cfgloader.config.encoding,
 )
+bot = get_bot()
+
+
+@bot.on_stopped
+async def _():
+    render_executor.shutdown()
 
 
 @Quoter.use
@@ -68,19 +87,20 @@ async def quote(adapter: Adapter, event: GroupMessageEvent, logger: GenericLogge
     image = await maker.make(
         msg.data,
         use_imgs=cfgloader.config.allow_image,
+        executor=render_executor,
     )
     if image is None:
         await adapter.send_reply("目标消息中没有支持引用的元素")
         return
-    imagebytes = image.getvalue()
+    imagebytes = image.data
     imageb64 = "base64://" + base64.b64encode(imagebytes).decode("utf-8")
     await adapter.send(ImageSegment(file=imageb64))
     if not (path := cfgloader.config.saveto):
         return
     file = os.path.join(
         path,
-        f"{time.strftime('%Y%m%d-%H%M%S', time.localtime())}_{sender.user_id}_{event.group_id}.png",
+        f"{time.strftime('%Y%m%d-%H%M%S', time.localtime())}_{sender.user_id}_{event.group_id}{image.extension}",
     )
     async with aiofiles.open(file, "wb+") as fp:
         await fp.write(imagebytes)
-    logger.info(f"quote saved as {file}")
+    logger.info(f"quote ({image}) saved as {file}")
@@ -13,16 +13,22 @@ from melobot.protocols.onebot.v11.adapter.segment import (
     TextSegment,
 )
 from PIL import Image, ImageDraw, ImageOps
-from pilmoji.source import BaseSource, GoogleEmojiSource
+from pilmoji.source import BaseSource
 
 from lemony_utils.botutils import cached_avatar_source
 from lemony_utils.consts import http_headers
+from lemony_utils.emoji import CachedEmojiSource
+from lemony_utils.emoji_atlas import AtlasEmojiSource
+from lemony_utils.encoding import EncodePolicy, encode_image
 from lemony_utils.images import (
     FontCache,
-    SelfHostSource,
     draw_multiline_text_auto,
+    get_font_cache,
     get_main_color,
+    preload_fonts,
 )
+from lemony_utils.render import RenderExecutor, warm_object
+from lemony_utils.stickers import sticker_cache, sticker_key
 from lemony_utils.templates import async_http
 
 _SupportedImgInput = str | BytesIO | Image.Image
@@ -30,38 +36,74 @@ _FontSource = str | BytesIO
 
 
 class QuoteMaker:
+    # 消息图片的粘贴区域
+    IMAGE_BOX = (800, 700)
+
     def __init__(
         self,
         font: _FontSource,
         bg_mask: _SupportedImgInput,
         emoji_cdn: str | None = None,
+        emoji_atlas: str | None = None,
+        encoding: EncodePolicy | None = None,
     ):
-        self._font_cache = FontCache(font)
+        self._font_cache = get_font_cache(font)
+        self._encoding = encoding
+        source = CachedEmojiSource(emoji_cdn)
+        # 图集中没有的 emoji 仍从 CDN 取得
         self._emoji_source = (
-            SelfHostSource(emoji_cdn) if emoji_cdn else GoogleEmojiSource()
+            AtlasEmojiSource(emoji_atlas, fallback=source) if emoji_atlas else source
         )
         self._mask = self._standardize(bg_mask)
 
-    async def make(self, msg: _GetMsgEchoDataInterface, use_imgs=False):
+    async def make(
+        self,
+        msg: _GetMsgEchoDataInterface,
+        use_imgs=False,
+        executor: RenderExecutor | None = None,
+    ):
+        """`executor` 为空时在线程中绘制, 否则交给其中以 `make_quote_maker` 预热的对象"""
         sender = msg["sender"]
         avatar = BytesIO(await cached_avatar_source.get(sender.user_id))
         image_dict = (await self._fetch_all_imgs(msg["message"])) if use_imgs else None
-        return await asyncio.to_thread(
-            self._make,
+        texts = [sender.card or "", sender.nickname or ""]
+        texts += [s.data["text"] for s in msg["message"] if isinstance(s, TextSegment)]
+        await self._emoji_source.prefetch(texts)
+        if executor is None:
+            return await asyncio.to_thread(self.render, msg, avatar, image_dict)
+        return await executor.run(render_quote, msg, avatar, image_dict)
+
+    def render(
+        self,
+        msg: _GetMsgEchoDataInterface,
+        avatar: BytesIO | None,
+        image_dict: dict[str, Image.Image] | None = None,
+    ):
+        return self._make(
             msg=msg,
             mask=self._mask,
             avatar=self._standardize(avatar),
             emsource=self._emoji_source,
             font=self._font_cache,
             image_dict=image_dict,
+            policy=self._encoding,
         )
 
     @staticmethod
-    def _standardize(image: _SupportedImgInput | None):
+    def _standardize(
+        image: _SupportedImgInput | None, max_size: tuple[int, int] | None = None
+    ):
+        """`max_size` 不为空时先在解码阶段缩小, 避免完整解码大图"""
         if image is None:
             return None
         if isinstance(image, (str, BytesIO)):
-            img = Image.open(image).convert("RGBA")
+            img = Image.open(image)
+            if max_size:
+                img.draft("RGB", max_size)
+            # 调色板图缩放时只能用最近邻采样, 要先转成 RGBA 再缩小
+            img = img.convert("RGBA")
+            if max_size:
+                img.thumbnail(max_size)
         elif isinstance(image, Image.Image):
             img = image.convert("RGBA")
         else:
@@ -72,22 +114,37 @@ class QuoteMaker:
 
     @classmethod
     async def _fetch_all_imgs(cls, segs: Iterable[Segment], maxsize=-1):
+        segs = list(segs)
         urls = [
             str(seg.data["url"]) for seg in segs if isinstance(seg, ImageRecvSegment)
         ]
-        get_logger().debug(f"{urls=}")
-        return {
-            k: v
-            for k, v in zip(
+        # 商城表情从共享的表情缓存中取得, 不再按 url 下载
+        stickers = {
+            url: (key, url)
+            for seg in segs
+            if seg.type == "mface"
+            and (url := seg.data.get("url"))
+            and (key := sticker_key(seg.data))
+        }
+        get_logger().debug(f"{urls=}, {list(stickers)=}")
+        images = dict(
+            zip(
                 urls,
                 map(
-                    cls._standardize,
+                    functools.partial(cls._standardize, max_size=cls.IMAGE_BOX),
                     await asyncio.gather(
                         *(cls.fetch_image(url, maxsize=maxsize) for url in urls)
                     ),
                 ),
             )
-            if v
+        )
+        for url, frame in (await sticker_cache.get_frames(stickers)).items():
+            images[url] = cls._standardize(frame)
+        # 保持图片在消息中的顺序
+        return {
+            str(url): img
+            for seg in segs
+            if (url := seg.data.get("url")) and (img := images.get(str(url)))
         }
 
     @staticmethod
@@ -113,6 +170,7 @@ class QuoteMaker:
         emsource: BaseSource,
         font: FontCache,
         image_dict: dict[str, Image.Image] | None = None,
+        policy: EncodePolicy | None = None,
     ):
         if image_dict is None:
             image_dict = {}
@@ -123,8 +181,16 @@ class QuoteMaker:
         sender = msg["sender"]
         msgsegs = msg["message"]
         msgtexts: list[str] = []
+        # 已作为图片绘制的商城表情, 其附带的文本不再重复绘制
+        sticker_texts = {
+            seg.data.get("summary")
+            for seg in msgsegs
+            if seg.type == "mface" and seg.data.get("url") in image_dict
+        }
         for seg in msgsegs:
             if isinstance(seg, TextSegment):
+                if seg.data["text"] in sticker_texts:
+                    continue
                 msgtexts.append(seg.data["text"])
             elif isinstance(seg, AtSegment):
                 msgtexts.append(
@@ -175,7 +241,7 @@ class QuoteMaker:
         elif image_dict:
             get_logger().debug("drawing msg, plainimgs")
             imgs = list(image_dict.values())
-            pastebox = cls._calc_paste_box((800, 700), [img.size for img in imgs])
+            pastebox = cls._calc_paste_box(cls.IMAGE_BOX, [img.size for img in imgs])
             w, h, cw, ch = pastebox
             x, y = 1050, 200
             for i in range(h):
@@ -194,9 +260,7 @@ class QuoteMaker:
                             y + i * ch + int((ch - resized.size[1]) / 2),
                         ),
                     )
-        fp = BytesIO()
-        canvas.save(fp, format="PNG")
-        return fp
+        return encode_image(canvas, policy)
 
     @staticmethod
     def _calc_paste_box(box: tuple[int, int], sizes: Iterable[tuple[int, int]]):
@@ -216,3 +280,25 @@ class QuoteMaker:
         q = box_h // best_h
 
         return best_w, best_h, p, q
+
+
+def make_quote_maker(
+    font: _FontSource,
+    bg_mask: _SupportedImgInput,
+    emoji_cdn: str | None = None,
+    emoji_atlas: str | None = None,
+    encoding: EncodePolicy | None = None,
+):
+    """构造 QuoteMaker 并载入作者名和消息文本框的最大字号, 也用作渲染进程的预热"""
+    preload_fonts(font, (36, 72))
+    return QuoteMaker(font, bg_mask, emoji_cdn, emoji_atlas, encoding)
+
+
+def render_quote(
+    msg: _GetMsgEchoDataInterface,
+    avatar: BytesIO | None,
+    image_dict: dict[str, Image.Image] | None = None,
+):
+    """渲染进程中执行的任务, 使用预热好的 QuoteMaker"""
+    maker: QuoteMaker = warm_object("justquote")
+    return maker.render(msg, avatar, image_dict)
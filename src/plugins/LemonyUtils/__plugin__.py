@@ -31,7 +31,7 @@ import checker_factory
 import little_helper
 from extended_actions.lagrange import MfaceSegment
 from lemony_utils.botutils import get_reply
-from lemony_utils.images import text_to_imgseg
+from lemony_utils.images import text_to_imgsegs
 
 REBOOT_INFO_PATH = "data/reboot_info.json"
 
@@ -154,7 +154,7 @@ async def getmsg(
         await adapter.send_reply(json.dumps(msgdata, indent=2, ensure_ascii=False))
     else:
         await adapter.send_reply(
-            await text_to_imgseg(json.dumps(msgdata, indent=2, ensure_ascii=False))
+            await text_to_imgsegs(json.dumps(msgdata, indent=2, ensure_ascii=False))
         )
 
 
@@ -9,7 +9,7 @@ from io import BytesIO
 from typing import Annotated, Concatenate
 
 import aiofiles
-from melobot import get_logger, send_text
+from melobot import get_bot, get_logger, send_text
 from melobot.di import Reflect
 from melobot.handle import on_command
 from melobot.plugin import PluginPlanner
@@ -22,6 +22,7 @@ from melobot.protocols.onebot.v11.adapter.segment import (
 )
 from melobot.session import Rule, enter_session, suspend
 from melobot.utils import get_id, singleton, unfold_ctx
+from PIL import Image
 from pydantic import BaseModel
 from sqlmodel import Session as SqlmSession
 from sqlmodel import col, select
@@ -31,11 +32,22 @@ import checker_factory
 import little_helper
 from configloader import ConfigLoader, ConfigLoaderMetadata
 from lemony_utils.botutils import auto_report_traceback, get_reply
-from lemony_utils.images import FontCache, SelfHostSource, bytes_to_b64_url
+from lemony_utils.encoding import EncodePolicy
+from lemony_utils.images import bytes_to_b64_url
+from lemony_utils.render import RenderExecutor
+from lemony_utils.stickers import sticker_cache
 from recorder_models import Message
 
 from .. import Recorder
-from .core import QuoteFactory, gather_resources, prepare_quote
+from .core import (
+    collect_stickers,
+    gather_avatars,
+    gather_resources,
+    make_quote_factory,
+    prepare_quote,
+    render_quote,
+)
+from .params import default_drawing_params
 
 logger = get_logger()
 
@@ -53,6 +65,8 @@ little_helper.register(
 
 class QuoteConfig(BaseModel):
     emoji_cdn: str | None = None
+    # 离线 emoji 图集, 由 `python -m lemony_utils.emoji_atlas` 生成
+    emoji_atlas: str | None = None
     font: str = "data/fonts/NotoSansSC-Medium.ttf"
     placeholder_img: str = "data/no_data.png"
     saveto: str | None = "data/record/quotes"
@@ -68,21 +82,33 @@ class QuoteConfig(BaseModel):
     same_msg_min_dist: int = 60 * 10
     region_limit: tuple[int, int] = (-25, 25)
     scale_limit: float = 5.0
+    # 引用图常带有照片, 超过 4MiB 时改用更紧凑的编码
+    encoding: EncodePolicy = EncodePolicy(max_bytes=4 * 1024 * 1024)
+    # 渲染进程数, 默认在线程中渲染; 多个群同时引用较慢时再开启
+    render_processes: int = 0
 
 
 cfgloader = ConfigLoader(
     ConfigLoaderMetadata(model=QuoteConfig, filename="momoquote_conf.json")
 )
 cfgloader.load_config()
-quote_factory = QuoteFactory(
-    font=FontCache(cfgloader.config.font),
-    emoji_source=(
-        SelfHostSource(cfgloader.config.emoji_cdn)
-        if cfgloader.config.emoji_cdn
-        else None
-    ),
-    placeholder_img=cfgloader.config.placeholder_img,
+
+
+render_executor = RenderExecutor(cfgloader.config.render_processes)
+quote_factory = render_executor.register(
+    "momoquote",
+    make_quote_factory,
+    cfgloader.config.font,
+    cfgloader.config.placeholder_img,
+    cfgloader.config.emoji_cdn,
+    cfgloader.config.emoji_atlas,
 )
+bot = get_bot()
+
+
+@bot.on_stopped
+async def _():
+    render_executor.shutdown()
 
 
 def to_thread_deco[**P, T](func: Callable[P, T]):
@@ -124,7 +150,8 @@ class MsgFromDB:
 
 async def get_reply_from_db(event: GroupMessageEvent):
     msg_id = get_reply_msg_id(event)
-    async with Recorder.database.get_session() as sess:
+    database = await Recorder.shards.route_read(event.group_id)
+    async with database.get_session() as sess:
         msg = (
             await sess.exec(
                 select(Message)
@@ -197,20 +224,30 @@ just_prepare = just_prepare_quote_data_decorator(cfgloader.config.banned_sticker
     Recorder.get_context_messages
 )
 
-do_quote = to_thread_deco(quote_factory.quote_sync)
 b2b64url_async = to_thread_deco(bytes_to_b64_url)
 
 
-async def gather_resources_from_recorder(resources: set[str | URL]):
+async def _read_into_bytesio(path: str):
+    async with aiofiles.open(path, "rb") as fp:
+        return BytesIO(await fp.read())
+
+
+async def gather_resources_from_recorder(
+    resources: set[str | URL], min_width: int | None = None
+):
+    fileids = {r: Recorder.url_to_fileid(URL(r)) for r in resources}
+    filepaths = await Recorder.get_filepaths(fileids.values(), min_width=min_width)
     paths = {
-        r: await Recorder.get_filepath(Recorder.url_to_fileid(URL(r)))
-        for r in resources
+        url: path
+        for url, fileid in fileids.items()
+        if (path := filepaths.get(fileid)) and os.path.isfile(path)
     }
-    result: dict[str | URL, BytesIO] = {}
-    for url, path in paths.items():
-        if path and os.path.isfile(path):
-            async with aiofiles.open(path, "rb") as fp:
-                result[url] = BytesIO(await fp.read())
+    result: dict[str | URL, BytesIO] = dict(
+        zip(
+            paths.keys(),
+            await asyncio.gather(*[_read_into_bytesio(p) for p in paths.values()]),
+        )
+    )
     notfounds = resources - set(result.keys())
     return result, notfounds
 
@@ -292,7 +329,8 @@ async def quote(
     logger.debug(
         f"Preparing quote of {target}, [{left}, {right}], sender_only={sender_only}, {scale}x, a{ascale}x"
     )
-    data, required_resources = await Recorder.database.run_sync(
+    database = await Recorder.shards.route_read(event.group_id)
+    data, required_resources = await database.run_sync(
         just_prepare,
         base_msgid=target.msg_id,
         group_id=event.group_id,
@@ -309,33 +347,55 @@ async def quote(
         # TODO: 增加更多参数选项
         start_draw_time = time.perf_counter()
         logger.debug(f"Got QuoteData: {data!r}")
-        resources, notfounds = await gather_resources_from_recorder(required_resources)
+        resources: dict[str | URL, BytesIO | Image.Image] = dict(
+            await sticker_cache.get_frames(
+                collect_stickers(data, cfgloader.config.banned_stickersets)
+            )
+        )
+        # 头像按绘制尺寸取得裁剪好的圆形, 重复出现的头像不再解码和裁剪
+        resources.update(
+            await gather_avatars(
+                data, int(default_drawing_params["avatar_size"] * (scale * ascale))
+            )
+        )
+        # 宽度不小于气泡宽度的缩小变体在排版上与原图等价
+        local, notfounds = await gather_resources_from_recorder(
+            required_resources - resources.keys(),
+            min_width=int(
+                default_drawing_params["wrap_width"] * max(1.0, scale * ascale)
+            ),
+        )
+        resources.update(local)
         logger.debug(f"Got {len(resources)} resources from local")
         resources.update(await gather_resources(notfounds))
         logger.debug(
             f"Got {len(resources)}/{len(required_resources)} resources in total"
         )
-        result = await do_quote(
+        await quote_factory.prefetch_emojis(data)
+        result = await render_executor.run(
+            render_quote,
             data,
             resources,
             scale=scale,
             scale_for_antialias=ascale,
+            policy=cfgloader.config.encoding,
         )
 
-        imagebytes = result.getvalue()
+        imagebytes = result.data
         now_time = time.perf_counter()
         await adapter.send(
             [
                 ImageSegment(file=await b2b64url_async(imagebytes)),
                 TextSegment(
                     f"db: {query_time:.3f}s; draw: {now_time - start_draw_time:.3f}s"
+                    f"; {result}"
                 ),
             ]
         )
         if path := cfgloader.config.saveto:
             file = os.path.join(
                 path,
-                f"{time.strftime('%Y%m%d%H%M%S', time.localtime())}_{event.group_id}_{target.msg_id}[{left}-{right}]_{get_id()}.png",
+                f"{time.strftime('%Y%m%d%H%M%S', time.localtime())}_{event.group_id}_{target.msg_id}[{left}-{right}]_{get_id()}{result.extension}",
             )
             async with aiofiles.open(file, "wb+") as fp:
                 await fp.write(imagebytes)
@@ -18,7 +18,12 @@ from yarl import URL
 from lemony_utils.asyncutils import gather_with_concurrency
 from lemony_utils.botutils import cached_avatar_source
 from lemony_utils.consts import http_headers
-from lemony_utils.images import FontCache, _ColorT
+from lemony_utils.encoding import EncodePolicy, encode_image
+from lemony_utils.emoji import CachedEmojiSource
+from lemony_utils.emoji_atlas import AtlasEmojiSource
+from lemony_utils.images import FontCache, _ColorT, get_font_cache, preload_fonts
+from lemony_utils.render import warm_object
+from lemony_utils.stickers import StickerKey, sticker_key
 from lemony_utils.templates import async_http
 from recorder_models import Message
 
@@ -43,6 +48,8 @@ class SupportDot:
 
 
 _FontSource = str | BytesIO
+# 商城表情直接以解码好的图片提供
+_Resource = BytesIO | Image.Image
 
 
 async def retrieve_into_bytesio(url: URL | str):
@@ -112,6 +119,23 @@ def prepare_quote(
     return data, resources
 
 
+def collect_stickers(data: QuoteData, banned_sticker_sets: Iterable[int] = ()):
+    """找出引用中可以由表情缓存提供的商城表情, 返回 {url: (键, url)}
+
+    `banned_sticker_sets` 应与 `prepare_quote` 的一致, 被屏蔽的表情不会被取出"""
+    banned = set(banned_sticker_sets)
+    stickers: dict[str, tuple[StickerKey, str | None]] = {}
+    for msg in data["messages"]:
+        for seg in msg["segments"]:
+            if seg.type != "mface" or not (url := seg.data.get("url")):
+                continue
+            if seg.data.get("emoji_package_id") in banned:
+                continue
+            if key := sticker_key(seg.data):
+                stickers[url] = (key, url)
+    return stickers
+
+
 async def gather_resources(urls: Iterable[URL | str], concurrency=4):
     return {
         k: v
@@ -127,15 +151,32 @@ async def gather_resources(urls: Iterable[URL | str], concurrency=4):
     }
 
 
+async def gather_avatars(data: QuoteData, size: int, concurrency=4):
+    """取得各发送者 `size` 见方的圆形头像, 以头像 url 为键; 取得失败的不在结果中"""
+    uids = list(dict.fromkeys(msg["sender_id"] for msg in data["messages"]))
+    return {
+        cached_avatar_source.get_url(uid): v
+        for uid, v in zip(
+            uids,
+            await gather_with_concurrency(
+                *[cached_avatar_source.get_circle(uid, size) for uid in uids],
+                concurrency=concurrency,
+                return_exceptions=True,
+            ),
+        )
+        if not isinstance(v, Exception)
+    }
+
+
 class QuoteDrawer:
     def __init__(
         self,
         data: QuoteData,
-        resources: dict[URL | str, BytesIO],
+        resources: dict[URL | str, _Resource],
         font: FontCache,
         quote_params: QuoteParams | None = None,
         drawing_params: DrawingParams | None = None,
-        placeholder_img: Path | str | BytesIO = "data/no_data.png",
+        placeholder_img: Path | str | BytesIO | Image.Image = "data/no_data.png",
         scale: float = 1.0,
     ):
         self._data = data
@@ -146,7 +187,12 @@ class QuoteDrawer:
             default_drawing_params if drawing_params is None else drawing_params
         )
         self._scale = scale
-        self._img_missing_img = Image.open(placeholder_img).convert("RGBA")
+        self._avatars: dict[int, Avatar] = {}
+        self._img_missing_img = (
+            placeholder_img
+            if isinstance(placeholder_img, Image.Image)
+            else Image.open(placeholder_img).convert("RGBA")
+        )
 
         self._widgets: list[list[tuple[tuple[int, int], Avatar | Bubble]]] = []
         # 一个 widget 列表对应一个 msg
@@ -200,17 +246,29 @@ class QuoteDrawer:
             + max(max_bubble_width, max_userinfo_width)
         )
 
-    def _msg_to_widgets(self, msg: _QuoteMsg):
-        avatar_img = self._resources.get(cached_avatar_source.get_url(msg["sender_id"]))
+    def _get_avatar(self, sender_id: int):
+        """每个发送者的头像只解码和裁剪一次"""
+        if (avatar := self._avatars.get(sender_id)) is not None:
+            return avatar
+        avatar_img = self._resources.get(cached_avatar_source.get_url(sender_id))
+        if isinstance(avatar_img, Image.Image):
+            # `gather_avatars` 取得的头像已裁剪为圆形
+            image, circled = avatar_img, True
+        elif avatar_img:
+            image, circled = Image.open(avatar_img).convert("RGBA"), False
+        else:
+            image, circled = self._img_missing_img, False
         avatar = Avatar(
-            (
-                Image.open(avatar_img).convert("RGBA")
-                if avatar_img
-                else self._img_missing_img
-            ),
+            image,
             width=self._dparams["avatar_size"],
             scale=self._scale,
+            circled=circled,
         )
+        self._avatars[sender_id] = avatar
+        return avatar
+
+    def _msg_to_widgets(self, msg: _QuoteMsg):
+        avatar = self._get_avatar(msg["sender_id"])
         bubble = Bubble(
             self._segs_to_bublems(msg["segments"]),
             font=self._font,
@@ -234,11 +292,14 @@ class QuoteDrawer:
                     continue
                 bio = self._resources.get(url)
                 try:
-                    img = (
-                        Image.open(bio).convert("RGBA")
-                        if bio
-                        else self._img_missing_img
-                    )
+                    if isinstance(bio, Image.Image):
+                        img = bio
+                    else:
+                        img = (
+                            Image.open(bio).convert("RGBA")
+                            if bio
+                            else self._img_missing_img
+                        )
                 except UnidentifiedImageError:
                     img = self._img_missing_img
                 elements.append(img)
@@ -340,12 +401,27 @@ class QuoteFactory:
     ):
         self._font_cache = font
         self._emoji_source = emoji_source
-        self._phimg = placeholder_img
+        # 占位图只读入一次
+        self._phimg = Image.open(placeholder_img).convert("RGBA")
+
+    async def prefetch_emojis(self, data: QuoteData):
+        """绘制前取得引用中所有文本里的 emoji, 绘制时不再访问网络"""
+        if (prefetch := getattr(self._emoji_source, "prefetch", None)) is None:
+            return
+        texts = [data["group_name"] or ""]
+        for msg in data["messages"]:
+            texts.append(msg["sender_name"] or "")
+            texts.extend(
+                seg.data["text"]
+                for seg in msg["segments"]
+                if isinstance(seg, TextSegment)
+            )
+        await prefetch(texts)
 
     def draw(
         self,
         data: QuoteData,
-        resources: dict[URL | str, BytesIO],
+        resources: dict[URL | str, _Resource],
         drawing_params: DrawingParams | None = None,
         quote_params: QuoteParams | None = None,
         scale: float = 1.0,
@@ -374,13 +450,47 @@ class QuoteFactory:
     def quote_sync(
         self,
         data: QuoteData,
-        resources: dict[URL | str, BytesIO],
+        resources: dict[URL | str, _Resource],
         scale: float = 1.0,
         scale_for_antialias: float = 1.0,
+        policy: EncodePolicy | None = None,
     ):
         result = self.draw(
             data, resources, scale=scale, antialias_scale=scale_for_antialias
         )
-        bio = BytesIO()
-        result.save(bio, "png")
-        return bio
+        return encode_image(result, policy)
+
+
+def make_emoji_source(cdn: str | None = None, atlas: str | None = None):
+    source = CachedEmojiSource(cdn) if cdn else None
+    if atlas:
+        # 图集中没有的 emoji 仍从 CDN 取得
+        return AtlasEmojiSource(atlas, fallback=source)
+    return source
+
+
+def make_quote_factory(
+    font: str,
+    placeholder_img: str,
+    emoji_cdn: str | None = None,
+    emoji_atlas: str | None = None,
+):
+    """构造 QuoteFactory 并载入默认字号, 也用作渲染进程的预热"""
+    preload_fonts(font, default_drawing_params["font_size"].values())
+    return QuoteFactory(
+        font=get_font_cache(font),
+        emoji_source=make_emoji_source(emoji_cdn, emoji_atlas),
+        placeholder_img=placeholder_img,
+    )
+
+
+def render_quote(
+    data: QuoteData,
+    resources: dict[URL | str, _Resource],
+    scale: float = 1.0,
+    scale_for_antialias: float = 1.0,
+    policy: EncodePolicy | None = None,
+):
+    """渲染进程中执行的任务, 使用预热好的 QuoteFactory"""
+    factory: QuoteFactory = warm_object("momoquote")
+    return factory.quote_sync(data, resources, scale, scale_for_antialias, policy)
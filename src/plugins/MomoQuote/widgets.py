@@ -25,8 +25,11 @@ class Avatar:
         image: Image.Image,
         width: int = 90,
         scale: float = 1.0,
+        circled: bool = False,
     ):
-        self._image = crop_to_circle(image)
+        """`circled` 为真时 `image` 已是裁剪好的圆形头像, 尺寸合适时直接使用"""
+        n = int(width * scale)
+        self._image = image if circled else crop_to_circle(image, n)
         self._width = width
         self._scale = scale
 
@@ -44,8 +47,11 @@ class Avatar:
         n = int(self._width * s)
         x, y = map(lambda _n: int(_n * s), coor)
 
+        avatar = self._image
+        if avatar.size != (n, n):
+            avatar = ImageOps.fit(avatar, (n, n))
         img = Image.new("RGBA", (n, n), color=bg_color)
-        img.alpha_composite(ImageOps.fit(self._image, (n, n)))
+        img.alpha_composite(avatar)
         canvas.paste(img, (x, y))
 
         if show_border:
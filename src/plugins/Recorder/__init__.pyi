@@ -1,11 +1,23 @@
 # This file is @generated by melobot cli.
 # It is not intended for manual editing.
 from .__plugin__ import dbcore_share as _database
+from .__plugin__ import shards_share as _shards
+from .__plugin__ import jobs_share as _jobs
 from .__plugin__ import url_to_fileid
 from .__plugin__ import get_filepath
+from .__plugin__ import get_filepaths
+from .__plugin__ import find_similar_images
+from .__plugin__ import analyze_user_counts
+from .__plugin__ import analyze_top_senders
+from .__plugin__ import analyze_hourly_counts
+from .__plugin__ import analyze_segment_types
+from .__plugin__ import export_analytics
 from .utils import get_context_messages
+from .utils import get_recent_messages
 from .utils import query_group_msg_count
 
 database = _database.get()
+shards = _shards.get()
+jobs = _jobs.get()
 
-__all__ = ('database', 'url_to_fileid', 'get_filepath', 'get_context_messages', 'query_group_msg_count')
+__all__ = ('database', 'shards', 'jobs', 'url_to_fileid', 'get_filepath', 'get_filepaths', 'find_similar_images', 'analyze_user_counts', 'analyze_top_senders', 'analyze_hourly_counts', 'analyze_segment_types', 'export_analytics', 'get_context_messages', 'get_recent_messages', 'query_group_msg_count')
@@ -1,11 +1,16 @@
 import asyncio
+import dataclasses
 import functools
 import hashlib
 import mimetypes
+import multiprocessing
 import os
 import posixpath
 import sys
 import time
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from pathlib import Path
 
 import aiofiles
@@ -13,65 +18,279 @@ from melobot import get_bot
 from melobot.log import get_logger
 from melobot.plugin import PluginPlanner, SyncShare
 from melobot.protocols.onebot.v11.adapter import Adapter
-from melobot.protocols.onebot.v11.adapter.event import (
-    GroupMessageEvent,
-    MessageEvent,
-    PrivateMessageEvent,
-)
-from melobot.protocols.onebot.v11.adapter.segment import ImageSegment, RecordSegment
+from melobot.protocols.onebot.v11.adapter.event import MessageEvent
 from melobot.protocols.onebot.v11.handle import on_message
 from melobot.utils import lock
-from sqlmodel import col, func, or_, select
-from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import bindparam
+from sqlmodel import Session, col, or_, select
 from yarl import URL
 
+from configloader import ConfigLoader, ConfigLoaderMetadata
+from extended_actions.lagrange import GetGroupFileUrlAction
 from lemony_utils.consts import http_headers
-from lemony_utils.database import AsyncDbCore
+from lemony_utils.database import AsyncDbCore, ShardRouter
+from lemony_utils.jobqueue import JOB_TABLE, PENDING, Job, JobQueue
+from lemony_utils.stickers import sticker_cache
 from lemony_utils.templates import async_http
-from recorder_models import TABLES, Group, MediaFile, Message, MessageSegment, User
+from recorder_models import TABLES, ArchivedFile, Group, MediaFile, MediaHash, User
+
+from .analytics import AnalyticsMirror, fetch_new_rows
+from .archive import (
+    ArchiveRejected,
+    TokenBucket,
+    download_resumable,
+    file_digest,
+    guess_extension,
+)
 
-from .utils import get_context_messages, query_group_msg_count
+from .coldstore import (
+    compress_cold_segments,
+    load_dictionaries,
+    restore_text_segments,
+    sample_segments,
+    save_dictionary,
+    train_dictionary,
+)
+from .hotcache import hot_cache
+from .ingest import (
+    IngestRows,
+    build_rows,
+    url_to_fileid,
+    write_messages,
+    write_refs,
+    write_rows,
+)
+from .mediaindex import media_index
+from .params import RecorderConfig
+from .phash import dhash_bytes, image_size, phash_index, same_shape
+from .policy import PolicyMatcher, mimetype_allowed
+from .sharding import SHARDED_TABLES, migrate_to_shards
+from .thumbnails import ensure_thumbnails, pick_variant
+from .transcode import COMPACT_EXTENSION, transcode_to_webp
+from .utils import (
+    get_context_messages,
+    get_recent_messages,
+    query_group_msg_count,
+    warm_hot_cache,
+)
 
 DB_URL = "sqlite+aiosqlite:///data/record/messages.db"
 IMAGE_LOCATION = Path("data/record/images")
 os.makedirs(IMAGE_LOCATION, exist_ok=True)
 VOICE_LOCATION = Path("data/record/voices")
 os.makedirs(VOICE_LOCATION, exist_ok=True)
+FILE_LOCATION = Path("data/record/files")
+PARTIAL_LOCATION = FILE_LOCATION / ".partial"
+os.makedirs(PARTIAL_LOCATION, exist_ok=True)
+SHARD_LOCATION = Path("data/record/shards")
+ANALYTICS_PATH = "data/record/analytics.duckdb"
 
 logger = get_logger()
-recorder = AsyncDbCore(DB_URL, TABLES, echo="--debug" in sys.argv)
+cfgloader = ConfigLoader(
+    ConfigLoaderMetadata(model=RecorderConfig, filename="recorder_conf.json")
+)
+cfgloader.load_config()
+hot_cache.capacity = cfgloader.config.hot_buffer_size
+media_index.lru_size = cfgloader.config.media_index_size
+media_index.bloom_capacity = cfgloader.config.media_bloom_capacity
+policies = PolicyMatcher(cfgloader.config)
+recorder = AsyncDbCore(DB_URL, [*TABLES, JOB_TABLE], echo="--debug" in sys.argv)
+# 启用分片时群消息保存在各自的分片中, 按群查询只会访问一个分片
+shards = ShardRouter(
+    recorder,
+    SHARD_LOCATION,
+    SHARDED_TABLES,
+    mode=cfgloader.config.shard_mode,
+    buckets=cfgloader.config.shard_buckets,
+    echo="--debug" in sys.argv,
+)
+# 本次运行中已写入主库的用户和群组, 分片模式下不再为它们占用主库的写锁
+_written_users: set[int] = set()
+_written_groups: set[int] = set()
+# 下载媒体文件、补全群名之类的后续工作放到这里, 重启后未完成的任务会继续执行
+jobs = JobQueue(recorder)
+MEDIA_JOB = "recorder.media"
+GROUP_NAME_JOB = "recorder.group_name"
+STICKER_JOB = "recorder.sticker"
+ARCHIVE_JOB = "recorder.archive"
+archive_limiter = TokenBucket(cfgloader.config.archive_bandwidth)
+# 统计查询在这个列式副本上执行, 不会扫描 messages.db
+analytics = AnalyticsMirror(ANALYTICS_PATH)
+_analytics_lock = asyncio.Lock()
+# 当前用于压缩较早消息段的 zstd 字典 id
+_segment_dict: int | None = None
+# 训练字典至少需要的样本数
+MIN_DICT_SAMPLES = 1000
 
 
 def do_md5(d: bytes):
     return hashlib.md5(d).hexdigest()
 
 
-def url_to_fileid(url: URL):
-    if url.host == "multimedia.nt.qq.com.cn":
-        return url.query["fileid"]
-    elif url.host.endswith("qpic.cn"):
-        return max(url.parts, key=len)
-    # logger.warning(f"url {url} is not known url pattern")
-    return str(url)
+_query_filepath = recorder.prepare(
+    select(MediaFile.path).where(MediaFile.fileid == bindparam("fileid")),
+    "one_or_none",
+)
+_query_filepaths = recorder.prepare(
+    select(MediaFile.fileid, MediaFile.path).where(
+        col(MediaFile.fileid).in_(bindparam("fileids", expanding=True))
+    ),
+    "all",
+)
 
 
-async def get_filepath(fileid: str):
-    async with recorder.get_session() as sess:
-        file = (
-            await sess.exec(select(MediaFile).where(MediaFile.fileid == fileid))
-        ).one_or_none()
-        if file:
-            return file.path
-        else:
-            return None
+_query_path_by_hash = recorder.prepare(
+    select(MediaFile.path)
+    .where(MediaFile.hash == bindparam("hash"), col(MediaFile.path).is_not(None))
+    .limit(1),
+    "first",
+)
+
+
+def _with_variant(path: str | None, min_width: int | None):
+    if path is None or min_width is None:
+        return path
+    return pick_variant(path, min_width, cfgloader.config.thumbnail_widths)
+
+
+async def get_filepath(fileid: str, min_width: int | None = None) -> str | None:
+    """指定 min_width 时, 若存在宽度不小于它的缩小变体则返回变体的路径"""
+    known, path = media_index.lookup(fileid)
+    if not known:
+        path = await _query_filepath(fileid=fileid)
+        media_index.put(fileid, path)
+    return _with_variant(path, min_width)
 
 
-async def _fetch_mediafile(url: str | URL, dest: Path):
+async def get_filepaths(
+    fileids: Iterable[str], min_width: int | None = None
+) -> dict[str, str | None]:
+    """批量版本的 `get_filepath`, 索引无法确定的部分只查询一次数据库"""
+    result: dict[str, str | None] = {}
+    unresolved: list[str] = []
+    for fileid in set(fileids):
+        known, path = media_index.lookup(fileid)
+        if known:
+            result[fileid] = path
+        else:
+            unresolved.append(fileid)
+    if unresolved:
+        found = dict(await _query_filepaths(fileids=unresolved))
+        for fileid in unresolved:
+            result[fileid] = found.get(fileid)
+            media_index.put(fileid, result[fileid])
+    if min_width is not None:
+        result = {k: _with_variant(v, min_width) for k, v in result.items()}
+    return result
+
+
+async def find_similar_images(
+    data: bytes, max_distance: int = 6
+) -> list[tuple[int, str]]:
+    """按感知哈希查找与给定图片相近的已存储图片, 返回按距离递增排序的 (距离, 路径)
+
+    可用于判断一张图片是否 "之前见过", 距离为 0 时基本可以认为是同一张图"""
+    if (h := await asyncio.to_thread(dhash_bytes, data)) is None:
+        return []
+    return [(d, p) for d, p in phash_index.find(h, max_distance) if os.path.isfile(p)]
+
+
+def _near_duplicate(data: bytes, h: int | None):
+    """在 dHash 相近的已存储文件中找到宽高比也一致的一个, 在线程中调用"""
+    if h is None or (distance := cfgloader.config.phash_dedupe_distance) < 0:
+        return None
+    if not (candidates := phash_index.find(h, distance)):
+        return None
+    if (size := image_size(data)) is None:
+        return None
+    for _, path in candidates:
+        if (
+            os.path.isfile(path)
+            and (other := image_size(path)) is not None
+            and same_shape(size, other)
+        ):
+            return path
+    return None
+
+
+def load_phash_index(session: Session):
+    rows = session.exec(select(MediaHash.path, MediaHash.dhash)).all()
+    phash_index.load((path, int(h, 16)) for path, h in rows)
+    return len(rows)
+
+
+async def backfill_phashes(batch: int = 100):
+    """为在感知哈希索引之前存储的文件补上哈希"""
+    async with recorder.get_session() as sess:
+        paths = (
+            await sess.exec(
+                select(MediaFile.path)
+                .distinct()
+                .where(
+                    col(MediaFile.path).is_not(None),
+                    col(MediaFile.path).not_in(select(MediaHash.path)),
+                )
+            )
+        ).all()
+    count = 0
+    for i in range(0, len(paths), batch):
+        rows: list[MediaHash] = []
+        for path in paths[i : i + batch]:
+            if path is None or not os.path.isfile(path):
+                continue
+            async with aiofiles.open(path, "rb") as fp:
+                data = await fp.read()
+            if (h := await asyncio.to_thread(dhash_bytes, data)) is None:
+                continue
+            rows.append(MediaHash(path=path, dhash=f"{h:016x}"))
+            phash_index.add(path, h)
+        if rows:
+            async with recorder.get_session() as sess:
+                sess.add_all(rows)
+                await sess.commit()
+            count += len(rows)
+    return count
+
+
+def load_media_index(session: Session):
+    fileids = session.exec(select(MediaFile.fileid)).all()
+    recent = session.exec(
+        select(MediaFile.fileid, MediaFile.path)
+        .where(col(MediaFile.path).is_not(None))
+        .order_by(col(MediaFile.timestamp).desc())
+        .limit(media_index.lru_size)
+    ).all()
+    # 越新的记录越晚放入, 在 LRU 中越不容易被淘汰
+    media_index.load(fileids, [(fileid, path) for fileid, path in reversed(recent)])
+    return len(fileids)
+
+
+class MediaRejected(Exception):
+    """媒体文件不符合录入策略的类型或大小限制"""
+
+
+async def _fetch_mediafile(
+    url: str | URL, dest: Path, types: str | None = None, max_size: int = 0
+):
     dest.mkdir(parents=True, exist_ok=True)
     async with async_http(url, "get", headers=http_headers) as resp:
         resp.raise_for_status()
-        data = await resp.read()
-        extension = mimetypes.guess_extension(resp.headers["Content-Type"])
+        mimetype = resp.headers["Content-Type"]
+        if not mimetype_allowed(types, mimetype):
+            raise MediaRejected(f"type {mimetype!r} is not allowed")
+        if max_size <= 0:
+            data = await resp.read()
+        elif (resp.content_length or 0) > max_size:
+            raise MediaRejected(f"size {resp.content_length} exceeds {max_size}")
+        else:
+            # 没有 Content-Length 时边读边检查, 超出上限立即中止
+            buf = bytearray()
+            async for chunk in resp.content.iter_chunked(65536):
+                buf += chunk
+                if len(buf) > max_size:
+                    raise MediaRejected(f"size exceeds {max_size}")
+            data = bytes(buf)
+        extension = mimetypes.guess_extension(mimetype)
     filename = (md5 := await asyncio.to_thread(do_md5, data)) + (
         extension if extension else ""
     )
@@ -80,7 +299,9 @@ async def _fetch_mediafile(url: str | URL, dest: Path):
 
 
 @lock()
-async def _store_mediafile(data: bytes, fileid: str, hash_str: str, path: str):
+async def _store_mediafile(
+    data: bytes, fileid: str, hash_str: str, path: str, dhash: int | None = None
+):
     do_write = True
     logger.debug(f"MediaFile(fileid={fileid!r}) download ok, now saving...")
     async with recorder.get_session() as sess:
@@ -109,6 +330,11 @@ async def _store_mediafile(data: bytes, fileid: str, hash_str: str, path: str):
             logger.debug(
                 f"Former MediaFile record found as {path!r}, dont save new one"
             )
+        elif similar := await asyncio.to_thread(_near_duplicate, data, dhash):
+            path = similar
+            do_write = False
+            logger.debug(f"Near-duplicate media file found as {path!r}, reuse it")
+        refreshed = [i.fileid for i in missing_images]
         if missing_images:
             for i in missing_images:
                 i.path = path
@@ -122,82 +348,369 @@ async def _store_mediafile(data: bytes, fileid: str, hash_str: str, path: str):
         img.hash = hash_str
         img.path = path
         sess.add(img)
+        if do_write and dhash is not None and path not in phash_index:
+            await sess.merge(MediaHash(path=path, dhash=f"{dhash:016x}"))
         await sess.commit()
     if do_write:
         async with aiofiles.open(path, "wb+") as fp:
             await fp.write(data)
         logger.debug(f"MediaFile(fileid={fileid!r}) saved as {path!r}")
+    for i in refreshed:
+        media_index.put(i, path)
+    media_index.put(fileid, path)
+    if do_write and dhash is not None:
+        phash_index.add(path, dhash)
+    return path
+
+
+_transcode_pool: ProcessPoolExecutor | None = None
+
+
+async def _transcode(data: bytes, path: str):
+    """按配置把图片转码为 WebP, 返回 (数据, 路径); 不转码时原样返回"""
+    global _transcode_pool
+    if (mode := cfgloader.config.transcode) == "off":
+        return data, path
+    if _transcode_pool is None:
+        # 不从多线程的主进程 fork, transcode 模块没有导入副作用, 在新进程中导入即可
+        _transcode_pool = ProcessPoolExecutor(
+            cfgloader.config.transcode_processes,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+    try:
+        compact = await asyncio.get_running_loop().run_in_executor(
+            _transcode_pool,
+            transcode_to_webp,
+            data,
+            mode == "lossless",
+            cfgloader.config.transcode_quality,
+        )
+    except Exception as e:
+        logger.warning(f"Exception while transcoding {path!r}: {e}")
+        return data, path
+    if compact is None:
+        return data, path
+    logger.debug(f"Transcoded {path!r}: {len(data)} -> {len(compact)} bytes")
+    return compact, os.path.splitext(path)[0] + COMPACT_EXTENSION
 
 
-async def handle_mediafile(url: str | URL):
+async def handle_mediafile(url: str | URL, types: str | None = None, max_size: int = 0):
     url = URL(url)  # .with_scheme("http")
     dest = IMAGE_LOCATION / time.strftime("%Y-%m", time.localtime())
     # TODO: 处理语音文件
     fileid = url_to_fileid(url)
+    # 下载失败时抛出异常, 由任务队列负责重试
     try:
-        data, md5, path = await _fetch_mediafile(url, dest)
+        data, md5, path = await _fetch_mediafile(url, dest, types, max_size)
+    except MediaRejected as e:
+        logger.debug(f"MediaFile(fileid={fileid!r}) rejected by policy: {e}")
+        await _drop_placeholder(fileid)
+        return
+    dhash = await asyncio.to_thread(dhash_bytes, data)
+    # md5 始终取自原始数据, 以便之后下载到同一张图时仍能去重;
+    # 已经存过的图片不会再被写入, 也就不必转码
+    former = await _query_path_by_hash(hash=md5)
+    if not (former and os.path.isfile(former)):
+        data, path = await _transcode(data, path)
+    path = await _store_mediafile(
+        data, fileid=fileid, hash_str=md5, path=path, dhash=dhash
+    )
+    await make_thumbnails(path)
+
+
+async def _media_job(payload: dict):
+    await handle_mediafile(
+        payload["url"], payload.get("types"), payload.get("max_size", 0)
+    )
+
+
+async def _media_giveup(payload: dict):
+    """多次下载失败后删除占位的记录"""
+    await _drop_placeholder(payload["fileid"])
+
+
+async def _drop_placeholder(fileid: str):
+    async with recorder.get_session() as sess:
+        img = await sess.get(MediaFile, fileid)
+        if img is not None and (img.path is None or img.hash is None):
+            await sess.delete(img)
+            await sess.commit()
+            media_index.discard(fileid)
+
+
+async def make_thumbnails(path: str):
+    if not (widths := cfgloader.config.thumbnail_widths):
+        return
+    try:
+        created = await asyncio.to_thread(
+            ensure_thumbnails, path, widths, cfgloader.config.thumbnail_quality
+        )
     except Exception as e:
-        logger.warning(f"Exception while fetching img: {e}")
+        logger.warning(f"Exception while making thumbnails of {path!r}: {e}")
     else:
-        await _store_mediafile(data, fileid=fileid, hash_str=md5, path=path)
+        if created:
+            logger.debug(f"Made {len(created)} thumbnails for {path!r}")
 
 
-async def ensure_user(session: AsyncSession, uid: int, name: str | None = None):
-    user = (await session.exec(select(User).where(User.id == uid))).one_or_none()
-    if user is None:
-        user = User(id=uid, name=name)
-        session.add(user)
-    return user
+async def _sticker_job(payload: dict):
+    key = (payload["package_id"], payload["emoji_id"])
+    if await sticker_cache.prefetch(key, payload.get("url")):
+        logger.debug(f"Sticker {key} cached")
 
 
-async def ensure_group(session: AsyncSession, gid: int, name: str | None = None):
-    group = (await session.exec(select(Group).where(Group.id == gid))).one_or_none()
-    if group is None:
-        group = Group(id=gid, name=name)
-        session.add(group)
-    return group
+def _partial_path(fileid: str):
+    return PARTIAL_LOCATION / f"{hashlib.sha1(fileid.encode()).hexdigest()}.part"
 
 
-async def ensure_mediafile(session: AsyncSession, fileid: str):
-    img = (
-        await session.exec(select(MediaFile).where(MediaFile.fileid == fileid))
-    ).one_or_none()
-    if img is None:
-        img = MediaFile(fileid=fileid)
-        session.add(img)
+async def _resolve_file_url(payload: dict):
+    """文件消息段通常不带 url, 需要通过群文件接口获取"""
+    if payload.get("group_id") is None or not payload.get("file_id"):
+        raise RuntimeError(f"No way to get url of file {payload['fileid']!r}")
+    if (adapter := bot.get_adapter(Adapter)) is None:
+        raise RuntimeError("OneBot v11 adapter is not available")
+    echo = await (
+        await adapter.call_output(
+            GetGroupFileUrlAction(
+                group_id=payload["group_id"],
+                file_id=payload["file_id"],
+                busid=payload.get("busid") or 102,
+            )
+        )
+    )[0]
+    if echo is None or not echo.data or not (url := echo.data.get("url")):
+        raise RuntimeError(f"Failed to get url of file {payload['fileid']!r}")
+    return str(url)
 
 
-async def fix_group_name(adapter: Adapter):
+async def handle_archive(payload: dict):
+    fileid: str = payload["fileid"]
+    url = payload.get("url") or await _resolve_file_url(payload)
+    part = _partial_path(fileid)
+    try:
+        content_type, size = await download_resumable(
+            url, part, max_size=payload.get("max_size", 0), limiter=archive_limiter
+        )
+    except ArchiveRejected as e:
+        logger.debug(f"ArchivedFile(fileid={fileid!r}) rejected by policy: {e}")
+        await _drop_archive(payload)
+        return
+    sha256 = await asyncio.to_thread(file_digest, part)
+    extension = guess_extension(payload.get("name"), content_type)
+    if not extension and payload["kind"] == "video":
+        extension = ".mp4"
+    dest = FILE_LOCATION / time.strftime("%Y-%m", time.localtime())
+    dest.mkdir(parents=True, exist_ok=True)
+    path = (dest / f"{sha256}{extension}").as_posix()
     async with recorder.get_session() as sess:
-        groups = (await sess.exec(select(Group).where(col(Group.name).is_(None)))).all()
-        if not groups:
-            return
-        handles = await asyncio.gather(
-            *[adapter.get_group_info(group_id=g.id) for g in groups]
+        record = await sess.get(ArchivedFile, fileid) or ArchivedFile(
+            fileid=fileid, kind=payload["kind"], name=payload.get("name")
         )
-        count = 0
-        for echo, group in zip(await asyncio.gather(*[h[0] for h in handles]), groups):
-            if echo is None or echo.data is None:
-                continue
-            if echo.data["group_id"] == group.id:
-                group.name = echo.data["group_name"]
-                count += 1
-        sess.add_all(groups)
+        former = (
+            await sess.exec(
+                select(ArchivedFile.path).where(
+                    ArchivedFile.sha256 == sha256, col(ArchivedFile.path).is_not(None)
+                )
+            )
+        ).first()
+        if former and os.path.isfile(former):
+            path = former
+            part.unlink(missing_ok=True)
+        else:
+            os.replace(part, path)
+        record.size, record.sha256, record.path = size, sha256, path
+        sess.add(record)
         await sess.commit()
-        logger.debug(f"fixed names of {count} groups")
+    logger.debug(f"ArchivedFile(fileid={fileid!r}) saved as {path!r}, {size} bytes")
+
+
+async def _drop_archive(payload: dict):
+    _partial_path(payload["fileid"]).unlink(missing_ok=True)
+    async with recorder.get_session() as sess:
+        record = await sess.get(ArchivedFile, payload["fileid"])
+        if record is not None and record.path is None:
+            await sess.delete(record)
+            await sess.commit()
+
+
+# 已确认在数据库中有名字的群, 它们的消息不再需要补全群名
+_named_groups: set[int] = set()
+
+
+async def fix_group_name(adapter: Adapter, group_id: int):
+    async with recorder.get_session() as sess:
+        group = await sess.get(Group, group_id)
+        if group is not None and group.name is None:
+            echo = await (await adapter.get_group_info(group_id=group_id))[0]
+            if echo is None or echo.data is None:
+                raise RuntimeError(f"Failed to get info of group {group_id}")
+            group.name = echo.data["group_name"]
+            sess.add(group)
+            await sess.commit()
+            hot_cache.set_group_name(group_id, group.name)
+            logger.debug(f"fixed name of group {group_id}")
+    _named_groups.add(group_id)
+
+
+async def _group_name_job(payload: dict):
+    if (adapter := bot.get_adapter(Adapter)) is None:
+        raise RuntimeError("OneBot v11 adapter is not available")
+    await fix_group_name(adapter, payload["group_id"])
+
+
+async def sync_analytics():
+    """把水位线之后的新消息追加到分析副本, 返回追加的条数"""
+    batch = cfgloader.config.analytics_batch_size
+    total = 0
+    async with _analytics_lock:
+        while True:
+            wm_time, wm_id = await asyncio.to_thread(analytics.watermark)
+            results = await shards.fan_out(fetch_new_rows, wm_time, wm_id, batch)
+            # 各库都返回了水位线之后的前 batch 条, 合并后的前 batch 条即为全局的下一批
+            messages = sorted(
+                (m for msgs, _ in results for m in msgs),
+                key=lambda m: (m.store_time, m.store_id),
+            )[:batch]
+            kept = {m.store_id for m in messages}
+            segments = [s for _, segs in results for s in segs if s[0] in kept]
+            total += await asyncio.to_thread(analytics.append, messages, segments)
+            if len(messages) < batch:
+                return total
+
+
+async def analyze_user_counts(
+    group_id: int | None, start: datetime, end: datetime, fresh: bool = True
+) -> dict[int, int]:
+    """时间段内各用户的消息数, group_id 为 None 时统计所有会话
+
+    `fresh` 为真时先同步一次分析副本, 但仍会缺少最近 `SETTLE_DELAY` 秒内的消息;
+    否则可能缺少最近一个同步周期内的消息"""
+    if fresh:
+        await sync_analytics()
+    return await asyncio.to_thread(analytics.user_counts, group_id, start, end)
+
+
+async def analyze_top_senders(
+    group_id: int | None,
+    start: datetime,
+    end: datetime,
+    limit: int = 10,
+    fresh: bool = True,
+) -> list[tuple[int, int]]:
+    if fresh:
+        await sync_analytics()
+    return await asyncio.to_thread(
+        analytics.top_senders, group_id, start, end, limit
+    )
+
+
+async def analyze_hourly_counts(
+    group_id: int | None,
+    start: datetime,
+    end: datetime,
+    sender_id: int | None = None,
+    fresh: bool = True,
+) -> dict[float, int]:
+    if fresh:
+        await sync_analytics()
+    return await asyncio.to_thread(
+        analytics.hourly_counts, group_id, start, end, sender_id
+    )
+
+
+async def analyze_segment_types(
+    group_id: int | None,
+    start: datetime,
+    end: datetime,
+    sender_id: int | None = None,
+    fresh: bool = True,
+) -> dict[str, int]:
+    if fresh:
+        await sync_analytics()
+    return await asyncio.to_thread(
+        analytics.segment_type_breakdown, group_id, start, end, sender_id
+    )
+
+
+async def export_analytics(directory: str = "data/record/parquet"):
+    """同步后把分析副本导出为 Parquet 文件"""
+    await sync_analytics()
+    os.makedirs(directory, exist_ok=True)
+    await asyncio.to_thread(analytics.export_parquet, directory)
+
+
+async def compress_cold_history():
+    """压缩所有库中早于设定时间的消息段, 没有字典时先训练一个
+
+    返回 (处理的条数, 节省的字节数)"""
+    global _segment_dict
+    cfg = cfgloader.config
+    if _segment_dict is None:
+        results = await shards.fan_out(sample_segments, cfg.cold_sample_count)
+        samples = [s for batch in results for s in batch]
+        if len(samples) < MIN_DICT_SAMPLES:
+            return 0, 0
+        data = await asyncio.to_thread(train_dictionary, samples, cfg.cold_dict_size)
+        _segment_dict = await recorder.run_sync(save_dictionary, data)
+        logger.info(
+            f"Trained segment dictionary {_segment_dict} from {len(samples)} samples"
+        )
+    before = time.time() - cfg.cold_segment_days * 24 * 60 * 60
+    total = saved = 0
+    for core in shards.cores:
+        after = None
+        while True:
+            after, count, size = await core.run_sync(
+                compress_cold_segments,
+                before,
+                _segment_dict,
+                level=cfg.cold_compress_level,
+                after=after,
+            )
+            if not count:
+                break
+            total += count
+            saved += size
+    if saved:
+        for core in shards.cores:
+            if not await core.reclaim_space(cfg.cold_vacuum_convert):
+                logger.info(
+                    "auto_vacuum is not INCREMENTAL, freed pages stay in the file"
+                    " until cold_vacuum_convert is enabled or VACUUM is run manually"
+                )
+                break
+    return total, saved
+
+
+async def restore_compressed_text():
+    """解压从前被压缩的文本消息段, 使它们重新可以在 SQL 中搜索"""
+    total = 0
+    for core in shards.cores:
+        while count := await core.run_sync(restore_text_segments):
+            total += count
+    return total
 
 
 dbcore_share = SyncShare("database", lambda: recorder, static=True)
+shards_share = SyncShare("shards", lambda: shards, static=True)
+jobs_share = SyncShare("jobs", lambda: jobs, static=True)
 
 RecorderPlugin = PluginPlanner(
     "0.1.0",
     funcs=[
         url_to_fileid,
         get_filepath,
+        get_filepaths,
+        find_similar_images,
+        analyze_user_counts,
+        analyze_top_senders,
+        analyze_hourly_counts,
+        analyze_segment_types,
+        export_analytics,
         get_context_messages,
+        get_recent_messages,
         query_group_msg_count,
     ],
-    shares=[dbcore_share],
+    shares=[dbcore_share, shards_share, jobs_share],
 )
 bot = get_bot()
 
@@ -205,9 +718,100 @@ bot = get_bot()
 # TODO: 占用空间超过指定大小自动删除距上次使用时间最长的文件
 
 
+jobs.register(MEDIA_JOB, _media_job, on_giveup=_media_giveup)
+jobs.register(GROUP_NAME_JOB, _group_name_job, retry_delay=60)
+jobs.register(STICKER_JOB, _sticker_job)
+# 大文件下载可能持续很久, 中断后从已下载的位置继续
+jobs.register(
+    ARCHIVE_JOB,
+    handle_archive,
+    max_attempts=8,
+    lease=6 * 60 * 60,
+    retry_delay=60,
+    on_giveup=_drop_archive,
+)
+
+
 @bot.on_started
 async def _():
-    await recorder.startup()
+    await shards.startup()
+    # 读出任何消息段之前都要先登记压缩用的字典
+    global _segment_dict
+    _segment_dict = await recorder.run_sync(load_dictionaries)
+    if hot_cache.enabled:
+        count = sum(await shards.fan_out(warm_hot_cache, hot_cache.capacity))
+        hot_cache.mark_ready()
+        logger.info(f"Hot message cache warmed up with {count} msgs")
+    count = await recorder.run_sync(load_media_index)
+    logger.info(f"Media index loaded with {count} fileids")
+    count = await recorder.run_sync(load_phash_index)
+    logger.info(f"Perceptual hash index loaded with {count} files")
+
+
+@bot.on_loaded
+async def _():
+    await recorder.started.wait()
+    if count := await backfill_phashes():
+        logger.info(f"Computed perceptual hashes for {count} former media files")
+
+
+@bot.on_loaded
+async def _():
+    await recorder.started.wait()
+    await jobs.start(cfgloader.config.job_workers)
+    # 归档下载只由专门的 worker 执行, 不占用通用 worker
+    jobs.add_workers(max(1, cfgloader.config.archive_workers), types=[ARCHIVE_JOB])
+    if count := await jobs.pending_count():
+        logger.info(f"Resuming {count} pending background jobs")
+
+
+@bot.on_loaded
+async def _():
+    await recorder.started.wait()
+    if (interval := cfgloader.config.analytics_interval) <= 0:
+        return
+    while True:
+        try:
+            if count := await sync_analytics():
+                logger.debug(f"Appended {count} msgs to the analytics mirror")
+        except Exception:
+            logger.exception("Failed to sync the analytics mirror")
+        await asyncio.sleep(interval)
+
+
+@bot.on_loaded
+async def _():
+    await recorder.started.wait()
+    if count := await migrate_to_shards(shards):
+        logger.info(f"Moved {count} former group msgs into shards")
+
+
+@bot.on_loaded
+async def _():
+    await recorder.started.wait()
+    if _segment_dict is not None and (count := await restore_compressed_text()):
+        logger.info(f"Restored {count} compressed text segments")
+    if cfgloader.config.cold_segment_days <= 0:
+        return
+    while True:
+        try:
+            count, saved = await compress_cold_history()
+            if count:
+                logger.info(
+                    f"Compressed {count} cold segments, saved {saved / 1024:.1f} KiB"
+                )
+        except Exception:
+            logger.exception("Failed to compress cold segments")
+        await asyncio.sleep(cfgloader.config.cold_compress_interval)
+
+
+@bot.on_stopped
+async def _():
+    await jobs.stop()
+    await shards.shutdown()
+    await asyncio.to_thread(analytics.close)
+    if _transcode_pool is not None:
+        _transcode_pool.shutdown(cancel_futures=True)
 
 
 @bot.on_loaded
@@ -232,6 +836,7 @@ async def update_myself(adapter: Adapter):
 
 @bot.on_loaded
 async def delete_failed():
+    """删除没有对应下载任务的占位记录, 它们来自任务队列启用之前"""
     await recorder.started.wait()
     async with recorder.get_session() as sess:
         images = (
@@ -240,70 +845,105 @@ async def delete_failed():
                     or_(
                         col(MediaFile.hash).is_(None),
                         col(MediaFile.path).is_(None),
-                    )
+                    ),
+                    col(MediaFile.fileid).not_in(
+                        select(col(Job.payload)["fileid"].as_string()).where(
+                            Job.type == MEDIA_JOB, Job.status == PENDING
+                        )
+                    ),
                 )
             )
         ).all()
         if images:
             for i in images:
+                media_index.discard(i.fileid)
                 await sess.delete(i)
             await sess.commit()
             logger.debug(f"deleted {len(images)} failed images left from last launch")
 
 
+def _unwritten_refs(rows: IngestRows):
+    """去掉本次运行中已写入过的用户和群组, 没有需要写入主库的行时返回 None"""
+    refs = dataclasses.replace(
+        rows,
+        users=[u for u in rows.users if u["id"] not in _written_users],
+        groups=[g for g in rows.groups if g["id"] not in _written_groups],
+    )
+    if refs.users or refs.groups or refs.mediafiles or refs.archives:
+        return refs
+    return None
+
+
 @RecorderPlugin.use
 @on_message()
-async def do_record(event: MessageEvent, adapter: Adapter):
+async def do_record(event: MessageEvent):
     await recorder.started.wait()
-    async with recorder.get_session() as sess:
-        user = await ensure_user(sess, event.sender.user_id, event.sender.nickname)
-        params = {
-            "message_id": event.message_id,
-            "timestamp": event.time,
-            "sender": user,
-            "sender_id": event.sender.user_id,
-            "message_type": "group",
-        }
-        if isinstance(event, GroupMessageEvent):
-            params["group"] = await ensure_group(sess, event.group_id)
-            params["group_id"] = event.group_id
-        elif isinstance(event, PrivateMessageEvent):
-            params["receiver"] = await ensure_user(sess, event.self_id)
-            params["receiver_id"] = event.self_id
-            params["message_type"] = "private"
-        message = Message(**params)
-        sess.add(message)
-
-        urls_to_fetch: list[URL] = []
-        segments = []
-        objs_to_add = []
-        for i, seg in enumerate(event.message):
-            if isinstance(seg, ImageSegment):
-                url = URL(str(seg.data["url"]))
-                logger.error("#####seg.data"+ seg.data)
-                await ensure_mediafile(sess, url_to_fileid(url))
-                urls_to_fetch.append(url)
-            elif isinstance(seg, RecordSegment):
-                pass
-                # TODO: 处理语音消息段
-            data = seg.raw["data"]
-            dbseg = MessageSegment(
-                order=i,
-                type=seg.type,
-                data=data,
-                message_store_id=message.store_id,
-            )
-            segments.append(dbseg)
-            objs_to_add.append(dbseg)
-        objs_to_add.append(message)
-        sess.add_all(objs_to_add)
-        (await message.awaitable_attrs.segments).extend(segments)
-        await sess.commit()
-        count = (
-            await sess.exec(
-                select(func.count()).select_from(Message)  # pylint: disable=E1102
-            )
-        ).one()
-        logger.debug(f"Recorded new, now exists {count} msgs in db")
-    await asyncio.gather(*[handle_mediafile(u) for u in urls_to_fetch])
-    await fix_group_name(adapter)
+    # 在任何数据库操作之前按策略决定是否录入、录入哪些部分
+    policy = policies.match(event)
+    if not policy.sampled():
+        return
+    rows = build_rows(event, policy)
+    if not rows.segments:
+        return
+    limits = policy.media_limits()
+    pending = [
+        (
+            MEDIA_JOB,
+            {"url": str(url), "fileid": m["fileid"], **limits},
+            f"media:{m['fileid']}",
+        )
+        for url, m in zip(rows.media_urls, rows.mediafiles)
+    ]
+    # 商城表情按表情 id 缓存, 已缓存过的不再下载
+    pending.extend(
+        (
+            STICKER_JOB,
+            {"package_id": key[0], "emoji_id": key[1], "url": url},
+            f"sticker:{key[0]}:{key[1]}",
+        )
+        for key, url in rows.stickers
+        if not sticker_cache.has(key)
+    )
+    gid = rows.message["group_id"]
+    pending.extend(
+        (
+            ARCHIVE_JOB,
+            {
+                **source,
+                "fileid": a["fileid"],
+                "kind": a["kind"],
+                "name": a["name"],
+                "group_id": gid,
+                "max_size": policy.max_archive_size,
+            },
+            f"archive:{a['fileid']}",
+        )
+        for a, source in zip(rows.archives, rows.archive_sources)
+    )
+    if gid is not None and gid not in _named_groups:
+        pending.append((GROUP_NAME_JOB, {"group_id": gid}, f"group_name:{gid}"))
+    if (shard := await shards.route(gid)) is recorder:
+        # 任务和消息在同一个事务中写入, 不会出现消息已录入而任务丢失的情况
+        async with recorder.begin() as conn:
+            await write_rows(conn, [rows])
+            await jobs.enqueue_many(pending, conn=conn)
+    else:
+        # 先在主库中写入引用的记录和任务, 再把消息写入分片
+        refs = _unwritten_refs(rows)
+        if pending or refs is not None:
+            async with recorder.begin() as conn:
+                if refs is not None:
+                    await write_refs(conn, [refs])
+                await jobs.enqueue_many(pending, conn=conn)
+            if refs is not None:
+                _written_users.update(u["id"] for u in refs.users)
+                _written_groups.update(g["id"] for g in refs.groups)
+        async with shard.begin() as conn:
+            await write_messages(conn, [rows])
+    if pending:
+        jobs.notify()
+    hot_cache.push(rows)
+    media_index.add_known(m["fileid"] for m in rows.mediafiles)
+    logger.debug(
+        f"Recorded message {event.message_id} with {len(rows.segments)} segments"
+    )
@@ -0,0 +1,276 @@
+"""消息记录的列式分析副本
+
+统计类查询要扫描数月的历史, 直接在 messages.db 上通过 ORM 执行既慢,
+又会和录入的写入争抢. 这里定期把新增的 `Message` 行按水位线增量追加到本地的 DuckDB 中,
+聚合查询全部在 DuckDB 上以向量化的方式执行, 不再触碰 messages.db"""
+
+import threading
+import time
+import uuid
+from collections.abc import Sequence
+from datetime import datetime
+from typing import Any
+
+import duckdb
+import numpy as np
+from sqlalchemy import and_, bindparam, or_
+from sqlmodel import Session, col, select
+
+from recorder_models import Message, MessageSegment
+
+__all__ = ["SETTLE_DELAY", "fetch_new_rows", "AnalyticsMirror"]
+
+# store_time 在提交之前生成, 提交可能要等待 SQLite 的忙等超时 (默认 5 秒) 甚至重试,
+# 水位线只推进到这么多秒之前, 余量要远大于忙等超时, 否则晚提交的消息会被永久跳过
+SETTLE_DELAY = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    store_id VARCHAR PRIMARY KEY,
+    store_time DOUBLE,
+    timestamp DOUBLE,
+    message_id BIGINT,
+    message_type VARCHAR,
+    sender_id BIGINT,
+    group_id BIGINT
+);
+CREATE TABLE IF NOT EXISTS segments (
+    store_id VARCHAR,
+    type VARCHAR,
+    timestamp DOUBLE,
+    sender_id BIGINT,
+    group_id BIGINT
+);
+CREATE TABLE IF NOT EXISTS watermark (
+    id INTEGER PRIMARY KEY,
+    store_time DOUBLE,
+    store_id VARCHAR
+);
+"""
+
+_NEW_MESSAGES = (
+    select(
+        Message.store_id,
+        Message.store_time,
+        Message.timestamp,
+        Message.message_id,
+        Message.message_type,
+        Message.sender_id,
+        Message.group_id,
+    )
+    .where(
+        col(Message.store_time) <= bindparam("until"),
+        or_(
+            col(Message.store_time) > bindparam("wm_time"),
+            and_(
+                col(Message.store_time) == bindparam("wm_time"),
+                col(Message.store_id) > bindparam("wm_id"),
+            ),
+        )
+    )
+    .order_by(col(Message.store_time), col(Message.store_id))
+    .limit(bindparam("limit"))
+)
+_SEGMENT_TYPES = select(MessageSegment.message_store_id, MessageSegment.type).where(
+    col(MessageSegment.message_store_id).in_(bindparam("store_ids", expanding=True))
+)
+
+
+def fetch_new_rows(
+    session: Session, wm_time: float, wm_id: uuid.UUID, limit: int = 5000
+):
+    """从 messages.db 中读出水位线之后的一批消息及其消息段类型, 供 `run_sync` 调用"""
+    params = {
+        "wm_time": wm_time,
+        "wm_id": wm_id,
+        # 留出余量以免跳过仍在提交中的消息
+        "until": time.time() - SETTLE_DELAY,
+        "limit": limit,
+    }
+    messages = session.exec(_NEW_MESSAGES, params=params).all()
+    segments = []
+    if messages:
+        segments = session.exec(
+            _SEGMENT_TYPES, params={"store_ids": [m[0] for m in messages]}
+        ).all()
+    return messages, segments
+
+
+def _timestamp(t: datetime | float):
+    return t.timestamp() if isinstance(t, datetime) else t
+
+
+class AnalyticsMirror:
+    def __init__(self, path: str):
+        self._path = path
+        self._conn: duckdb.DuckDBPyConnection | None = None
+        # 同一个 DuckDB 连接不能被多个线程同时使用
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = duckdb.connect(self._path)
+            self._conn.execute(_SCHEMA)
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def watermark(self) -> tuple[float, uuid.UUID]:
+        with self._lock:
+            row = (
+                self._connect()
+                .execute("SELECT store_time, store_id FROM watermark WHERE id = 1")
+                .fetchone()
+            )
+        if row is None:
+            return -1.0, uuid.UUID(int=0)
+        return row[0], uuid.UUID(row[1])
+
+    def append(self, messages: Sequence[Any], segments: Sequence[Any]):
+        """追加一批消息并推进水位线, 二者在同一个事务中提交"""
+        if not messages:
+            return 0
+        store_ids = np.array([m.store_id.hex for m in messages], dtype=object)
+        senders = np.array([m.sender_id for m in messages], dtype=np.int64)
+        # 私聊消息没有群号, 用 0 占位后在插入时转为 NULL
+        groups = np.array([m.group_id or 0 for m in messages], dtype=np.int64)
+        times = np.array([m.timestamp for m in messages], dtype=np.float64)
+        message_batch = {
+            "store_id": store_ids,
+            "store_time": np.array([m.store_time for m in messages], dtype=np.float64),
+            "timestamp": times,
+            "message_id": np.array([m.message_id for m in messages], dtype=np.int64),
+            "message_type": np.array([m.message_type for m in messages], dtype=object),
+            "sender_id": senders,
+            "group_id": groups,
+        }
+        index = {sid: i for i, sid in enumerate(store_ids)}
+        rows = np.array([index[s[0].hex] for s in segments], dtype=np.int64)
+        segment_batch = {
+            "store_id": store_ids[rows] if len(rows) else store_ids[:0],
+            "type": np.array([s[1] for s in segments], dtype=object),
+            "timestamp": times[rows],
+            "sender_id": senders[rows],
+            "group_id": groups[rows],
+        }
+        last = messages[-1]
+        with self._lock:
+            conn = self._connect()
+            conn.register("message_batch", message_batch)
+            conn.register("segment_batch", segment_batch)
+            try:
+                conn.execute("BEGIN TRANSACTION")
+                conn.execute(
+                    "INSERT OR IGNORE INTO messages SELECT store_id, store_time,"
+                    " timestamp, message_id, message_type, sender_id,"
+                    " NULLIF(group_id, 0) FROM message_batch"
+                )
+                conn.execute(
+                    "INSERT INTO segments SELECT store_id, type, timestamp,"
+                    " sender_id, NULLIF(group_id, 0) FROM segment_batch"
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO watermark VALUES (1, ?, ?)",
+                    [last.store_time, last.store_id.hex],
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.unregister("message_batch")
+                conn.unregister("segment_batch")
+        return len(messages)
+
+    def _query(self, sql: str, params: list[Any]):
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    @staticmethod
+    def _where(
+        group_id: int | None,
+        start: datetime | float,
+        end: datetime | float,
+        sender_id: int | None = None,
+    ):
+        clauses = ["timestamp BETWEEN ? AND ?"]
+        params: list[Any] = [_timestamp(start), _timestamp(end)]
+        if group_id is not None:
+            clauses.append("group_id = ?")
+            params.append(group_id)
+        if sender_id is not None:
+            clauses.append("sender_id = ?")
+            params.append(sender_id)
+        return " AND ".join(clauses), params
+
+    def user_counts(
+        self, group_id: int | None, start: datetime | float, end: datetime | float
+    ) -> dict[int, int]:
+        """各用户的消息数, 按数量降序排列"""
+        where, params = self._where(group_id, start, end)
+        return dict(
+            self._query(
+                f"SELECT sender_id, count(*) AS n FROM messages WHERE {where}"
+                " GROUP BY sender_id ORDER BY n DESC",
+                params,
+            )
+        )
+
+    def top_senders(
+        self,
+        group_id: int | None,
+        start: datetime | float,
+        end: datetime | float,
+        limit: int = 10,
+    ) -> list[tuple[int, int]]:
+        where, params = self._where(group_id, start, end)
+        return self._query(
+            f"SELECT sender_id, count(*) AS n FROM messages WHERE {where}"
+            " GROUP BY sender_id ORDER BY n DESC, sender_id LIMIT ?",
+            [*params, limit],
+        )
+
+    def hourly_counts(
+        self,
+        group_id: int | None,
+        start: datetime | float,
+        end: datetime | float,
+        sender_id: int | None = None,
+    ) -> dict[float, int]:
+        """按小时分桶的消息数, 键为每个小时开始时的时间戳"""
+        where, params = self._where(group_id, start, end, sender_id)
+        return dict(
+            self._query(
+                f"SELECT floor(timestamp / 3600) * 3600 AS hour, count(*)"
+                f" FROM messages WHERE {where} GROUP BY hour ORDER BY hour",
+                params,
+            )
+        )
+
+    def segment_type_breakdown(
+        self,
+        group_id: int | None,
+        start: datetime | float,
+        end: datetime | float,
+        sender_id: int | None = None,
+    ) -> dict[str, int]:
+        where, params = self._where(group_id, start, end, sender_id)
+        return dict(
+            self._query(
+                f"SELECT type, count(*) AS n FROM segments WHERE {where}"
+                " GROUP BY type ORDER BY n DESC",
+                params,
+            )
+        )
+
+    def export_parquet(self, directory: str):
+        """把两张表导出为 Parquet 文件, 供外部工具离线分析"""
+        with self._lock:
+            conn = self._connect()
+            for table in ("messages", "segments"):
+                path = f"{directory}/{table}.parquet".replace("'", "''")
+                conn.execute(f"COPY {table} TO '{path}' (FORMAT parquet)")
@@ -0,0 +1,126 @@
+"""视频和文件消息段的归档下载
+
+这些文件体积大, 又最先从 QQ 的 CDN 上消失. 下载以流的形式写入磁盘上的 `.part` 文件,
+中断后用 HTTP Range 请求从已写入的位置继续; 所有归档下载共用一个令牌桶限速,
+并由专门的 worker 执行, 不会与图片下载争抢带宽, 也不会把整个文件读入内存"""
+
+import asyncio
+import hashlib
+import mimetypes
+import os
+import time
+from pathlib import Path
+
+import aiofiles
+from aiohttp import ClientResponse, ClientTimeout
+
+from lemony_utils.consts import http_headers
+from lemony_utils.templates import async_http
+
+__all__ = [
+    "ArchiveRejected",
+    "TokenBucket",
+    "file_digest",
+    "download_resumable",
+    "guess_extension",
+]
+
+CHUNK_SIZE = 256 * 1024
+# 限速下大文件要下载很久, 不限制总时长, 只在连接或读取停滞时放弃
+DOWNLOAD_TIMEOUT = ClientTimeout(total=None, sock_connect=30, sock_read=120)
+
+
+class ArchiveRejected(Exception):
+    """文件超出了录入策略的大小限制"""
+
+
+class TokenBucket:
+    """以字节每秒为单位的令牌桶, rate <= 0 时不限速"""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, CHUNK_SIZE)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def consume(self, amount: int):
+        if self.rate <= 0:
+            return
+        # 加锁保证多个下载按先后顺序分享带宽
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._stamp) * self.rate
+            )
+            self._stamp = now
+            self._tokens -= amount
+            if self._tokens < 0:
+                await asyncio.sleep(-self._tokens / self.rate)
+
+
+def file_digest(path: str | Path):
+    """分块计算文件的 sha256, 在线程中调用"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while chunk := fp.read(1024 * 1024):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _total_size(resp: ClientResponse, offset: int):
+    if resp.status == 206:
+        # Content-Range: bytes start-end/total
+        total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+        if total.isdigit():
+            return int(total)
+    if resp.content_length is not None:
+        return offset + resp.content_length
+    return None
+
+
+async def download_resumable(
+    url: str,
+    part: Path,
+    *,
+    max_size: int = 0,
+    limiter: TokenBucket | None = None,
+):
+    """把 url 的内容续传到 part 文件, 返回 (Content-Type, 文件大小)
+
+    part 文件已存在时从其末尾开始请求; 服务器不支持 Range 时从头下载"""
+    part.parent.mkdir(parents=True, exist_ok=True)
+    offset = part.stat().st_size if part.exists() else 0
+    headers = http_headers.copy()
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    async with async_http(
+        url, "get", headers=headers, timeout=DOWNLOAD_TIMEOUT
+    ) as resp:
+        if resp.status == 416:
+            # 已下载的部分就是完整的文件
+            return "", offset
+        resp.raise_for_status()
+        if resp.status != 206:
+            offset = 0
+        total = _total_size(resp, offset)
+        if max_size > 0 and total is not None and total > max_size:
+            raise ArchiveRejected(f"size {total} exceeds {max_size}")
+        size = offset
+        async with aiofiles.open(part, "ab" if offset else "wb") as fp:
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                if limiter is not None:
+                    await limiter.consume(len(chunk))
+                size += len(chunk)
+                if max_size > 0 and size > max_size:
+                    raise ArchiveRejected(f"size exceeds {max_size}")
+                await fp.write(chunk)
+        if total is not None and size < total:
+            raise ConnectionError(f"download interrupted at {size}/{total} bytes")
+        return resp.headers.get("Content-Type", ""), size
+
+
+def guess_extension(name: str | None, content_type: str):
+    if name and (ext := os.path.splitext(name)[1]):
+        return ext.lower()
+    return mimetypes.guess_extension(content_type.split(";")[0].strip()) or ""
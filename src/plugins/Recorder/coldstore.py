@@ -0,0 +1,157 @@
+"""较早消息段数据的字典压缩
+
+消息段的 JSON 高度重复: 相同的键、URL 前缀和 fileid 形式. 这里用录入的数据训练一个
+zstd 字典, 把超过一定时间的消息段数据压缩后原地写回. 列类型 `CompressedJSON`
+在读取时自动解压, 查询辅助函数和各插件都不需要感知压缩的存在
+
+文本消息段不压缩, 以便 `.recquery` 之类的查询仍能在 SQL 里按 JSON 路径搜索.
+压缩只是把行改小, 释放出的页要靠 VACUUM 才能归还给文件系统, 见 `AsyncDbCore.reclaim_space`"""
+
+import json
+
+import uuid
+
+import zstandard
+from sqlalchemy import String, bindparam, func, select, type_coerce, update
+from sqlalchemy.types import LargeBinary
+from sqlmodel import Session, SQLModel, col
+
+from lemony_utils.compressed_json import (
+    decompress_value,
+    make_compressor,
+    register_dictionary,
+)
+from recorder_models import Message, MessageSegment, SegmentDictionary
+
+__all__ = [
+    "load_dictionaries",
+    "sample_segments",
+    "train_dictionary",
+    "save_dictionary",
+    "compress_cold_segments",
+    "restore_text_segments",
+]
+
+_SEGMENT_TABLE = SQLModel.metadata.tables[MessageSegment.__tablename__]
+_MESSAGE_TABLE = SQLModel.metadata.tables[Message.__tablename__]
+# 绕过列类型, 原样读出 JSON 文本
+_RAW_DATA = type_coerce(_SEGMENT_TABLE.c.data, String)
+_IS_PLAIN = func.typeof(_SEGMENT_TABLE.c.data) == "text"
+_IS_TEXT = _SEGMENT_TABLE.c.type == "text"
+
+_SAMPLE = (
+    select(_RAW_DATA)
+    .where(_IS_PLAIN, ~_IS_TEXT)
+    .order_by(func.random())
+    .limit(bindparam("n"))
+)
+_COLD_SEGMENTS = (
+    select(_SEGMENT_TABLE.c.id, _RAW_DATA)
+    .join(
+        _MESSAGE_TABLE,
+        _MESSAGE_TABLE.c.store_id == _SEGMENT_TABLE.c.message_store_id,
+    )
+    .where(
+        _IS_PLAIN,
+        ~_IS_TEXT,
+        _MESSAGE_TABLE.c.timestamp < bindparam("before"),
+        _SEGMENT_TABLE.c.id > bindparam("after"),
+    )
+    .order_by(_SEGMENT_TABLE.c.id)
+    .limit(bindparam("limit"))
+)
+_COMPRESSED_TEXT = (
+    select(_SEGMENT_TABLE.c.id, type_coerce(_SEGMENT_TABLE.c.data, LargeBinary))
+    .where(_IS_TEXT, func.typeof(_SEGMENT_TABLE.c.data) == "blob")
+    .limit(bindparam("limit"))
+)
+_STORE_PLAIN = (
+    update(_SEGMENT_TABLE)
+    .where(_SEGMENT_TABLE.c.id == bindparam("seg_id"))
+    .values(data=type_coerce(bindparam("text"), String))
+)
+_STORE_COMPRESSED = (
+    update(_SEGMENT_TABLE)
+    .where(_SEGMENT_TABLE.c.id == bindparam("seg_id"))
+    .values(data=type_coerce(bindparam("blob"), LargeBinary))
+)
+
+
+def load_dictionaries(session: Session):
+    """登记库中的所有字典, 返回最新一个的 id, 没有字典时返回 None"""
+    latest = None
+    for zdict in session.exec(
+        select(SegmentDictionary).order_by(col(SegmentDictionary.created))
+    ).all():
+        latest = register_dictionary(zdict.data)
+    return latest
+
+
+def sample_segments(session: Session, count: int) -> list[bytes]:
+    """随机取出未压缩的消息段数据, 用作训练字典的样本"""
+    texts = session.connection().execute(_SAMPLE, {"n": count}).scalars()
+    return [text.encode() for text in texts]
+
+
+def train_dictionary(samples: list[bytes], size: int):
+    """训练字典, 返回字典的原始数据; CPU 密集, 在线程中调用"""
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+def save_dictionary(session: Session, data: bytes):
+    dict_id = register_dictionary(data)
+    session.add(SegmentDictionary(id=dict_id, data=data))
+    session.commit()
+    return dict_id
+
+
+def compress_cold_segments(
+    session: Session,
+    before: float,
+    dict_id: int,
+    *,
+    level: int = 9,
+    after: uuid.UUID | None = None,
+    limit: int = 500,
+):
+    """压缩一批消息时间早于 `before` 的消息段, 只保留变小了的结果
+
+    返回 (最后一个处理的消息段 id, 处理的条数, 节省的字节数), 把返回的 id
+    作为下一次调用的 `after`, 可以跳过上一批中压缩后没有变小的消息段"""
+    conn = session.connection()
+    rows = conn.execute(
+        _COLD_SEGMENTS,
+        {"before": before, "after": after or uuid.UUID(int=0), "limit": limit},
+    ).all()
+    if not rows:
+        return None, 0, 0
+    cctx = make_compressor(dict_id, level)
+    updates = []
+    saved = 0
+    for seg_id, text in rows:
+        raw = text.encode()
+        blob = cctx.compress(raw)
+        if len(blob) < len(raw):
+            updates.append({"seg_id": seg_id, "blob": blob})
+            saved += len(raw) - len(blob)
+    if updates:
+        conn.execute(_STORE_COMPRESSED, updates)
+        session.commit()
+    return rows[-1][0], len(rows), saved
+
+
+def restore_text_segments(session: Session, limit: int = 500):
+    """把从前被压缩的文本消息段解压回 JSON 文本, 返回处理的条数, 为 0 时已全部恢复"""
+    conn = session.connection()
+    rows = conn.execute(_COMPRESSED_TEXT, {"limit": limit}).all()
+    if not rows:
+        return 0
+    conn.execute(
+        _STORE_PLAIN,
+        [
+            {"seg_id": seg_id, "text": json.dumps(decompress_value(blob))}
+            for seg_id, blob in rows
+        ],
+    )
+    session.commit()
+    return len(rows)
@@ -0,0 +1,265 @@
+"""按群划分的最近消息环形缓冲区
+
+`.sum M` 和 `.mq [a,b]` 之类的指令绝大多数只会用到当前群最近的几百条消息,
+所以在内存里为每个群保留最近 N 条消息的紧凑副本, 窗口落在缓冲区内时直接从这里取,
+否则回落到 SQL 查询
+
+缓冲区在录入时填充, 启动时从数据库预热. 它始终是该群消息历史的一个连续后缀,
+因此只要在缓冲区内找到了足够的消息, 得到的结果就和 SQL 查询完全一致"""
+
+import bisect
+import uuid
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from typing import Any
+
+from .ingest import IngestRows
+
+__all__ = [
+    "CachedSegment",
+    "CachedUser",
+    "CachedGroup",
+    "CachedMessage",
+    "HotMessageCache",
+    "hot_cache",
+]
+
+
+@dataclass(frozen=True, slots=True)
+class CachedSegment:
+    order: int
+    type: str
+    data: dict[str, Any]
+
+
+@dataclass(frozen=True, slots=True)
+class CachedUser:
+    id: int
+    name: str | None
+
+
+@dataclass(slots=True)
+class CachedGroup:
+    """同一个群的所有缓存消息共享此对象, 以便群名修正后立即生效"""
+
+    id: int
+    name: str | None = None
+
+
+@dataclass(slots=True)
+class CachedMessage:
+    """`Message` 的紧凑只读副本, 提供与之相同的常用属性以便直接替代使用"""
+
+    store_id: uuid.UUID
+    message_id: int
+    timestamp: float
+    sender_id: int
+    group: CachedGroup
+    sender: CachedUser
+    segments: tuple[CachedSegment, ...]
+    message_type: str = "group"
+
+    @property
+    def group_id(self):
+        return self.group.id
+
+    @property
+    def sort_key(self):
+        return (self.timestamp, self.message_id)
+
+
+@dataclass
+class _GroupRing:
+    group: CachedGroup
+    messages: list[CachedMessage] = field(default_factory=list)
+    store_ids: set[uuid.UUID] = field(default_factory=set)
+    # 为真时缓冲区包含了该群自有记录以来的全部消息
+    complete: bool = True
+
+
+class HotMessageCache:
+    def __init__(self, capacity: int = 500):
+        self.capacity = capacity
+        self._rings: dict[int, _GroupRing] = {}
+        self._user_names: dict[int, str | None] = {}
+        self._ready = False
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    @property
+    def ready(self):
+        """只有在预热完成后才会用缓存来回答查询"""
+        return self.enabled and self._ready
+
+    def _ring(self, gid: int):
+        if (ring := self._rings.get(gid)) is None:
+            ring = self._rings[gid] = _GroupRing(CachedGroup(gid))
+        return ring
+
+    def _insert(self, ring: _GroupRing, msg: CachedMessage):
+        if msg.store_id in ring.store_ids:
+            return
+        msgs = ring.messages
+        if not msgs or msgs[-1].sort_key <= msg.sort_key:
+            msgs.append(msg)
+        else:
+            bisect.insort(msgs, msg, key=lambda m: m.sort_key)
+        ring.store_ids.add(msg.store_id)
+
+    def _trim(self, ring: _GroupRing):
+        if (overflow := len(ring.messages) - self.capacity) > 0:
+            for msg in ring.messages[:overflow]:
+                ring.store_ids.discard(msg.store_id)
+            del ring.messages[:overflow]
+            ring.complete = False
+
+    def _user(self, uid: int, name: str | None):
+        # 与数据库中 User 行 "先到先得" 的写入语义保持一致
+        return CachedUser(uid, self._user_names.setdefault(uid, name))
+
+    def push(self, rows: IngestRows):
+        """录入一条刚写入数据库的消息"""
+        if not self.enabled or (gid := rows.message["group_id"]) is None:
+            return
+        ring = self._ring(gid)
+        msg = rows.message
+        sender_id = msg["sender_id"]
+        name = next((u["name"] for u in rows.users if u["id"] == sender_id), None)
+        self._insert(
+            ring,
+            CachedMessage(
+                store_id=msg["store_id"],
+                message_id=msg["message_id"],
+                timestamp=msg["timestamp"],
+                sender_id=sender_id,
+                group=ring.group,
+                sender=self._user(sender_id, name),
+                segments=tuple(
+                    CachedSegment(s["order"], s["type"], s["data"])
+                    for s in rows.segments
+                ),
+            ),
+        )
+        self._trim(ring)
+
+    def warm(self, messages: Iterable[Any], exhausted_groups: Iterable[int] = ()):
+        """用从数据库读出的 `Message` 预热缓存, 调用时请保持其所属的 session 打开
+
+        `exhausted_groups` 是预热查询取到的消息少于容量的群,
+        它们在缓冲区里拥有完整的历史. 消息可能分散在多个数据库中, 因此可以多次调用,
+        全部预热完成后再调用 `mark_ready`"""
+        if not self.enabled:
+            return
+        touched: set[int] = set()
+        for msg in messages:
+            ring = self._ring(msg.group_id)
+            if msg.group is not None and ring.group.name is None:
+                ring.group.name = msg.group.name
+            self._insert(
+                ring,
+                CachedMessage(
+                    store_id=msg.store_id,
+                    message_id=msg.message_id,
+                    timestamp=msg.timestamp,
+                    sender_id=msg.sender_id,
+                    group=ring.group,
+                    sender=self._user(msg.sender_id, msg.sender.name),
+                    segments=tuple(
+                        CachedSegment(s.order, s.type, s.data)
+                        for s in sorted(msg.segments, key=lambda s: s.order)
+                    ),
+                ),
+            )
+            touched.add(msg.group_id)
+        exhausted = set(exhausted_groups)
+        for gid in touched:
+            ring = self._rings[gid]
+            # 同一个群的消息在另一个库中没有取完时, 缓冲区的历史就不完整
+            ring.complete = ring.complete and gid in exhausted
+            self._trim(ring)
+
+    def mark_ready(self):
+        """所有数据库都预热完成后调用, 此后才会用缓存来回答查询"""
+        self._ready = True
+
+    def set_group_name(self, gid: int, name: str | None):
+        if (ring := self._rings.get(gid)) is not None:
+            ring.group.name = name
+
+    def clear(self):
+        self._rings.clear()
+        self._user_names.clear()
+        self._ready = False
+
+    def recent(self, gid: int, count: int, sender_id: int | None = None):
+        """返回按时间递增排序的最近 count 条消息, 缓冲区无法确定答案时返回 None"""
+        if not self.ready:
+            return None
+        if (ring := self._rings.get(gid)) is None:
+            # 从未见过的群, 预热时数据库里也没有它的消息
+            return []
+        result: list[CachedMessage] = []
+        for msg in reversed(ring.messages):
+            if len(result) >= count:
+                break
+            if sender_id is None or msg.sender_id == sender_id:
+                result.append(msg)
+        if len(result) < count and not ring.complete:
+            return None
+        return result[::-1]
+
+    def context(
+        self,
+        gid: int,
+        uid: int,
+        mid: int,
+        edge_e: int,
+        edge_l: int,
+        sender_only: bool,
+    ):
+        """`get_context_messages` 的缓存版本, 语义一致; 无法确定答案时返回 None
+
+        返回 (base, earliers, laters), earliers 按时间倒序, laters 按时间正序"""
+        if not self.ready:
+            return None
+        if (ring := self._rings.get(gid)) is None:
+            return None, [], []
+        msgs = ring.messages
+        for base_i in range(len(msgs) - 1, -1, -1):
+            m = msgs[base_i]
+            if m.sender_id == uid and m.message_id == mid:
+                break
+        else:
+            return (None, [], []) if ring.complete else None
+        base = msgs[base_i]
+
+        def matches(m: CachedMessage):
+            # 与 SQL 一致, 和基准消息 (timestamp, message_id) 完全相同的消息不算在内
+            return m.sort_key != base.sort_key and (
+                not sender_only or m.sender_id == uid
+            )
+
+        earliers: list[CachedMessage] = []
+        laters: list[CachedMessage] = []
+        if edge_e < 0:
+            need = abs(edge_e)
+            for m in reversed(msgs[:base_i]):
+                if len(earliers) >= need:
+                    break
+                if matches(m):
+                    earliers.append(m)
+            if len(earliers) < need and not ring.complete:
+                return None
+        if edge_l > 0:
+            # 缓冲区是历史的后缀, 晚于基准的消息一定都在里面
+            for m in msgs[base_i + 1 :]:
+                if len(laters) >= edge_l:
+                    break
+                if matches(m):
+                    laters.append(m)
+        return base, earliers, laters
+
+
+hot_cache = HotMessageCache()
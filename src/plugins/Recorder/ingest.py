@@ -0,0 +1,220 @@
+"""绕开 ORM 的消息录入路径
+
+每条消息原本要构建 `Message` 和若干 `MessageSegment` 对象, 经过 pydantic 校验、
+unit-of-work flush 和关系维护, 大部分 CPU 时间都花在了这里而不是 SQLite 上.
+这里直接从事件构建行字典, 再用 Core 层面的 executemany 批量写入,
+ORM 模型只留给读取使用"""
+
+import time
+import uuid
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from typing import Any
+
+from melobot.protocols.onebot.v11.adapter.event import (
+    GroupMessageEvent,
+    MessageEvent,
+    PrivateMessageEvent,
+)
+from melobot.protocols.onebot.v11.adapter.segment import ImageSegment, Segment
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlmodel import SQLModel
+from yarl import URL
+
+from lemony_utils.stickers import StickerKey, sticker_key
+from recorder_models import (
+    ArchivedFile,
+    Group,
+    MediaFile,
+    Message,
+    MessageSegment,
+    User,
+)
+
+from .policy import CompiledPolicy
+
+__all__ = [
+    "IngestRows",
+    "url_to_fileid",
+    "build_rows",
+    "write_refs",
+    "write_messages",
+    "write_rows",
+]
+
+_USER_TABLE = SQLModel.metadata.tables[User.__tablename__]
+_GROUP_TABLE = SQLModel.metadata.tables[Group.__tablename__]
+_MESSAGE_TABLE = SQLModel.metadata.tables[Message.__tablename__]
+_SEGMENT_TABLE = SQLModel.metadata.tables[MessageSegment.__tablename__]
+_MEDIAFILE_TABLE = SQLModel.metadata.tables[MediaFile.__tablename__]
+_ARCHIVE_TABLE = SQLModel.metadata.tables[ArchivedFile.__tablename__]
+
+# 语句只构建一次, 执行时传入参数列表即为 executemany
+_INSERT_USER = insert(_USER_TABLE).on_conflict_do_nothing()
+_INSERT_GROUP = insert(_GROUP_TABLE).on_conflict_do_nothing()
+_INSERT_MEDIAFILE = insert(_MEDIAFILE_TABLE).on_conflict_do_nothing()
+_INSERT_ARCHIVE = insert(_ARCHIVE_TABLE).on_conflict_do_nothing()
+_INSERT_MESSAGE = insert(_MESSAGE_TABLE)
+_INSERT_SEGMENT = insert(_SEGMENT_TABLE)
+
+
+def url_to_fileid(url: URL):
+    if url.host == "multimedia.nt.qq.com.cn":
+        return url.query["fileid"]
+    elif url.host.endswith("qpic.cn"):
+        return max(url.parts, key=len)
+    # logger.warning(f"url {url} is not known url pattern")
+    return str(url)
+
+
+@dataclass
+class IngestRows:
+    """一条消息事件对应的所有待写入行"""
+
+    message: dict[str, Any]
+    segments: list[dict[str, Any]] = field(default_factory=list)
+    users: list[dict[str, Any]] = field(default_factory=list)
+    groups: list[dict[str, Any]] = field(default_factory=list)
+    mediafiles: list[dict[str, Any]] = field(default_factory=list)
+    media_urls: list[URL] = field(default_factory=list)
+    # 需要预先缓存的商城表情: (键, url)
+    stickers: list[tuple[StickerKey, str | None]] = field(default_factory=list)
+    # 需要归档的视频和文件, 以及获取它们所需的信息
+    archives: list[dict[str, Any]] = field(default_factory=list)
+    archive_sources: list[dict[str, Any]] = field(default_factory=list)
+
+
+def _declared_size(seg: Segment):
+    try:
+        return int(seg.raw["data"].get("file_size") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def build_rows(event: MessageEvent, policy: CompiledPolicy | None = None):
+    """从 OneBot 消息事件直接构建行字典, 不经过任何 ORM 对象
+
+    给出 `policy` 时, 不需要的消息段和媒体文件在这里就被丢掉"""
+    now = time.time()
+    store_id = uuid.uuid4()
+    rows = IngestRows(
+        message={
+            "store_id": store_id,
+            "store_time": now,
+            "message_id": event.message_id,
+            "timestamp": event.time,
+            "message_type": "group",
+            "sender_id": event.sender.user_id,
+            "group_id": None,
+            "receiver_id": None,
+        },
+        users=[{"id": event.sender.user_id, "name": event.sender.nickname}],
+    )
+    if isinstance(event, GroupMessageEvent):
+        rows.message["group_id"] = event.group_id
+        rows.groups.append({"id": event.group_id, "name": None})
+    elif isinstance(event, PrivateMessageEvent):
+        rows.message["receiver_id"] = event.self_id
+        rows.message["message_type"] = "private"
+        rows.users.append({"id": event.self_id, "name": None})
+
+    for i, seg in enumerate(event.message):
+        if policy is not None and not policy.keep_segment(seg.type):
+            continue
+        if isinstance(seg, ImageSegment) and (
+            policy is None
+            or policy.download_media
+            and policy.allows_size(_declared_size(seg))
+        ):
+            url = URL(str(seg.data["url"]))
+            rows.mediafiles.append(
+                {
+                    "fileid": url_to_fileid(url),
+                    "timestamp": now,
+                    "path": None,
+                    "hash": None,
+                }
+            )
+            rows.media_urls.append(url)
+        elif seg.type == "mface" and (policy is None or policy.download_media):
+            if key := sticker_key(seg.raw["data"]):
+                rows.stickers.append((key, seg.raw["data"].get("url")))
+        elif (
+            seg.type in ("video", "file")
+            and policy is not None
+            and policy.archives(seg.type, _declared_size(seg))
+        ):
+            _add_archive(rows, seg, now)
+        # TODO: 处理语音消息段
+        rows.segments.append(
+            {
+                "id": uuid.uuid4(),
+                "order": i,
+                "type": seg.type,
+                "data": seg.raw["data"],
+                "message_store_id": store_id,
+            }
+        )
+    return rows
+
+
+def _add_archive(rows: IngestRows, seg: Segment, now: float):
+    data = seg.raw["data"]
+    url = data.get("url") or None
+    if url:
+        fileid = url_to_fileid(URL(str(url)))
+    elif not (fileid := data.get("file_id") or None):
+        return
+    rows.archives.append(
+        {
+            "fileid": str(fileid),
+            "kind": seg.type,
+            "name": data.get("file") or data.get("name"),
+            "timestamp": now,
+            "size": None,
+            "sha256": None,
+            "path": None,
+        }
+    )
+    rows.archive_sources.append(
+        {
+            "url": url and str(url),
+            "file_id": data.get("file_id"),
+            "busid": data.get("busid"),
+        }
+    )
+
+
+async def write_refs(conn: AsyncConnection, batch: Sequence[IngestRows]):
+    """写入消息引用的用户、群组、媒体文件和归档记录, 它们总在主库中
+
+    已存在的记录会被跳过, 与原先的 `ensure_*` 行为一致"""
+    users = [u for rows in batch for u in rows.users]
+    groups = [g for rows in batch for g in rows.groups]
+    mediafiles = [m for rows in batch for m in rows.mediafiles]
+    archives = [a for rows in batch for a in rows.archives]
+    if users:
+        await conn.execute(_INSERT_USER, users)
+    if groups:
+        await conn.execute(_INSERT_GROUP, groups)
+    if mediafiles:
+        await conn.execute(_INSERT_MEDIAFILE, mediafiles)
+    if archives:
+        await conn.execute(_INSERT_ARCHIVE, archives)
+
+
+async def write_messages(conn: AsyncConnection, batch: Sequence[IngestRows]):
+    """写入消息和消息段, 启用分片时它们在群所在的分片中"""
+    messages = [rows.message for rows in batch]
+    segments = [s for rows in batch for s in rows.segments]
+    if messages:
+        await conn.execute(_INSERT_MESSAGE, messages)
+    if segments:
+        await conn.execute(_INSERT_SEGMENT, segments)
+
+
+async def write_rows(conn: AsyncConnection, batch: Sequence[IngestRows]):
+    """在给定连接上把一批消息的行写入数据库, 每张表只执行一次 executemany"""
+    await write_refs(conn, batch)
+    await write_messages(conn, batch)
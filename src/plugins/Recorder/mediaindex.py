@@ -0,0 +1,123 @@
+"""常驻内存的 fileid -> path 索引
+
+`get_filepath` 的大部分调用都来自渲染前的资源收集, 其中头像之类的 URL 根本不会被录入过,
+却依然要为每个 URL 开一次 session 跑一次 SELECT. 这里用布隆过滤器记下所有已知的 fileid,
+用于直接否定未录入过的 URL; 命中的部分先查有界的 LRU, 剩下的才交给数据库批量查询"""
+
+import hashlib
+import math
+from collections import OrderedDict
+from collections.abc import Iterable
+
+__all__ = ["BloomFilter", "MediaPathIndex", "media_index"]
+
+_MISSING = object()
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self._size = max(
+            8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        )
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        # 双重哈希模拟 k 个独立的哈希函数
+        return ((h1 + i * h2) % self._size for i in range(self._hashes))
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str):
+        return all(
+            self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key)
+        )
+
+
+class MediaPathIndex:
+    def __init__(self, lru_size: int = 10000, bloom_capacity: int = 1_000_000):
+        self.lru_size = lru_size
+        self.bloom_capacity = bloom_capacity
+        self._bloom = BloomFilter(bloom_capacity)
+        self._lru: OrderedDict[str, str | None] = OrderedDict()
+        self._ready = False
+        # 载入完成前登记的 fileid, 重建布隆过滤器时需要补上
+        self._early: list[str] = []
+        self.hits = 0
+        self.misses = 0
+        self.rejects = 0
+
+    @property
+    def ready(self):
+        """载入完成前布隆过滤器不完整, 此时不能用于否定查询"""
+        return self._ready
+
+    def load(self, fileids: Iterable[str], recent: Iterable[tuple[str, str | None]]):
+        """用数据库中全部的 fileid 重建布隆过滤器, 并用最近的记录预热 LRU"""
+        fileids = list(fileids)
+        bloom = BloomFilter(max(self.bloom_capacity, len(fileids) * 2))
+        for fileid in fileids:
+            bloom.add(fileid)
+        for fileid in self._early:
+            bloom.add(fileid)
+        self._early.clear()
+        self._bloom = bloom
+        for fileid, path in recent:
+            self._lru.setdefault(fileid, path)
+        self._trim()
+        self._ready = True
+
+    def _trim(self):
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def add_known(self, fileids: Iterable[str]):
+        """登记新录入的 fileid, 它们的文件可能还在下载中"""
+        for fileid in fileids:
+            self._add(fileid)
+
+    def _add(self, fileid: str):
+        self._bloom.add(fileid)
+        if not self._ready:
+            self._early.append(fileid)
+
+    def put(self, fileid: str, path: str | None):
+        self._add(fileid)
+        self._lru[fileid] = path
+        self._lru.move_to_end(fileid)
+        self._trim()
+
+    def discard(self, fileid: str):
+        self._lru.pop(fileid, None)
+
+    def lookup(self, fileid: str):
+        """返回 (已确定, path); 未确定时需要查询数据库"""
+        if self._ready and fileid not in self._bloom:
+            self.rejects += 1
+            return True, None
+        if (path := self._lru.get(fileid, _MISSING)) is not _MISSING:
+            self._lru.move_to_end(fileid)
+            self.hits += 1
+            return True, path
+        self.misses += 1
+        return False, None
+
+    def stats(self):
+        return {
+            "entries": len(self._lru),
+            "known": self._bloom.count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "rejects": self.rejects,
+        }
+
+
+media_index = MediaPathIndex()
@@ -0,0 +1,66 @@
+from typing import Literal
+
+from pydantic import BaseModel, Field
+
+
+class RecordPolicy(BaseModel):
+    # full: 录入全部消息段并下载媒体文件; text: 只录入文本类消息段; skip: 完全不录入
+    mode: Literal["full", "text", "skip"] = "full"
+    # 录入消息的比例, 用于在刷屏的群里只保留一部分消息
+    sample_rate: float = 1.0
+    # 是否下载媒体文件, 为假时只记录消息段
+    download_media: bool = True
+    # 允许下载的 MIME 类型, 支持 "image/*" 形式的通配, 为空时不限制
+    media_types: list[str] = Field(default_factory=list)
+    # 单个媒体文件的大小上限 (字节), <= 0 时不限制
+    max_media_size: int = 0
+    # 是否归档视频和文件消息段, 仅在 full 模式下生效
+    archive_videos: bool = False
+    archive_files: bool = False
+    # 单个归档文件的大小上限 (字节), <= 0 时不限制
+    max_archive_size: int = 512 * 1024 * 1024
+
+
+class RecorderConfig(BaseModel):
+    # 每个群在内存中保留的最近消息条数, <= 0 时禁用热缓存
+    hot_buffer_size: int = 500
+    # fileid -> path 索引中 LRU 的条目数, 以及布隆过滤器的预期容量
+    media_index_size: int = 10000
+    media_bloom_capacity: int = 1_000_000
+    # 录入图片时在原图旁生成的缩小变体宽度 (WebP), 为空时不生成
+    thumbnail_widths: list[int] = [256, 512]
+    thumbnail_quality: int = 80
+    # 写入前把图片转码为 WebP: off 不转码, lossless 无损, lossy 按 transcode_quality 有损
+    transcode: Literal["off", "lossless", "lossy"] = "off"
+    transcode_quality: int = 85
+    # 执行转码的进程数
+    transcode_processes: int = 2
+    # 新图片与已存储图片的 dHash 距离不超过此值且宽高比一致时直接复用已有文件,
+    # 小于 0 时不做近似去重. 被复用的图片不会再单独保存, 开启前请确认能接受这一点
+    phash_dedupe_distance: int = -1
+    # 执行下载媒体文件等后台任务的 worker 数量
+    job_workers: int = 4
+    # 录入策略: 私聊消息、未单独指定的群, 以及按群号指定的策略
+    private_policy: RecordPolicy = Field(default_factory=RecordPolicy)
+    default_policy: RecordPolicy = Field(default_factory=RecordPolicy)
+    group_policies: dict[int, RecordPolicy] = Field(default_factory=dict)
+    # 归档视频和文件的专用 worker 数量, 以及它们共享的带宽上限 (字节每秒, <= 0 时不限速)
+    archive_workers: int = 1
+    archive_bandwidth: int = 2 * 1024 * 1024
+    # 向 DuckDB 分析副本追加新消息的间隔 (秒), <= 0 时只在查询时同步; 以及每批读取的条数
+    analytics_interval: int = 600
+    analytics_batch_size: int = 5000
+    # 群消息分片: off 不分片, group 每个群一个文件, hash 按群号取模分到 shard_buckets 个文件
+    # 启用后原有的群消息会被逐步迁移到分片中; 启用 hash 后不要再修改 shard_buckets
+    shard_mode: Literal["off", "group", "hash"] = "off"
+    shard_buckets: int = 16
+    # 消息时间早于此天数的非文本消息段数据会用训练出的 zstd 字典压缩保存, <= 0 时不压缩
+    cold_segment_days: int = 0
+    cold_compress_interval: int = 6 * 60 * 60
+    cold_compress_level: int = 9
+    # 训练字典时采样的消息段数量和字典大小 (字节)
+    cold_sample_count: int = 5000
+    cold_dict_size: int = 112 * 1024
+    # 压缩后用 incremental_vacuum 归还空闲页, 这要求库的 auto_vacuum 为 INCREMENTAL;
+    # 为真时会把尚未启用的库切换过去, 这需要执行一次完整的 VACUUM, 期间录入会被阻塞
+    cold_vacuum_convert: bool = False
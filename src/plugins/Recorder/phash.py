@@ -0,0 +1,155 @@
+"""感知哈希与近似重复图片的索引
+
+`_store_mediafile` 只能用 md5 去重, 同一张表情包被 QQ 以不同质量重新编码后,
+每次都会被当作新文件存下来. 这里为每个存储的文件计算 64 位的 dHash,
+并放进 BK 树里, 以汉明距离为半径查找相近的图片, 不需要两两比较"""
+
+import io
+from collections.abc import Iterable
+
+import numpy as np
+from PIL import Image
+
+__all__ = [
+    "dhash",
+    "dhash_bytes",
+    "hamming",
+    "image_size",
+    "same_shape",
+    "BKTree",
+    "PerceptualIndex",
+    "phash_index",
+]
+
+_HASH_SIZE = 8
+
+
+def dhash(image: Image.Image) -> int:
+    """在 9x8 的灰度缩略图上比较水平相邻像素的亮度, 得到 64 位哈希"""
+    if image.mode in ("RGBA", "LA", "P"):
+        # 透明部分按白色处理, 否则透明背景的颜色会影响结果
+        image = image.convert("RGBA")
+        bg = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(bg, image)
+    gray = image.convert("L").resize(
+        (_HASH_SIZE + 1, _HASH_SIZE), Image.Resampling.LANCZOS
+    )
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def dhash_bytes(data: bytes):
+    """计算图片文件内容的 dHash, 无法解码时返回 None; 动图只取第一帧"""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            # 对 JPEG 可以直接以缩小的尺寸解码
+            img.draft("RGB", (64, 64))
+            return dhash(img)
+    except Exception:
+        return None
+
+
+def image_size(src: bytes | str) -> tuple[int, int] | None:
+    """只读取文件头得到图片尺寸, 无法解码时返回 None"""
+    try:
+        with Image.open(io.BytesIO(src) if isinstance(src, bytes) else src) as img:
+            return img.size
+    except Exception:
+        return None
+
+
+def same_shape(a: tuple[int, int], b: tuple[int, int], tolerance: float = 0.01):
+    """两张图的宽高比是否一致; 9x8 的 dHash 很粗糙, 命中后要用它排除截图和裁剪过的图"""
+    (wa, ha), (wb, hb) = a, b
+    if not (wa and ha and wb and hb):
+        return False
+    return abs(wa * hb - wb * ha) <= tolerance * max(wa * hb, wb * ha)
+
+
+def hamming(a: int, b: int):
+    return (a ^ b).bit_count()
+
+
+class BKTree[T]:
+    """以汉明距离为度量的 BK 树, 同一个哈希可以挂多个值"""
+
+    __slots__ = ("_root", "_size")
+
+    def __init__(self):
+        # 节点: [hash, values, {distance: child}]
+        self._root: list | None = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, h: int, value: T):
+        self._size += 1
+        if self._root is None:
+            self._root = [h, [value], {}]
+            return
+        node = self._root
+        while True:
+            if (d := hamming(h, node[0])) == 0:
+                node[1].append(value)
+                return
+            if (child := node[2].get(d)) is None:
+                node[2][d] = [h, [value], {}]
+                return
+            node = child
+
+    def search(self, h: int, radius: int) -> list[tuple[int, T]]:
+        """返回距离不超过 radius 的 (距离, 值), 按距离递增排序"""
+        result: list[tuple[int, T]] = []
+        if self._root is None:
+            return result
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                result.extend((d, v) for v in node[1])
+            # 三角不等式: 只有边权在 [d - r, d + r] 之间的子树才可能有结果
+            for edge, child in node[2].items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        result.sort(key=lambda x: x[0])
+        return result
+
+
+class PerceptualIndex:
+    """存储文件的路径 -> dHash 索引"""
+
+    def __init__(self):
+        self._tree: BKTree[str] = BKTree()
+        self._paths: set[str] = set()
+        self._ready = False
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, path: str):
+        return path in self._paths
+
+    def load(self, rows: Iterable[tuple[str, int]]):
+        for path, h in rows:
+            self.add(path, h)
+        self._ready = True
+
+    def add(self, path: str, h: int):
+        if path in self._paths:
+            return
+        self._paths.add(path)
+        self._tree.add(h, path)
+
+    def find(self, h: int, max_distance: int):
+        """返回 (距离, 路径) 列表, 按距离递增排序"""
+        return self._tree.search(h, max_distance)
+
+
+phash_index = PerceptualIndex()
@@ -0,0 +1,103 @@
+"""按群划分的录入策略
+
+配置中的策略在载入时被编译成不可变的 `CompiledPolicy`, 录入时只需一次字典查找
+和几次属性访问即可决定如何处理一条消息, 在做任何数据库操作之前就能丢掉不需要的部分"""
+
+import fnmatch
+import random
+import re
+from dataclasses import dataclass
+
+from melobot.protocols.onebot.v11.adapter.event import GroupMessageEvent, MessageEvent
+
+from .params import RecorderConfig, RecordPolicy
+
+__all__ = ["TEXT_SEGMENT_TYPES", "mimetype_allowed", "CompiledPolicy", "PolicyMatcher"]
+
+# text 模式下保留的消息段类型
+TEXT_SEGMENT_TYPES = frozenset({"text", "at", "face", "reply"})
+
+
+def mimetype_allowed(pattern: str | None, mimetype: str):
+    """`pattern` 为编译后的 MIME 类型通配, 为空时不限制"""
+    if pattern is None:
+        return True
+    return re.match(pattern, mimetype.split(";")[0].strip().lower()) is not None
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledPolicy:
+    store: bool
+    text_only: bool
+    download_media: bool
+    sample_rate: float
+    # 由 MIME 类型通配编译成的正则表达式
+    media_types: str | None
+    max_media_size: int
+    # 需要归档的消息段类型
+    archive_types: frozenset[str]
+    max_archive_size: int
+
+    @classmethod
+    def compile(cls, policy: RecordPolicy):
+        types = None
+        if policy.media_types:
+            types = "|".join(fnmatch.translate(t.lower()) for t in policy.media_types)
+        return cls(
+            store=policy.mode != "skip" and policy.sample_rate > 0,
+            text_only=policy.mode == "text",
+            download_media=policy.mode == "full" and policy.download_media,
+            sample_rate=policy.sample_rate,
+            media_types=types,
+            max_media_size=max(policy.max_media_size, 0),
+            archive_types=frozenset(
+                t
+                for t, enabled in (
+                    ("video", policy.archive_videos),
+                    ("file", policy.archive_files),
+                )
+                if enabled and policy.mode == "full"
+            ),
+            max_archive_size=max(policy.max_archive_size, 0),
+        )
+
+    def sampled(self):
+        """决定这一条消息是否录入"""
+        return self.store and (
+            self.sample_rate >= 1 or random.random() < self.sample_rate
+        )
+
+    def keep_segment(self, type: str):
+        return not self.text_only or type in TEXT_SEGMENT_TYPES
+
+    def allows_size(self, size: int):
+        return not self.max_media_size or size <= self.max_media_size
+
+    def archives(self, type: str, size: int):
+        """是否归档这个消息段, `size` 为消息段声明的大小, 未知时为 0"""
+        return type in self.archive_types and (
+            not self.max_archive_size or size <= self.max_archive_size
+        )
+
+    def media_limits(self):
+        """下载任务所需的限制参数, 随任务一起持久化"""
+        limits: dict[str, object] = {}
+        if self.media_types is not None:
+            limits["types"] = self.media_types
+        if self.max_media_size:
+            limits["max_size"] = self.max_media_size
+        return limits
+
+
+class PolicyMatcher:
+    def __init__(self, config: RecorderConfig):
+        self.private = CompiledPolicy.compile(config.private_policy)
+        self.default = CompiledPolicy.compile(config.default_policy)
+        self.groups = {
+            gid: CompiledPolicy.compile(p) for gid, p in config.group_policies.items()
+        }
+
+    def match(self, event: MessageEvent):
+        if isinstance(event, GroupMessageEvent):
+            return self.groups.get(event.group_id, self.default)
+        return self.private
@@ -0,0 +1,99 @@
+"""把主库中已有的群消息迁移到分片
+
+启用分片之前录入的群消息都在 messages.db 中. 迁移逐个群进行, 最近活跃的群优先;
+每个群按批迁移: 先把一批消息和消息段写入分片, 提交后再从主库中删除.
+一个群迁移完之前, 对它的 `route_read` 会等待, 以免读到不完整的历史.
+启用分片后新消息只会写入分片, 所以群一旦迁移完就不会再有消息留在主库中.
+中途退出时重复写入的行会被跳过, 下次启动继续迁移"""
+
+from melobot.log import get_logger
+from sqlalchemy import bindparam, delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import SQLModel
+
+from lemony_utils.database import ShardRouter
+from recorder_models import Message, MessageSegment
+
+__all__ = ["SHARDED_TABLES", "migrate_to_shards"]
+
+_MESSAGE_TABLE = SQLModel.metadata.tables[Message.__tablename__]
+_SEGMENT_TABLE = SQLModel.metadata.tables[MessageSegment.__tablename__]
+# 分片中只保存这两张表, 其余的表通过 ATTACH 的主库访问
+SHARDED_TABLES = [_MESSAGE_TABLE, _SEGMENT_TABLE]
+
+_PENDING_GROUPS = (
+    select(_MESSAGE_TABLE.c.group_id)
+    .where(_MESSAGE_TABLE.c.group_id.is_not(None))
+    .group_by(_MESSAGE_TABLE.c.group_id)
+    .order_by(func.max(_MESSAGE_TABLE.c.store_time).desc())
+)
+_TAKE_MESSAGES = (
+    select(_MESSAGE_TABLE)
+    .where(_MESSAGE_TABLE.c.group_id == bindparam("group_id"))
+    .order_by(_MESSAGE_TABLE.c.store_time)
+    .limit(bindparam("limit"))
+)
+_TAKE_SEGMENTS = select(_SEGMENT_TABLE).where(
+    _SEGMENT_TABLE.c.message_store_id.in_(bindparam("ids", expanding=True))
+)
+_PUT_MESSAGE = insert(_MESSAGE_TABLE).on_conflict_do_nothing()
+_PUT_SEGMENT = insert(_SEGMENT_TABLE).on_conflict_do_nothing()
+_DROP_SEGMENTS = delete(_SEGMENT_TABLE).where(
+    _SEGMENT_TABLE.c.message_store_id.in_(bindparam("ids", expanding=True))
+)
+_DROP_MESSAGES = delete(_MESSAGE_TABLE).where(
+    _MESSAGE_TABLE.c.store_id.in_(bindparam("ids", expanding=True))
+)
+
+
+async def migrate_to_shards(router: ShardRouter, batch: int = 1000):
+    """把主库中的群消息全部移入分片, 返回移动的消息条数
+
+    启用分片时必须在启动后调用, 失败时也会放行所有等待中的读取"""
+    if not router.enabled:
+        return 0
+    # 按 message_store_id 取出和删除消息段依赖启动时补建的索引, 否则每批都要扫描整张表
+    await router.main.started.wait()
+    total = 0
+    try:
+        async with router.main.begin() as conn:
+            groups = (await conn.execute(_PENDING_GROUPS)).scalars().all()
+        router.begin_migration(groups)
+        for group_id in groups:
+            total += await _migrate_group(router, group_id, batch)
+            router.finish_migration(group_id)
+    except Exception:
+        get_logger().exception("Failed to migrate group msgs into shards")
+    finally:
+        router.finish_migration()
+    return total
+
+
+async def _migrate_group(router: ShardRouter, group_id: int, batch: int):
+    shard = await router.route(group_id)
+    total = 0
+    while True:
+        async with router.main.begin() as conn:
+            messages = (
+                (
+                    await conn.execute(
+                        _TAKE_MESSAGES, {"group_id": group_id, "limit": batch}
+                    )
+                )
+                .mappings()
+                .all()
+            )
+            if not messages:
+                return total
+            ids = [m["store_id"] for m in messages]
+            segments = (
+                (await conn.execute(_TAKE_SEGMENTS, {"ids": ids})).mappings().all()
+            )
+        async with shard.begin() as conn:
+            await conn.execute(_PUT_MESSAGE, [dict(m) for m in messages])
+            if segments:
+                await conn.execute(_PUT_SEGMENT, [dict(s) for s in segments])
+        async with router.main.begin() as conn:
+            await conn.execute(_DROP_SEGMENTS, {"ids": ids})
+            await conn.execute(_DROP_MESSAGES, {"ids": ids})
+        total += len(messages)
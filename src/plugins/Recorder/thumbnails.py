@@ -0,0 +1,51 @@
+"""录入时预先生成的缩小版图片
+
+渲染器只需要宽度在几百像素以内的图片, 却每次都要解码完整的原图再缩小.
+这里在文件存储完成后, 于原图旁边生成若干个指定宽度的 WebP 变体,
+渲染前按所需宽度挑选最接近的一个即可"""
+
+import os
+from collections.abc import Iterable
+
+from PIL import Image
+
+__all__ = ["variant_path", "ensure_thumbnails", "pick_variant"]
+
+
+def variant_path(path: str, width: int):
+    return f"{os.path.splitext(path)[0]}.w{width}.webp"
+
+
+def ensure_thumbnails(path: str, widths: Iterable[int], quality: int = 80):
+    """为原图生成缺失的缩小变体, 返回新生成的文件路径
+
+    只生成比原图窄的变体, 动图只取第一帧"""
+    todo = [w for w in sorted(set(widths), reverse=True) if w > 0]
+    todo = [w for w in todo if not os.path.isfile(variant_path(path, w))]
+    if not todo:
+        return []
+    created: list[str] = []
+    with Image.open(path) as img:
+        width, height = img.size
+        if not (todo := [w for w in todo if w < width]):
+            return []
+        # 对 JPEG 可以直接以缩小的尺寸解码
+        img.draft("RGB", (todo[0], max(1, height * todo[0] // width)))
+        frame = img.convert("RGBA")
+    # 从大到小逐级缩小, 每一级都以上一级为源
+    for w in todo:
+        frame = frame.resize(
+            (w, max(1, round(height * w / width))), Image.Resampling.LANCZOS
+        )
+        dest = variant_path(path, w)
+        frame.save(dest, "WEBP", quality=quality, method=4)
+        created.append(dest)
+    return created
+
+
+def pick_variant(path: str, min_width: int, widths: Iterable[int]):
+    """挑选宽度不小于 min_width 的最窄变体, 没有合适的变体时返回原图路径"""
+    for w in sorted(widths):
+        if w >= min_width and os.path.isfile(p := variant_path(path, w)):
+            return p
+    return path
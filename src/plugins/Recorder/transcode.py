@@ -0,0 +1,41 @@
+"""录入时把图片转码为 WebP
+
+下载到的图片大多原样保存, 其中不少是体积庞大的 PNG 截图. 这里在写入磁盘之前
+把它们转码成无损或有损的 WebP, 只有结果更小时才替换原数据. 转码是 CPU 密集的操作,
+由调用方放到进程池中执行, 因此本模块只依赖 Pillow, 不能有任何导入副作用"""
+
+from io import BytesIO
+
+from PIL import Image
+
+__all__ = ["COMPACT_EXTENSION", "transcode_to_webp"]
+
+COMPACT_EXTENSION = ".webp"
+
+
+def transcode_to_webp(data: bytes, lossless: bool, quality: int = 85):
+    """返回转码后的数据; 动图、已是 WebP 或转码后不更小时返回 None"""
+    with Image.open(BytesIO(data)) as img:
+        if img.format == "WEBP" or getattr(img, "is_animated", False):
+            return None
+        icc_profile = img.info.get("icc_profile")
+        # 保留 EXIF, 否则手机照片会丢失方向标记而被旋转着显示
+        exif = img.info.get("exif") or b""
+        has_alpha = img.mode in ("RGBA", "LA", "PA") or (
+            img.mode == "P" and "transparency" in img.info
+        )
+        frame = img.convert("RGBA" if has_alpha else "RGB")
+    out = BytesIO()
+    frame.save(
+        out,
+        "WEBP",
+        lossless=lossless,
+        # 无损模式下 quality 表示压缩力度
+        quality=quality,
+        method=4,
+        icc_profile=icc_profile,
+        exif=exif,
+    )
+    if out.tell() >= len(data):
+        return None
+    return out.getvalue()
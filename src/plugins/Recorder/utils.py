@@ -1,11 +1,14 @@
+from collections import Counter
 from datetime import datetime
 from typing import TypedDict, Unpack
 
 from sqlmodel import Session, and_, col, desc, func, or_, select
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, selectinload
 
 from recorder_models import Message, User
 
+from .hotcache import CachedMessage, hot_cache
+
 
 def query_group_msg_count(
 		session: Session, group_id: int, start_time: datetime, end_time: datetime
@@ -127,11 +130,27 @@ def get_context_messages1(
 		return earliers[::-1] + [base_message] + laters
 
 
+def _assemble_context[T](
+    edge_e: int, edge_l: int, base: T, earliers: list[T], laters: list[T]
+) -> list[T]:
+    """earliers 按时间倒序, laters 按时间正序"""
+    if edge_e == edge_l == 0:
+        return [base]
+    if edge_e > 0:
+        return laters[edge_e - 1:] if edge_e <= len(laters) else []
+    elif edge_l < 0:
+        return earliers[abs(edge_l) - 1:][::-1] if abs(edge_l) <= len(earliers) else []
+    else:
+        return earliers[::-1] + [base] + laters
+
+
 def get_context_messages(
         session: Session, **context: Unpack[RangeContextParams]
-) -> list[Message]:
+) -> list[Message] | list[CachedMessage]:
     """
     获取上下文消息，主动加载 segments 关系
+
+    窗口落在热缓存内时直接返回缓存中的 `CachedMessage`, 不会发出任何查询
     """
     from sqlalchemy.orm import joinedload
 
@@ -140,6 +159,14 @@ def get_context_messages(
     gid = context["group_id"]
     uid = context["sender_id"]
     mid = context["base_msgid"]
+    cached = hot_cache.context(
+        gid, uid, mid, edge_e, edge_l, context["sender_only"]
+    )
+    if cached is not None:
+        base, earliers, laters = cached
+        if base is None:
+            return []
+        return _assemble_context(edge_e, edge_l, base, earliers, laters)
     extra_filters = [Message.sender_id == uid] if context["sender_only"] else []
 
     # 查询基准消息，主动加载关系
@@ -182,7 +209,7 @@ def get_context_messages(
             .distinct()
             .order_by(col(Message.timestamp).desc(), col(Message.message_id).desc())
             .limit(abs(edge_e))
-        ).all()
+        ).unique().all()
 
     # 查询晚于基准的消息，主动加载关系
     if edge_l > 0:
@@ -205,22 +232,17 @@ def get_context_messages(
                 col(Message.timestamp).asc(), col(Message.message_id).asc()
             )
             .limit(edge_l)
-        ).all()
+        ).unique().all()
 
-    if edge_e > 0:
-        return laters[edge_e - 1:] if edge_e <= len(laters) else []
-    elif edge_l < 0:
-        return earliers[abs(edge_l) - 1:][::-1] if abs(edge_l) <= len(earliers) else []
-    else:
-        return earliers[::-1] + [base_message] + laters
+    return _assemble_context(edge_e, edge_l, base_message, earliers, laters)
 
 
-async def get_recent_messages(
+def get_recent_messages(
 		session: Session,
 		group_id: int,
 		count: int,
 		sender_id: int | None = None
-) -> list[Message]:
+) -> list[Message] | list[CachedMessage]:
 	"""
     获取群聊中最近N条消息
 
@@ -231,13 +253,15 @@ async def get_recent_messages(
         sender_id: 可选，如果提供则只获取指定发送者的消息
 
     Returns:
-        按时间戳递增排序的消息列表（从早到晚）
+        按时间戳递增排序的消息列表（从早到晚）, 命中热缓存时为 `CachedMessage`
     """
-	# 构建基础查询，使用 joinedload 主动加载 segments 和 sender 关系
-	from sqlalchemy.orm import joinedload
+	if (cached := hot_cache.recent(group_id, count, sender_id)) is not None:
+		return cached
 
+	# 构建基础查询，使用 joinedload 主动加载 segments 和 sender 关系
 	query = select(Message).options(
 		joinedload(Message.sender),
+		joinedload(Message.group),
 		joinedload(Message.segments)  # 主动加载 segments 关系
 	).where(
 		Message.group_id == group_id
@@ -254,3 +278,34 @@ async def get_recent_messages(
 	).unique().all()
 
 	return list(reversed(messages))
+
+
+def warm_hot_cache(session: Session, per_group: int):
+	"""从数据库中取出每个群最近 per_group 条消息来预热热缓存"""
+	if per_group <= 0:
+		return
+	rank = func.row_number().over(
+		partition_by=Message.group_id,
+		order_by=(col(Message.timestamp).desc(), col(Message.message_id).desc()),
+	).label("rank")
+	ranked = (
+		select(Message.store_id, rank)
+		.where(col(Message.group_id).is_not(None))
+		.subquery()
+	)
+	messages = session.exec(
+		select(Message)
+		.options(
+			joinedload(Message.sender),
+			joinedload(Message.group),
+			selectinload(Message.segments),
+		)
+		.join(ranked, ranked.c.store_id == Message.store_id)
+		.where(ranked.c.rank <= per_group)
+	).all()
+	counts = Counter(m.group_id for m in messages)
+	hot_cache.warm(
+		messages,
+		exhausted_groups=[gid for gid, n in counts.items() if n < per_group],
+	)
+	return len(messages)
@@ -9,11 +9,11 @@ from melobot.handle import on_start_match
 from melobot.plugin import PluginPlanner
 from melobot.protocols.onebot.v11.adapter import Adapter
 from melobot.protocols.onebot.v11.adapter.event import GroupMessageEvent
-from sqlmodel import Session, and_, col, not_, select
+from sqlmodel import Session, and_, col, func, not_, select
 
 import checker_factory
 from lemony_utils.botutils import get_reply
-from lemony_utils.images import text_to_imgseg
+from lemony_utils.images import text_to_imgsegs
 from recorder_models import Message, MessageSegment
 
 from .. import Recorder
@@ -51,6 +51,8 @@ def query_messages(session: Session, keyword: str, group_id: int):
             and_(
                 Message.group_id == group_id,
                 MessageSegment.type == "text",
+                # 压缩保存的消息段不是 JSON 文本, 无法按路径搜索
+                func.typeof(MessageSegment.data) == "text",
                 col(MessageSegment.data)["text"].icontains(keyword),
                 not_(col(MessageSegment.data)["text"].startswith(".recquery")),
             )
@@ -64,13 +66,14 @@ def query_messages(session: Session, keyword: str, group_id: int):
 @on_start_match(".recquery ", checker=checker_factory.get_owner_checker())
 async def query(event: GroupMessageEvent, adapter: Adapter) -> None:
     words = event.text.removeprefix(".recquery ").strip()
-    result = await Recorder.database.run_sync(
+    database = await Recorder.shards.route_read(event.group_id)
+    result = await database.run_sync(
         query_messages, group_id=event.group_id, keyword=words
     )
     if not result:
         await adapter.send_reply("没有查到记录")
         return
-    await adapter.send_reply(await text_to_imgseg(result))
+    await adapter.send_reply(await text_to_imgsegs(result))
 
 
 @plugin.use
@@ -100,7 +103,8 @@ async def get_ctx(event: GroupMessageEvent, adapter: Adapter) -> None:
     else:
         sonly = False
 
-    result = await Recorder.database.run_sync(
+    database = await Recorder.shards.route_read(event.group_id)
+    result = await database.run_sync(
         msgs_return_text(Recorder.get_context_messages),
         base_msgid=base_msg.data["message_id"],
         group_id=event.group_id,
@@ -112,4 +116,4 @@ async def get_ctx(event: GroupMessageEvent, adapter: Adapter) -> None:
     if not result:
         await adapter.send_reply("没有查到记录")
         return
-    await adapter.send_reply(await text_to_imgseg(result))
+    await adapter.send_reply(await text_to_imgsegs(result))
@@ -3,10 +3,12 @@ from typing import TYPE_CHECKING, Any, Generic, TypeVar
 from collections.abc import Awaitable
 import uuid
 
-from sqlmodel import Relationship, SQLModel, Field, JSON, CheckConstraint
+from sqlmodel import Relationship, SQLModel, Field, CheckConstraint
 from sqlalchemy import Column
 from sqlalchemy.ext.asyncio.session import AsyncAttrs as _AsyncAttrs
 
+from lemony_utils.compressed_json import CompressedJSON
+
 __all__ = [
     "UserGroupLink",
     "User",
@@ -14,6 +16,9 @@ __all__ = [
     "Message",
     "MessageSegment",
     "MediaFile",
+    "MediaHash",
+    "ArchivedFile",
+    "SegmentDictionary",
     "TABLES",
 ]
 
@@ -120,9 +125,10 @@ class MessageSegment(SQLModel, AsyncAttrs[_MsgSegAwaitableAttrs], table=True):
     order: int = Field(ge=0)
 
     type: str
-    data: dict[str, Any] = Field(sa_column=Column(JSON))
+    # 较早的消息段会被压缩保存, 读取时自动解压
+    data: dict[str, Any] = Field(sa_column=Column(CompressedJSON))
 
-    message_store_id: uuid.UUID = Field(foreign_key="message.store_id")
+    message_store_id: uuid.UUID = Field(foreign_key="message.store_id", index=True)
     message: Message = Relationship(back_populates="segments")
 
 
@@ -134,7 +140,47 @@ class MediaFile(SQLModel, AsyncAttrs, table=True):
     hash: str | None = None
 
 
+class MediaHash(SQLModel, table=True):
+    # 每个实际存储的文件一条记录
+    path: str = Field(primary_key=True)
+    # 64 位感知哈希的十六进制表示
+    dhash: str
+
+
+class ArchivedFile(SQLModel, table=True):
+    """归档的视频和文件"""
+
+    fileid: str = Field(primary_key=True)
+    # video 或 file
+    kind: str
+    name: str | None = None
+    timestamp: float = Field(default_factory=time.time)
+    # 在下载完成前用 None 占位
+    size: int | None = None
+    sha256: str | None = Field(default=None, index=True)
+    path: str | None = None
+
+
+class SegmentDictionary(SQLModel, table=True):
+    """压缩消息段数据用的 zstd 字典"""
+
+    # zstd 字典 id, 同时写在每个压缩帧的帧头中
+    id: int = Field(primary_key=True)
+    data: bytes
+    created: float = Field(default_factory=time.time)
+
+
 TABLES = [
     SQLModel.metadata.tables[t.__tablename__]
-    for t in (UserGroupLink, User, Group, Message, MessageSegment, MediaFile)
+    for t in (
+        UserGroupLink,
+        User,
+        Group,
+        Message,
+        MessageSegment,
+        MediaFile,
+        MediaHash,
+        ArchivedFile,
+        SegmentDictionary,
+    )
 ]